@@ -0,0 +1,203 @@
+import asyncio
+import logging
+from aiogram import Bot
+from aiogram.types import ChatMemberStatus
+from sqlalchemy import delete, exists, select
+from sqlalchemy.exc import IntegrityError
+from cache import TTLCache
+from database import ChatAdmin, ChatSettings
+
+logger = logging.getLogger(__name__)
+
+async def gather_limited(funcs, concurrency=10, rate=20):
+    """Выполняет корутины параллельно: не больше concurrency одновременно и не чаще rate запусков в секунду"""
+    semaphore = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_running_loop()
+    interval = 1 / rate if rate else 0
+    next_start = loop.time()
+    
+    async def run(func):
+        nonlocal next_start
+        async with semaphore:
+            # Запуски разносим по времени, чтобы не упереться в ограничения Telegram
+            now = loop.time()
+            start = max(now, next_start)
+            next_start = start + interval
+            if start > now:
+                await asyncio.sleep(start - now)
+            return await func()
+    
+    return await asyncio.gather(*(run(func) for func in funcs), return_exceptions=True)
+
+class AdminIndex:
+    """Постоянный индекс администраторов (таблица chat_admins): какие чаты может настраивать пользователь"""
+    
+    def __init__(self, session_factory):
+        self.session_factory = session_factory
+    
+    async def replace_chat(self, chat_id, admin_ids, title=None):
+        """Приводит записи чата к актуальному списку администраторов"""
+        key = str(chat_id)
+        user_ids = {str(user_id) for user_id in admin_ids}
+        
+        async with self.session_factory() as session:
+            rows = (await session.scalars(select(ChatAdmin).where(ChatAdmin.chat_id == key))).all()
+            if title is None:
+                title = next((row.chat_title for row in rows if row.chat_title), None)
+            
+            existing = set()
+            for row in rows:
+                if row.user_id not in user_ids:
+                    await session.delete(row)
+                    continue
+                existing.add(row.user_id)
+                if title and row.chat_title != title:
+                    row.chat_title = title
+            
+            session.add_all(ChatAdmin(chat_id=key, user_id=user_id, chat_title=title) for user_id in user_ids - existing)
+            await self._commit(session, key)
+    
+    async def update_member(self, chat_id, user_id, is_admin, title=None):
+        """Добавляет или удаляет одного администратора по обновлению chat_member"""
+        key = str(chat_id)
+        
+        async with self.session_factory() as session:
+            row = await session.scalar(select(ChatAdmin).where(
+                ChatAdmin.user_id == str(user_id),
+                ChatAdmin.chat_id == key
+            ).limit(1))
+            
+            if not is_admin:
+                if row is not None:
+                    await session.delete(row)
+            elif row is None:
+                session.add(ChatAdmin(chat_id=key, user_id=str(user_id), chat_title=title))
+            elif title:
+                row.chat_title = title
+            
+            await self._commit(session, key)
+    
+    async def remove_chat(self, chat_id):
+        """Удаляет чат из индекса, например когда бота исключили из группы"""
+        async with self.session_factory() as session:
+            await session.execute(delete(ChatAdmin).where(ChatAdmin.chat_id == str(chat_id)))
+            await session.commit()
+    
+    async def get_user_chats(self, user_id):
+        """Чаты пользователя из индекса: список пар (chat_id, название)"""
+        async with self.session_factory() as session:
+            rows = await session.execute(select(ChatAdmin.chat_id, ChatAdmin.chat_title).where(
+                ChatAdmin.user_id == str(user_id)
+            ).order_by(ChatAdmin.chat_title))
+            return [(int(chat_id), title) for chat_id, title in rows]
+    
+    async def get_unindexed_chats(self):
+        """Чаты с настройками, администраторы которых еще ни разу не попадали в индекс"""
+        async with self.session_factory() as session:
+            chat_ids = await session.scalars(select(ChatSettings.chat_id).where(
+                ~exists().where(ChatAdmin.chat_id == ChatSettings.chat_id)
+            ))
+            return [int(chat_id) for chat_id in chat_ids]
+    
+    async def _commit(self, session, chat_id):
+        # Одновременное обновление того же чата: запись уже сделана другой задачей
+        try:
+            await session.commit()
+        except IntegrityError:
+            await session.rollback()
+            logger.warning("Конфликт при обновлении индекса администраторов чата %s", chat_id)
+
+class AdminCache:
+    """Кэш администраторов чатов: список загружается одним запросом get_chat_administrators и живет ttl секунд"""
+    
+    def __init__(self, bot: Bot, index: AdminIndex, maxsize=1024, ttl=600, refresh_concurrency=10, refresh_rate=20):
+        self.bot = bot
+        self.index = index
+        self.refresh_concurrency = refresh_concurrency
+        self.refresh_rate = refresh_rate
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        # Чаты, которые не удалось обновить (бота удалили, чат закрыт): не опрашиваем их на каждый /config
+        self._failed = TTLCache(maxsize=maxsize, ttl=ttl)
+        # Загрузки, которые уже выполняются: параллельные проверки одного чата ждут один запрос
+        self._loading = {}
+    
+    def __len__(self):
+        return len(self._cache)
+    
+    async def get_admins(self, chat_id, title=None):
+        """Идентификаторы администраторов и создателя чата"""
+        key = str(chat_id)
+        admins = self._cache.get(key)
+        if admins is not None:
+            return admins
+        
+        task = self._loading.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._load(chat_id, title))
+            self._loading[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        
+        # Отмена одного из ожидающих не должна отменять общую загрузку
+        return await asyncio.shield(task)
+    
+    def _forget(self, key, task):
+        if self._loading.get(key) is task:
+            del self._loading[key]
+    
+    async def _load(self, chat_id, title=None):
+        key = str(chat_id)
+        members = await self.bot.get_chat_administrators(chat_id)
+        admins = frozenset(member.user.id for member in members)
+        
+        # Если чат сбросили во время загрузки, ответ мог устареть - не кэшируем и не индексируем его
+        if self._loading.get(key) is not asyncio.current_task():
+            return admins
+        
+        self._cache.set(key, admins)
+        logger.debug("Загружены администраторы чата %s: %s", chat_id, len(admins))
+        
+        # Ошибка записи индекса не должна мешать проверке прав
+        try:
+            await self.index.replace_chat(chat_id, admins, title)
+        except Exception as e:
+            logger.error("Ошибка при обновлении индекса администраторов чата %s: %s", chat_id, e)
+        
+        return admins
+    
+    async def is_admin(self, chat_id, user_id, title=None):
+        """Является ли пользователь администратором или создателем чата"""
+        return user_id in await self.get_admins(chat_id, title)
+    
+    def invalidate(self, chat_id):
+        key = str(chat_id)
+        self._cache.invalidate(key)
+        self._loading.pop(key, None)
+    
+    async def refresh_chats(self, chat_ids):
+        """Параллельно перечитывает администраторов и названия чатов с ограничением частоты запросов"""
+        chat_ids = [chat_id for chat_id in chat_ids if str(chat_id) not in self._failed]
+        
+        async def refresh(chat_id):
+            try:
+                chat = await self.bot.get_chat(chat_id)
+                self.invalidate(chat_id)
+                await self.get_admins(chat_id, chat.title)
+            except Exception as e:
+                self._failed.set(str(chat_id), True)
+                logger.error("Ошибка при получении информации о чате %s: %s", chat_id, e)
+        
+        await gather_limited(
+            [lambda chat_id=chat_id: refresh(chat_id) for chat_id in chat_ids],
+            concurrency=self.refresh_concurrency,
+            rate=self.refresh_rate
+        )
+    
+    def stats(self):
+        return self._cache.stats()
+
+def is_admin_change(chat_member_updated):
+    """Затрагивает ли изменение участника состав администраторов чата"""
+    return (
+        ChatMemberStatus.is_chat_admin(chat_member_updated.old_chat_member.status)
+        or ChatMemberStatus.is_chat_admin(chat_member_updated.new_chat_member.status)
+    )
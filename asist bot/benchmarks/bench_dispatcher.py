@@ -0,0 +1,333 @@
+"""Бенчмарк пропускной способности бота на синтетических потоках обновлений.
+
+Запуск из каталога бота: python benchmarks/bench_dispatcher.py [--updates 3000] [--api-latency 20]
+
+Диспетчер собирается настоящим модулем bot.py (register_handlers, setup_filters,
+middleware, очереди) на временной базе SQLite. Запросы к Telegram перехватываются
+на уровне aiogram.bot.api.make_request: ответы подставляются, вызовы считаются,
+задержка сети имитируется через asyncio.sleep. Обновления подаются пачками,
+как при long polling.
+
+Для каждого потока выводятся обновления в секунду, p50/p99 времени обработки
+обновления, запросы к базе и к Telegram на обновление, а также память по
+tracemalloc (отдельный прогон). Результаты можно сохранить (--save) и сравнить
+с сохраненными ранее (--compare). Остальные настройки бота берутся из окружения,
+как при обычном запуске (например, RAID_THRESHOLD).
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BOT_DIR)
+
+# Администратор всех тестовых чатов; авторы сообщений - обычные участники
+ADMIN_ID = 1
+FIRST_USER_ID = 1000
+
+CHATTER_WORDS = (
+    'привет', 'как', 'дела', 'сегодня', 'погода', 'хорошая', 'кто', 'идет', 'вечером', 'на', 'встречу',
+    'спасибо', 'за', 'помощь', 'код', 'работает', 'релиз', 'завтра', 'отличная', 'идея', 'согласен',
+    'hello', 'thanks', 'see', 'you', 'later', 'ok', 'lol', 'т.е.', 'ну', 'да', 'нет', 'может', 'быть',
+)
+SPAM_LINKS = ('https://spam.xyz/promo', 'join t.me/spam_channel', 'www.casino.bet', 'заходи на free-money.top')
+ALLOWED_LINKS = ('https://example.org/docs', 'example.org/page')
+RAID_TEXTS = (
+    'Лучшие ставки на спорт, бонус новым игрокам до 500%, пиши в личку прямо сейчас',
+    'Заработок от 5000 в день без вложений и опыта, подробности у меня в профиле',
+)
+
+def chatter(rng, min_words=3, max_words=20):
+    return ' '.join(rng.choices(CHATTER_WORDS, k=rng.randint(min_words, max_words)))
+
+def random_word(rng):
+    return ''.join(rng.choices('абвгдежзиклмнопрстуфхцшэюя', k=rng.randint(5, 10)))
+
+# Потоки: тексты сообщений и подготовка чатов (настройки, слова, домены)
+def clean_text(rng, chat):
+    return chatter(rng)
+
+def links_text(rng, chat):
+    roll = rng.random()
+    if roll < 0.4:
+        return f"{chatter(rng, 1, 8)} {rng.choice(SPAM_LINKS)}"
+    if roll < 0.6:
+        return f"{chatter(rng, 1, 8)} {rng.choice(ALLOWED_LINKS)}"
+    return chatter(rng)
+
+def obscene_text(rng, chat):
+    if rng.random() < 0.7:
+        return f"{chatter(rng, 1, 6)} бля {chatter(rng, 0, 6)}"
+    return chatter(rng)
+
+def banned_words_text(rng, chat):
+    if rng.random() < 0.1:
+        return f"{chatter(rng, 1, 10)} {rng.choice(chat['words'])}"
+    return chatter(rng, 5, 30)
+
+def duplicates_text(rng, chat):
+    # Копии рейда с мелкими отличиями в конце
+    if rng.random() < 0.5:
+        return f"{rng.choice(RAID_TEXTS)} {rng.randint(1, 99)}"
+    return chatter(rng)
+
+SCENARIOS = {
+    'clean': clean_text,
+    'links': links_text,
+    'obscene': obscene_text,
+    'banned_words': banned_words_text,
+    'duplicates': duplicates_text,
+}
+
+class FakeTelegram:
+    """Подмена Bot API: отвечает на запросы без сети, считает вызовы по методам и имитирует задержку"""
+    
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+    
+    async def make_request(self, session, server, token, method, data=None, files=None, **kwargs):
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        
+        data = data or {}
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        if method == 'sendMessage':
+            return {'message_id': 1, 'date': 0, 'chat': {'id': int(data['chat_id']), 'type': 'supergroup'},
+                    'text': data.get('text')}
+        if method == 'getChatAdministrators':
+            return [{'user': {'id': ADMIN_ID, 'is_bot': False, 'first_name': 'admin'}, 'status': 'creator'}]
+        if method == 'getChatMember':
+            return {'user': {'id': int(data['user_id']), 'is_bot': False, 'first_name': 'user'}, 'status': 'member'}
+        if method == 'getChat':
+            return {'id': int(data['chat_id']), 'type': 'supergroup', 'title': f"Chat {data['chat_id']}"}
+        return True
+
+def configure_environment(args, directory):
+    """Окружение бота для бенчмарка: временная база и отсутствие внешних ограничений"""
+    os.environ['DATABASE_URL'] = args.database_url or f"sqlite:///{os.path.join(directory, 'bench.db')}"
+    os.environ.setdefault('BOT_TOKEN', '123456:bench-token')
+    os.environ.setdefault('FSM_STORAGE', 'memory')
+    os.environ['METRICS_PORT'] = '0'
+    os.environ.setdefault('LOG_LEVEL', 'ERROR')
+    os.environ.setdefault('LOG_SAMPLE_RATE', '0')
+    # Лимиты Telegram в бенчмарке не моделируются: очередь не должна ждать токенов
+    os.environ.setdefault('OUTBOX_GLOBAL_RATE', '1000000')
+    os.environ.setdefault('OUTBOX_GROUP_RATE', '1000000')
+    os.environ.setdefault('OUTBOX_MAX_RETRIES', '0')
+
+async def seed_chats(session_factory, scenario, chat_ids, args, rng):
+    """Создает настройки тестовых чатов; для banned_words - еще и длинные списки слов"""
+    from database import AllowedDomain, BannedWord, ChatSettings
+    
+    chats = {}
+    async with session_factory() as session:
+        for chat_id in chat_ids:
+            chat = {'id': chat_id, 'words': []}
+            session.add(ChatSettings(chat_id=str(chat_id), action_type=args.action))
+            session.add(AllowedDomain(chat_id=str(chat_id), domain='example.org'))
+            if scenario == 'banned_words':
+                chat['words'] = sorted({random_word(rng) for _ in range(args.banned_words)})
+                session.add_all(BannedWord(chat_id=str(chat_id), word=word) for word in chat['words'])
+            chats[chat_id] = chat
+        await session.commit()
+    return chats
+
+def make_updates(scenario, chats, count, rng, counters):
+    """Обновления в виде словарей, как в ответе getUpdates: разбор в types.Update входит в замер"""
+    make_text = SCENARIOS[scenario]
+    chat_list = list(chats.values())
+    updates = []
+    for _ in range(count):
+        chat = rng.choice(chat_list)
+        counters['update_id'] += 1
+        counters[chat['id']] += 1
+        user_id = FIRST_USER_ID + rng.randrange(counters['users'])
+        updates.append({
+            'update_id': counters['update_id'],
+            'message': {
+                'message_id': counters[chat['id']],
+                'date': int(time.time()),
+                'text': make_text(rng, chat),
+                'chat': {'id': chat['id'], 'type': 'supergroup', 'title': f"Chat {chat['id']}"},
+                'from': {'id': user_id, 'is_bot': False, 'first_name': 'user', 'username': f"user{user_id}"},
+            },
+        })
+    return updates
+
+async def replay(dp, updates, batch_size):
+    """Подает обновления, как long polling; возвращает общее время и время каждого обновления.
+    
+    Через планировщик обновления ставятся в очереди чатов, как в ScheduledDispatcher.start_polling,
+    и время обновления считается от приема до конца обработки. Без планировщика обновления
+    обрабатываются пачками по batch_size.
+    """
+    from aiogram import types
+    
+    latencies = []
+    scheduler = getattr(dp, 'scheduler', None)
+    
+    async def process(update):
+        started = time.perf_counter()
+        await dp.updates_handler.notify(types.Update(**update))
+        latencies.append(time.perf_counter() - started)
+    
+    def done(started):
+        return lambda future: latencies.append(time.perf_counter() - started)
+    
+    started = time.perf_counter()
+    if scheduler is None:
+        for offset in range(0, len(updates), batch_size):
+            await asyncio.gather(*(process(update) for update in updates[offset:offset + batch_size]))
+    else:
+        futures = []
+        for update in updates:
+            future = await scheduler.submit(types.Update(**update))
+            future.add_done_callback(done(time.perf_counter()))
+            futures.append(future)
+        await asyncio.gather(*futures, return_exceptions=True)
+    return time.perf_counter() - started, latencies
+
+async def drain(bot_module):
+    """Дожидается отправки очереди запросов к Telegram и записи журнала нарушений"""
+    while len(bot_module.outbox) or bot_module.outbox.stats()['running']:
+        await asyncio.sleep(0.01)
+    await bot_module.violation_log.flush()
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+async def run_scenario(bot_module, fake, scenario, chat_offset, args):
+    from metrics import DB_QUERIES
+    
+    rng = random.Random(f"{args.seed}:{scenario}")
+    chat_ids = [-(1000000 + chat_offset + index) for index in range(args.chats)]
+    chats = await seed_chats(bot_module.db_session.session_factory, scenario, chat_ids, args, rng)
+    counters = Counter(users=args.users)
+    
+    # Прогрев: правила и администраторы чатов попадают в кэши, как в работающем боте
+    await replay(bot_module.dp, make_updates(scenario, chats, args.warmup, rng, counters), args.batch)
+    await drain(bot_module)
+    
+    updates = make_updates(scenario, chats, args.updates, rng, counters)
+    queries_before, calls_before = DB_QUERIES.total(), sum(fake.calls.values())
+    elapsed, latencies = await replay(bot_module.dp, updates, args.batch)
+    await drain(bot_module)
+    queries = DB_QUERIES.total() - queries_before
+    calls = sum(fake.calls.values()) - calls_before
+    
+    # Память меряем отдельным прогоном: tracemalloc заметно замедляет обработку
+    memory_updates = make_updates(scenario, chats, args.memory_updates, rng, counters)
+    # Прирост считаем после сборки мусора, чтобы в нем остались только действительно удерживаемые объекты
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    await replay(bot_module.dp, memory_updates, args.batch)
+    await drain(bot_module)
+    gc.collect()
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    
+    return {
+        'updates': len(updates),
+        'updates_per_sec': len(updates) / elapsed,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'db_queries_per_update': queries / len(updates),
+        'api_calls_per_update': calls / len(updates),
+        'peak_kib': (peak - before) / 1024,
+        'retained_kib_per_1000': (after - before) / 1024 / len(memory_updates) * 1000,
+    }
+
+# Колонки отчета: ключ, заголовок, формат
+COLUMNS = (
+    ('updates_per_sec', 'обн/с', '{:.0f}'),
+    ('p50_ms', 'p50, мс', '{:.2f}'),
+    ('p99_ms', 'p99, мс', '{:.2f}'),
+    ('db_queries_per_update', 'БД/обн', '{:.2f}'),
+    ('api_calls_per_update', 'API/обн', '{:.2f}'),
+    ('peak_kib', 'пик, КиБ', '{:.0f}'),
+    ('retained_kib_per_1000', 'прирост, КиБ/1000', '{:.1f}'),
+)
+
+def print_report(results, baseline=None):
+    print(f"{'поток':<14}" + ''.join(f"{title:>20}" for _, title, _ in COLUMNS))
+    for scenario, result in results.items():
+        print(f"{scenario:<14}" + ''.join(f"{fmt.format(result[key]):>20}" for key, _, fmt in COLUMNS))
+        if baseline and scenario in baseline:
+            cells = []
+            for key, _, _ in COLUMNS:
+                old = baseline[scenario].get(key)
+                cells.append(f"{(result[key] - old) / old * 100:+.1f}%" if old else '-')
+            print(f"{'  к базовому':<14}" + ''.join(f"{cell:>20}" for cell in cells))
+
+async def main(args):
+    import aiogram.bot.api
+    from aiogram import Bot, Dispatcher
+    
+    fake = FakeTelegram(args.api_latency / 1000)
+    aiogram.bot.api.make_request = fake.make_request
+    
+    import bot as bot_module
+    
+    Bot.set_current(bot_module.bot)
+    Dispatcher.set_current(bot_module.dp)
+    await bot_module.on_startup(bot_module.dp)
+    
+    results = {}
+    try:
+        for index, scenario in enumerate(args.scenarios):
+            results[scenario] = await run_scenario(bot_module, fake, scenario, index * args.chats, args)
+    finally:
+        await bot_module.on_shutdown(bot_module.dp)
+        session = await bot_module.bot.get_session()
+        await session.close()
+    
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as file:
+            baseline = json.load(file)['results']
+    
+    print(f"Обновлений: {args.updates}, чатов: {args.chats}, пользователей: {args.users}, "
+          f"пачка: {args.batch}, задержка API: {args.api_latency} мс, действие: {args.action}\n")
+    print_report(results, baseline)
+    
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as file:
+            json.dump({'params': vars(args), 'results': results}, file, ensure_ascii=False, indent=2)
+        print(f"\nРезультаты сохранены в {args.save}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Бенчмарк обработки обновлений через диспетчер бота')
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--updates', type=int, default=3000, help='обновлений в замеряемом прогоне')
+    parser.add_argument('--warmup', type=int, default=500, help='обновлений для прогрева кэшей')
+    parser.add_argument('--memory-updates', type=int, default=1000, help='обновлений в прогоне с tracemalloc')
+    parser.add_argument('--chats', type=int, default=20)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--batch', type=int, default=100, help='обновлений в пачке (getUpdates отдает до 100)')
+    parser.add_argument('--api-latency', type=float, default=20, help='задержка ответа Bot API, мс')
+    parser.add_argument('--banned-words', type=int, default=5000, help='запрещенных слов в чате для banned_words')
+    parser.add_argument('--action', choices=('delete', 'warn', 'mute', 'ban'), default='warn')
+    parser.add_argument('--seed', default='bench')
+    parser.add_argument('--database-url', help='база для прогона (по умолчанию временный файл SQLite)')
+    parser.add_argument('--save', help='сохранить результаты в JSON')
+    parser.add_argument('--compare', help='сравнить с результатами, сохраненными через --save')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        configure_environment(arguments, temp_dir)
+        asyncio.run(main(arguments))
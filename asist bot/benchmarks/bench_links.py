@@ -0,0 +1,86 @@
+"""Регрессионный бенчмарк детектора ссылок на враждебных входных данных.
+
+Запуск из каталога бота: python benchmarks/bench_links.py
+
+Сравнивает прежнее регулярное выражение URL_PATTERN с линейным сканером
+filters.find_link и завершается с ненулевым кодом, если время проверки
+сообщения превышает бюджет или растет сверхлинейно с длиной текста.
+"""
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram import types
+from filters import find_link
+
+# Прежнее выражение с вложенным квантификатором ([\/\w\.-]*)*
+LEGACY_URL_PATTERN = re.compile(r'(https?:\/\/)?([\da-z\.-]+)\.([a-z\.]{2,6})([\/\w\.-]*)*\/?')
+
+# Лимит длины текстового сообщения Telegram
+MESSAGE_LIMIT = 4096
+
+# Бюджет на проверку одного сообщения максимальной длины, в секундах
+BUDGET_PER_MESSAGE = 0.005
+
+ADVERSARIAL_INPUTS = {
+    'digits': lambda n: '1' * n,
+    'letters': lambda n: 'a' * n,
+    'hyphens': lambda n: '-' * n,
+    'digit-hyphen': lambda n: '1-' * (n // 2),
+    'dotted': lambda n: 'a.' * (n // 2),
+    'long-host': lambda n: 'http://' + 'a' * n + '.com',
+    'many-dots': lambda n: '.' * n,
+    'many-links': lambda n: 'x.com ' * (n // 6),
+    'clean-chat': lambda n: ('привет, как дела? всё хорошо, т.е. нормально. ' * n)[:n],
+}
+
+def make_message(text):
+    return types.Message(**{
+        'message_id': 1,
+        'text': text,
+        'chat': {'id': -1, 'type': 'supergroup'},
+        'from': {'id': 1, 'is_bot': False, 'first_name': 'bench'},
+    })
+
+def measure(func, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+def main():
+    failures = []
+    print(f"{'вход':<14}{'длина':>8}{'старый regex, мс':>20}{'find_link, мс':>16}")
+    
+    for name, build in ADVERSARIAL_INPUTS.items():
+        timings = []
+        for length in (MESSAGE_LIMIT // 4, MESSAGE_LIMIT):
+            text = build(length)
+            message = make_message(text)
+            legacy = measure(lambda: LEGACY_URL_PATTERN.search(text), repeat=1)
+            current = measure(lambda: find_link(message))
+            timings.append(current)
+            print(f"{name:<14}{len(text):>8}{legacy * 1000:>20.3f}{current * 1000:>16.3f}")
+        
+        if timings[-1] > BUDGET_PER_MESSAGE:
+            failures.append(f"{name}: {timings[-1] * 1000:.3f} мс превышает бюджет {BUDGET_PER_MESSAGE * 1000:.1f} мс")
+        
+        # При четырехкратном росте длины линейный сканер не должен замедляться больше чем в ~8 раз
+        if timings[0] > 1e-5 and timings[-1] / timings[0] > 8:
+            failures.append(f"{name}: рост времени x{timings[-1] / timings[0]:.1f} при росте длины x4")
+    
+    if failures:
+        print('\nРегрессия производительности:')
+        for failure in failures:
+            print(f"- {failure}")
+        sys.exit(1)
+    
+    print('\nВсе проверки уложились в бюджет.')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""Бенчмарк нормализации текста перед поиском запрещенных слов.
+
+Запуск из каталога бота: python benchmarks/bench_normalize.py
+
+Измеряет normalize_text на обычных и "замаскированных" сообщениях, проверяет,
+что замаскированные варианты нецензурных слов находятся, а обычные слова рядом
+не склеиваются в нецензурные, и завершается с ненулевым кодом, если нормализация
+сообщения превышает бюджет, растет сверхлинейно с длиной текста, перестает находить
+слова или находит их там, где их нет.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from filters import OBSCENE_MATCHER
+from normalize import normalize_text
+
+# Лимит длины текстового сообщения Telegram
+MESSAGE_LIMIT = 4096
+
+# Длина обычного сообщения в чате
+TYPICAL_LENGTH = 200
+
+# Бюджеты на нормализацию обычного сообщения и сообщения максимальной длины, в секундах
+BUDGET_TYPICAL = 0.0001
+BUDGET_PER_MESSAGE = 0.002
+
+INPUTS = {
+    'clean-chat': lambda n: ('привет, как дела? всё хорошо, т.е. нормально. ' * n)[:n],
+    'clean-latin': lambda n: ('hello, how are you? all good, see you later. ' * n)[:n],
+    'homoglyphs': lambda n: ('пpивeт, кaк дeлa? вcё xopoшo. ' * n)[:n],
+    'separators': lambda n: ('п.р.и.в.е.т к-а-к д_е_л_а ' * n)[:n],
+    'spaced': lambda n: ('п р и в е т ' * n)[:n],
+    'repeats': lambda n: 'а' * n,
+    'invisible': lambda n: ('п\u200bр\u200dи\ufeffв\u00adе\u2060т ' * n)[:n],
+    'combining': lambda n: ('п\u0301р\u0306и\u0308в ' * n)[:n],
+    'fullwidth': lambda n: ('ｐｒｉｖｅｔ ' * n)[:n],
+}
+
+# Замаскированные варианты слова из OBSCENE_WORDS, которые должны находиться после нормализации
+OBFUSCATED_SAMPLES = (
+    'б.л.я', 'bлядь', 'б л я', 'бляяяя', 'Б\u200bЛ\u200dЯ', '6ля', 'ｂля', 'б-л-я', 'бл\u0306я',
+    'б. л. я', '(б)(л)(я)',
+)
+
+# Обычный текст, в котором склейка соседних слов или цифра вместо буквы дала бы нецензурное слово
+FALSE_POSITIVE_SAMPLES = (
+    'хлеб,ляжки', 'клуб/лягушка', 'в 6 л я', 'клуб...лягушка', 'хлеб, ляжки',
+)
+
+def measure(func, repeat=5, number=20):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, (time.perf_counter() - started) / number)
+    return best
+
+def main():
+    failures = []
+    print(f"{'вход':<14}{'длина':>8}{'normalize_text, мкс':>22}")
+    
+    for name, build in INPUTS.items():
+        timings = []
+        for length in (TYPICAL_LENGTH, MESSAGE_LIMIT // 4, MESSAGE_LIMIT):
+            text = build(length)
+            current = measure(lambda: normalize_text(text))
+            timings.append(current)
+            print(f"{name:<14}{len(text):>8}{current * 1e6:>22.1f}")
+        
+        if timings[0] > BUDGET_TYPICAL:
+            failures.append(f"{name}: {timings[0] * 1e6:.1f} мкс превышает бюджет {BUDGET_TYPICAL * 1e6:.0f} мкс")
+        if timings[-1] > BUDGET_PER_MESSAGE:
+            failures.append(f"{name}: {timings[-1] * 1e6:.1f} мкс превышает бюджет {BUDGET_PER_MESSAGE * 1e6:.0f} мкс")
+        
+        # При четырехкратном росте длины линейный проход не должен замедляться больше чем в ~8 раз
+        if timings[1] > 1e-6 and timings[-1] / timings[1] > 8:
+            failures.append(f"{name}: рост времени x{timings[-1] / timings[1]:.1f} при росте длины x4")
+    
+    for sample in OBFUSCATED_SAMPLES:
+        if OBSCENE_MATCHER.find(normalize_text(sample)) is None:
+            failures.append(f"{sample!r}: слово не найдено после нормализации")
+    
+    for sample in FALSE_POSITIVE_SAMPLES:
+        if OBSCENE_MATCHER.find(normalize_text(sample)) is not None:
+            failures.append(f"{sample!r}: найдено слово, которого в тексте нет")
+    
+    if failures:
+        print('\nРегрессия:')
+        for failure in failures:
+            print(f"- {failure}")
+        sys.exit(1)
+    
+    print(
+        f'\nВсе проверки уложились в бюджет, замаскированных слов найдено: {len(OBFUSCATED_SAMPLES)}, '
+        f'ложных срабатываний нет ({len(FALSE_POSITIVE_SAMPLES)} примеров).'
+    )
+
+if __name__ == '__main__':
+    main()
@@ -1,43 +1,232 @@
 import logging
 import os
 from dotenv import load_dotenv
-from aiogram import Bot, Dispatcher, executor, types
-from aiogram.contrib.middlewares.logging import LoggingMiddleware
-from database import setup_database
+from aiogram import Dispatcher, executor
+from database import setup_database, close_database
+from migrations import upgrade_database
+from cache import TTLCache
+from storage import create_storage
+from admins import AdminCache, AdminIndex
+from violation_log import ViolationLog
+from retention import ViolationRetention
+from outbox import Outbox
+from raid import RaidGuard
+from duplicates import DuplicateDetector
+from flood import FloodLimiter
+from scheduler import ScheduledDispatcher
+from shard import ShardedCache, start_worker
+from webhook import ALLOWED_UPDATES, start_webhook
+from logs import setup_logging
+from metrics import MetricsBot, register_bot_metrics, start_metrics_server
 from handlers import register_handlers
 from filters import setup_filters
+from middlewares import DatabaseMiddleware, MetricsMiddleware, ModerationMiddleware, UpdateLogMiddleware
 
 # Загрузка переменных окружения из .env файла
 load_dotenv()
 
-# Настройка логирования
-logging.basicConfig(
-    level=getattr(logging, os.getenv('LOG_LEVEL', 'INFO')),
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# Настройка логирования: записи уходят в очередь, форматирует и пишет их фоновый поток
+setup_logging(os.getenv('LOG_LEVEL', 'INFO'), os.getenv('LOG_FORMAT', 'text'))
 logger = logging.getLogger(__name__)
 
-# Инициализация бота и диспетчера
-bot = Bot(token=os.getenv('BOT_TOKEN'))
-dp = Dispatcher(bot)
-dp.middleware.setup(LoggingMiddleware())
-
 # Настройка базы данных
-db_session = setup_database(os.getenv('DATABASE_URL', 'sqlite:///bot_database.db'))
+db_session = setup_database(
+    os.getenv('DATABASE_URL', 'sqlite:///bot_database.db'),
+    pool_size=int(os.getenv('DB_POOL_SIZE', '5')),
+    max_overflow=int(os.getenv('DB_MAX_OVERFLOW', '10')),
+    pool_recycle=int(os.getenv('DB_POOL_RECYCLE', '3600')),
+    pool_timeout=int(os.getenv('DB_POOL_TIMEOUT', '30'))
+)
+
+# Хранилище состояний диалога /config: Redis, если задан REDIS_URL, иначе таблица в основной базе
+storage = create_storage(
+    os.getenv('FSM_STORAGE', 'redis' if os.getenv('REDIS_URL') else 'database'),
+    session_factory=db_session.session_factory,
+    ttl=int(os.getenv('FSM_STATE_TTL', '86400')),
+    maxsize=int(os.getenv('FSM_MEMORY_SIZE', '10000')),
+    redis_url=os.getenv('REDIS_URL')
+)
+
+# Инициализация бота и диспетчера (бот учитывает время и ошибки запросов к Telegram для метрик)
+bot = MetricsBot(token=os.getenv('BOT_TOKEN'))
+# Обновления разных чатов обрабатываются параллельно, одного чата - по порядку
+dp = ScheduledDispatcher(
+    bot,
+    storage=storage,
+    concurrency=int(os.getenv('UPDATE_CONCURRENCY', '100')),
+    max_pending=int(os.getenv('UPDATE_MAX_PENDING', '10000'))
+)
+dp.middleware.setup(MetricsMiddleware())
+# Журнал обновлений: выборка LOG_SAMPLE_RATE обновлений и все медленные
+dp.middleware.setup(UpdateLogMiddleware(
+    sample_rate=float(os.getenv('LOG_SAMPLE_RATE', '0.01')),
+    slow_threshold=float(os.getenv('LOG_SLOW_UPDATE', '1'))
+))
+dp.middleware.setup(ModerationMiddleware())
 
 # Сохраняем сессию базы данных в контексте бота
 bot['db_session'] = db_session
+dp.middleware.setup(DatabaseMiddleware(db_session))
+
+# Кэш правил модерации чатов (настройки и запрещенные слова)
+bot['rules_cache'] = TTLCache(
+    maxsize=int(os.getenv('SETTINGS_CACHE_SIZE', '1024')),
+    ttl=int(os.getenv('SETTINGS_CACHE_TTL', '300'))
+)
+
+# Кэш администраторов чатов для проверки прав на команды и их постоянный индекс для /config
+bot['admin_cache'] = AdminCache(
+    bot,
+    AdminIndex(db_session.session_factory),
+    maxsize=int(os.getenv('ADMIN_CACHE_SIZE', '1024')),
+    ttl=int(os.getenv('ADMIN_CACHE_TTL', '600')),
+    refresh_concurrency=int(os.getenv('ADMIN_REFRESH_CONCURRENCY', '10')),
+    refresh_rate=float(os.getenv('ADMIN_REFRESH_RATE', '20'))
+)
+
+# Режим получения обновлений: polling, webhook или worker (обработчик шардированного режима, см. shard.py)
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+
+# Обработчик видит только свои чаты, а сброс кэшей нужен всем: правила группы меняются через /config
+# в личном чате, который может обрабатывать другой процесс
+if BOT_MODE == 'worker':
+    for cache_name in ('rules_cache', 'admin_cache'):
+        bot[cache_name] = ShardedCache(
+            bot[cache_name],
+            cache_name,
+            index=int(os.getenv('SHARD_INDEX', '0')),
+            workers=int(os.getenv('SHARD_WORKERS', '1')),
+            socket_dir=os.getenv('SHARD_SOCKET_DIR', '/tmp/moderator-shards'),
+            secret=os.getenv('SHARD_SECRET', '')
+        )
+
+# Счетчик нарушений пользователя для политики наказаний сбрасывается, если нарушений не было столько секунд (0 - не сбрасывается)
+bot['warnings_decay'] = int(os.getenv('WARNINGS_DECAY', '604800'))
+
+# Очередь записей о нарушениях с пакетной записью в базу
+violation_log = ViolationLog(
+    db_session.session_factory,
+    batch_size=int(os.getenv('VIOLATION_LOG_BATCH_SIZE', '100')),
+    flush_interval=float(os.getenv('VIOLATION_LOG_FLUSH_INTERVAL', '2'))
+)
+bot['violation_log'] = violation_log
+
+# Перенос старых нарушений в архив и сводку по дням (VIOLATION_RETENTION_DAYS=0 - хранить все).
+# В шардированном режиме его выполняет только первый обработчик
+retention = ViolationRetention(
+    db_session.session_factory,
+    retention_days=int(os.getenv('VIOLATION_RETENTION_DAYS', '90')) if os.getenv('SHARD_INDEX', '0') == '0' else 0,
+    archive_dir=os.getenv('VIOLATION_ARCHIVE_DIR', 'archive') or None,
+    batch_size=int(os.getenv('RETENTION_BATCH_SIZE', '500')),
+    interval=float(os.getenv('RETENTION_INTERVAL', '3600')),
+    batch_pause=float(os.getenv('RETENTION_BATCH_PAUSE', '0.5'))
+)
+bot['retention'] = retention
+
+# Очередь исходящих запросов к Telegram с ограничением частоты
+outbox = Outbox(
+    global_rate=int(os.getenv('OUTBOX_GLOBAL_RATE', '30')),
+    group_rate=int(os.getenv('OUTBOX_GROUP_RATE', '20')),
+    max_retries=int(os.getenv('OUTBOX_MAX_RETRIES', '3'))
+)
+bot['outbox'] = outbox
+
+# Защита от рейдов: при всплеске нарушений в чате удаление пачками и одна сводка вместо уведомлений
+raid_guard = RaidGuard(
+    bot,
+    outbox,
+    threshold=int(os.getenv('RAID_THRESHOLD', '10')),
+    window=float(os.getenv('RAID_WINDOW', '10')),
+    cooldown=float(os.getenv('RAID_COOLDOWN', '60')),
+    batch_interval=float(os.getenv('RAID_BATCH_INTERVAL', '2')),
+    notice_interval=float(os.getenv('RAID_NOTICE_INTERVAL', '30'))
+)
+bot['raid_guard'] = raid_guard
+
+# Фильтр повторов: сообщение нарушает правила, если в чате за DUPLICATE_WINDOW секунд набралось
+# DUPLICATE_THRESHOLD похожих сообщений. Память ограничена: DUPLICATE_HISTORY отпечатков
+# на чат и не больше DUPLICATE_MAX_CHATS чатов
+bot['duplicate_detector'] = DuplicateDetector(
+    threshold=int(os.getenv('DUPLICATE_THRESHOLD', '5')),
+    window=float(os.getenv('DUPLICATE_WINDOW', '60')),
+    min_similarity=float(os.getenv('DUPLICATE_SIMILARITY', '0.8')),
+    history=int(os.getenv('DUPLICATE_HISTORY', '50')),
+    min_length=int(os.getenv('DUPLICATE_MIN_LENGTH', '30')),
+    max_chats=int(os.getenv('DUPLICATE_MAX_CHATS', '10000'))
+)
+
+# Антифлуд: счетчики сообщений по паре (чат, пользователь), лимиты задаются в чате командой /setflood.
+# Хранится не больше FLOOD_MAX_ENTRIES пар, неактивные вытесняются
+bot['flood_limiter'] = FloodLimiter(maxsize=int(os.getenv('FLOOD_MAX_ENTRIES', '100000')))
+
+# Очереди и кэши в метриках считываются в момент запроса /metrics
+register_bot_metrics(bot, dp.scheduler)
+
+# HTTP-сервер метрик в формате Prometheus (0 - не запускать)
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
 
 # Регистрация обработчиков и фильтров
 setup_filters(dp)
 register_handlers(dp, bot, db_session)
 
+# Действия при запуске и остановке бота
+async def on_startup(dp: Dispatcher):
+    # Обработчики запускаются приемником после того, как он сам применил миграции
+    if BOT_MODE != 'worker':
+        await upgrade_database(db_session.bind)
+    violation_log.start()
+    retention.start()
+    outbox.start()
+    
+    if METRICS_PORT:
+        dp['metrics_runner'] = await start_metrics_server(os.getenv('METRICS_HOST', '127.0.0.1'), METRICS_PORT)
+
+async def on_shutdown(dp: Dispatcher):
+    # Дожидаемся принятых обновлений, отправляем накопленные запросы и дописываем очередь нарушений,
+    # затем закрываем соединения
+    await dp.scheduler.drain(timeout=float(os.getenv('UPDATE_DRAIN_TIMEOUT', '30')))
+    await raid_guard.stop()
+    await outbox.stop(timeout=float(os.getenv('OUTBOX_DRAIN_TIMEOUT', '10')))
+    await violation_log.stop()
+    await retention.stop()
+    await close_database(db_session)
+    
+    if 'metrics_runner' in dp:
+        await dp['metrics_runner'].cleanup()
+
 # Запуск бота
 if __name__ == '__main__':
     logger.info("Бот запущен")
     try:
-        executor.start_polling(dp, skip_updates=True)
+        if BOT_MODE == 'worker':
+            start_worker(
+                dp,
+                socket_dir=os.getenv('SHARD_SOCKET_DIR', '/tmp/moderator-shards'),
+                index=int(os.getenv('SHARD_INDEX', '0')),
+                secret=os.getenv('SHARD_SECRET', ''),
+                drain_timeout=float(os.getenv('WEBHOOK_DRAIN_TIMEOUT', '30')),
+                on_startup=on_startup,
+                on_shutdown=on_shutdown
+            )
+        elif BOT_MODE == 'webhook':
+            webhook_path = os.getenv('WEBHOOK_PATH', '/webhook')
+            start_webhook(
+                dp,
+                webhook_url=os.getenv('WEBHOOK_HOST', '').rstrip('/') + webhook_path,
+                webhook_path=webhook_path,
+                host=os.getenv('WEBAPP_HOST', '0.0.0.0'),
+                port=int(os.getenv('WEBAPP_PORT', '8080')),
+                secret_token=os.getenv('WEBHOOK_SECRET') or None,
+                max_connections=int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40')),
+                drain_timeout=float(os.getenv('WEBHOOK_DRAIN_TIMEOUT', '30')),
+                allowed_updates=ALLOWED_UPDATES,
+                on_startup=on_startup,
+                on_shutdown=on_shutdown
+            )
+        else:
+            executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown,
+                                   allowed_updates=ALLOWED_UPDATES)
     except Exception as e:
-        logger.error(f"Ошибка при запуске бота: {e}")
+        logger.error("Ошибка при запуске бота: %s", e)
     finally:
         logger.info("Бот остановлен")
\ No newline at end of file
@@ -0,0 +1,81 @@
+import time
+from collections import OrderedDict
+
+class TTLCache:
+    """Ограниченный по размеру LRU-кэш с временем жизни записей и счетчиками попаданий"""
+    
+    def __init__(self, maxsize=1024, ttl=300, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        # Загрузки, которые выполняются сейчас: ключ -> метка загрузки
+        self._loading = {}
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def __contains__(self, key):
+        item = self._data.get(key)
+        return item is not None and item[1] > self.timer()
+    
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None or item[1] <= self.timer():
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+        
+        # Отмечаем запись как недавно использованную
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[0]
+    
+    def set(self, key, value):
+        self._data[key] = (value, self.timer() + self.ttl)
+        self._data.move_to_end(key)
+        
+        # Вытесняем самые старые записи при переполнении
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+    
+    def begin_load(self, key):
+        """Отмечает начало загрузки значения и возвращает ее метку для set_loaded"""
+        token = object()
+        self._loading[key] = token
+        return token
+    
+    def set_loaded(self, key, value, token):
+        """Сохраняет загруженное значение, если ключ не сбросили, пока шла загрузка.
+        
+        Иначе значение могло устареть: оно не кэшируется, и следующий запрос загрузит его заново.
+        """
+        if self._loading.get(key) is not token:
+            return False
+        del self._loading[key]
+        self.set(key, value)
+        return True
+    
+    def cancel_load(self, key, token):
+        if self._loading.get(key) is token:
+            del self._loading[key]
+    
+    def invalidate(self, key):
+        self._data.pop(key, None)
+        self._loading.pop(key, None)
+    
+    def clear(self):
+        self._data.clear()
+        self._loading.clear()
+    
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
@@ -1,7 +1,16 @@
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, ForeignKey, DateTime, Text
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Date, DateTime, Text, Index, case, func, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, async_scoped_session
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import relationship
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+import asyncio
 import datetime
+from matcher import WordMatcher
+from normalize import normalize_text
+from policy import default_ladder, parse_policy
+from metrics import instrument_engine
 
 Base = declarative_base()
 
@@ -14,8 +23,12 @@ class ChatSettings(Base):
     filter_obscene = Column(Boolean, default=True)  # Фильтр мата
     filter_links = Column(Boolean, default=True)    # Фильтр ссылок
     filter_keywords = Column(Boolean, default=True) # Фильтр ключевых слов
+    filter_duplicates = Column(Boolean, default=True)  # Фильтр повторяющихся сообщений
     action_type = Column(String(50), default='delete')  # delete, warn, mute, ban
     mute_duration = Column(Integer, default=3600)  # Длительность мута в секундах (по умолчанию 1 час)
+    escalation_policy = Column(String(1024), nullable=True)  # Политика наказаний, например "warn, warn, mute 1h, ban"
+    flood_limit = Column(Integer, default=10)  # Сообщений пользователя за flood_window секунд (0 - без ограничения)
+    flood_window = Column(Integer, default=10)
     
     def __repr__(self):
         return f"<ChatSettings(chat_id='{self.chat_id}')>"
@@ -23,6 +36,10 @@ class ChatSettings(Base):
 # Модель для хранения запрещенных слов/фраз
 class BannedWord(Base):
     __tablename__ = 'banned_words'
+    __table_args__ = (
+        # Поиск слов чата и проверка на дубликат при добавлении
+        Index('ix_banned_words_chat_word', 'chat_id', 'word', unique=True),
+    )
     
     id = Column(Integer, primary_key=True)
     chat_id = Column(String(255), nullable=False)
@@ -31,6 +48,20 @@ class BannedWord(Base):
     def __repr__(self):
         return f"<BannedWord(word='{self.word}')>"
 
+# Модель для хранения разрешенных доменов (белый список ссылок чата)
+class AllowedDomain(Base):
+    __tablename__ = 'allowed_domains'
+    __table_args__ = (
+        Index('ix_allowed_domains_chat_domain', 'chat_id', 'domain', unique=True),
+    )
+    
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(String(255), nullable=False)
+    domain = Column(String(255), nullable=False)
+    
+    def __repr__(self):
+        return f"<AllowedDomain(domain='{self.domain}')>"
+
 # Модель для хранения нарушений пользователей
 class Violation(Base):
     __tablename__ = 'violations'
@@ -40,28 +71,243 @@ class Violation(Base):
     user_id = Column(String(255), nullable=False)
     username = Column(String(255), nullable=True)
     message_text = Column(Text, nullable=True)
-    violation_type = Column(String(50), nullable=False)  # obscene, link, keyword
+    violation_type = Column(String(50), nullable=False)  # obscene, link, keyword, flood_dup, flood
     timestamp = Column(DateTime, default=datetime.datetime.utcnow)
     action_taken = Column(String(50), nullable=False)  # delete, warn, mute, ban
     
     def __repr__(self):
         return f"<Violation(user_id='{self.user_id}', type='{self.violation_type}')>"
 
+# Последние нарушения чата (/violations) читаются по индексу без сортировки всей таблицы
+Index('ix_violations_chat_timestamp', Violation.chat_id, Violation.timestamp.desc())
+# Постраничный вывод нарушений чата по ключу id
+Index('ix_violations_chat_id', Violation.chat_id, Violation.id)
+
+# Сводка нарушений, перенесенных в архив: число нарушений чата за день по типу
+class ViolationStats(Base):
+    __tablename__ = 'violation_stats'
+    __table_args__ = (
+        Index('ix_violation_stats_chat_day_type', 'chat_id', 'day', 'violation_type', unique=True),
+    )
+    
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(String(255), nullable=False)
+    day = Column(Date, nullable=False)
+    violation_type = Column(String(50), nullable=False)
+    count = Column(Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f"<ViolationStats(chat_id='{self.chat_id}', day='{self.day}', type='{self.violation_type}', count={self.count})>"
+
 # Модель для хранения счетчика предупреждений пользователей
 class UserWarnings(Base):
     __tablename__ = 'user_warnings'
+    __table_args__ = (
+        # Один счетчик на пользователя в чате
+        Index('ix_user_warnings_chat_user', 'chat_id', 'user_id', unique=True),
+    )
     
     id = Column(Integer, primary_key=True)
     chat_id = Column(String(255), nullable=False)
     user_id = Column(String(255), nullable=False)
     warnings_count = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow)  # Время последнего нарушения, от него считается сброс счетчика
     
     def __repr__(self):
         return f"<UserWarnings(user_id='{self.user_id}', count={self.warnings_count})>"
 
+# Индекс администраторов: в каких чатах пользователь может настраивать бота через /config
+class ChatAdmin(Base):
+    __tablename__ = 'chat_admins'
+    __table_args__ = (
+        Index('ix_chat_admins_user_chat', 'user_id', 'chat_id', unique=True),
+        Index('ix_chat_admins_chat', 'chat_id'),
+    )
+    
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(String(255), nullable=False)
+    user_id = Column(String(255), nullable=False)
+    chat_title = Column(String(255), nullable=True)
+    
+    def __repr__(self):
+        return f"<ChatAdmin(user_id='{self.user_id}', chat_id='{self.chat_id}')>"
+
+# Состояния диалогов с пользователями (FSM) для хранилища в базе
+class FSMState(Base):
+    __tablename__ = 'fsm_states'
+    __table_args__ = (
+        Index('ix_fsm_states_chat_user', 'chat', 'user', unique=True),
+    )
+    
+    id = Column(Integer, primary_key=True)
+    chat = Column(String(255), nullable=False)
+    user = Column(String(255), nullable=False)
+    state = Column(String(255), nullable=True)
+    data = Column(Text, nullable=True)  # JSON
+    bucket = Column(Text, nullable=True)  # JSON
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, index=True)
+    
+    def __repr__(self):
+        return f"<FSMState(chat='{self.chat}', user='{self.user}', state='{self.state}')>"
+
+# Снимок правил модерации чата: настройки и запрещенные слова
+class ChatRules:
+    __slots__ = ('chat_id', 'filter_obscene', 'filter_links', 'filter_keywords', 'filter_duplicates',
+                 'action_type', 'mute_duration', 'escalation_policy', 'flood_limit', 'flood_window',
+                 'banned_words', 'allowed_domains', '_banned_matcher', '_ladder')
+    
+    def __init__(self, chat_settings, banned_words=(), allowed_domains=()):
+        self.chat_id = chat_settings.chat_id
+        self.filter_obscene = chat_settings.filter_obscene
+        self.filter_links = chat_settings.filter_links
+        self.filter_keywords = chat_settings.filter_keywords
+        self.filter_duplicates = chat_settings.filter_duplicates
+        self.action_type = chat_settings.action_type
+        self.mute_duration = chat_settings.mute_duration
+        self.escalation_policy = chat_settings.escalation_policy
+        self.flood_limit = chat_settings.flood_limit
+        self.flood_window = chat_settings.flood_window
+        self.banned_words = tuple(word.lower() for word in banned_words)
+        self.allowed_domains = frozenset(domain.lower() for domain in allowed_domains)
+        self._banned_matcher = None
+        self._ladder = None
+    
+    # Автомат по запрещенным словам строится лениво при первой проверке и живет вместе с записью кэша.
+    # Слова нормализуются так же, как текст сообщений
+    @property
+    def banned_matcher(self):
+        if self._banned_matcher is None:
+            self._banned_matcher = WordMatcher(normalize_text(word) for word in self.banned_words)
+        return self._banned_matcher
+    
+    # Политика наказаний компилируется один раз и тоже живет вместе с записью кэша
+    @property
+    def ladder(self):
+        if self._ladder is None:
+            self._ladder = get_ladder(self)
+        return self._ladder
+    
+    def __repr__(self):
+        return f"<ChatRules(chat_id='{self.chat_id}', words={len(self.banned_words)})>"
+
+# Лестница наказаний чата: своя политика или политика по умолчанию из action_type
+def get_ladder(chat_settings):
+    if chat_settings.escalation_policy:
+        try:
+            return parse_policy(chat_settings.escalation_policy, chat_settings.mute_duration)
+        except ValueError:
+            # Политика проверяется при сохранении, сюда попадает только испорченная вручную запись
+            pass
+    return default_ladder(chat_settings.action_type, chat_settings.mute_duration)
+
+# Атомарное увеличение счетчика нарушений пользователя одним запросом (insert ... on conflict do update ... returning).
+# Счетчик не растет выше limit (длины лестницы) и начинается заново, если нарушений не было decay секунд
+async def increment_warnings(db_session, chat_id, user_id, limit, decay=None):
+    now = datetime.datetime.utcnow()
+    table = UserWarnings.__table__
+    dialect = postgresql if db_session.bind.dialect.name == 'postgresql' else sqlite
+    
+    count = func.coalesce(table.c.warnings_count, 0)
+    new_count = case((count >= limit, limit), else_=count + 1)
+    if decay:
+        new_count = case((table.c.updated_at < now - datetime.timedelta(seconds=decay), 1), else_=new_count)
+    
+    statement = dialect.insert(table).values(
+        chat_id=str(chat_id),
+        user_id=str(user_id),
+        warnings_count=1,
+        updated_at=now
+    ).on_conflict_do_update(
+        index_elements=[table.c.chat_id, table.c.user_id],
+        set_={'warnings_count': new_count, 'updated_at': now}
+    ).returning(table.c.warnings_count)
+    
+    return await db_session.scalar(statement)
+
+# Загрузка настроек чата вместе с запрещенными словами одним запросом (и белым списком доменов, если он нужен)
+async def load_chat_rules(db_session, chat_id):
+    rows = (await db_session.execute(select(ChatSettings, BannedWord.word).outerjoin(
+        BannedWord, BannedWord.chat_id == ChatSettings.chat_id
+    ).where(
+        ChatSettings.chat_id == str(chat_id)
+    ))).all()
+    
+    if not rows:
+        return None
+    
+    chat_settings = rows[0][0]
+    
+    # Белый список доменов нужен только при включенном фильтре ссылок
+    allowed_domains = []
+    if chat_settings.filter_links:
+        allowed_domains = (await db_session.scalars(select(AllowedDomain.domain).where(
+            AllowedDomain.chat_id == str(chat_id)
+        ))).all()
+    
+    return ChatRules(chat_settings, [word for _, word in rows if word is not None], allowed_domains)
+
+# Маркер отсутствия записи в кэше (None кэшируется как "чат без настроек")
+_MISSING = object()
+
+# Получение правил чата через кэш, запрос к базе выполняется только при промахе
+async def get_chat_rules(db_session, rules_cache, chat_id):
+    chat_id = str(chat_id)
+    rules = rules_cache.get(chat_id, _MISSING)
+    
+    if rules is _MISSING:
+        # Если правила изменили и сбросили кэш во время загрузки, снимок не сохраняется
+        token = rules_cache.begin_load(chat_id)
+        try:
+            rules = await load_chat_rules(db_session, chat_id)
+        except BaseException:
+            rules_cache.cancel_load(chat_id, token)
+            raise
+        rules_cache.set_loaded(chat_id, rules, token)
+    
+    return rules
+
+# Асинхронные драйверы для синхронных URL из старых конфигураций
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'sqlite+pysqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+    'postgresql+psycopg2': 'postgresql+asyncpg',
+    'postgresql+psycopg': 'postgresql+asyncpg',
+}
+
+# Приведение URL базы данных к асинхронному драйверу (sqlite:///bot.db -> sqlite+aiosqlite:///bot.db)
+def get_async_database_url(database_url):
+    url = make_url(database_url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername))
+
 # Функция для настройки базы данных
-def setup_database(database_url):
-    engine = create_engine(database_url)
-    Base.metadata.create_all(engine)
-    Session = sessionmaker(bind=engine)
-    return Session()
\ No newline at end of file
+def setup_database(database_url, pool_size=5, max_overflow=10, pool_recycle=3600, pool_timeout=30):
+    url = get_async_database_url(database_url)
+    engine_options = {}
+    
+    # База в памяти живет в единственном соединении, пул для нее не настраивается
+    if url.database and url.database != ':memory:':
+        engine_options.update(
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_recycle=pool_recycle,
+            pool_timeout=pool_timeout,
+            pool_pre_ping=True,
+        )
+        
+        # aiosqlite по умолчанию открывает файл заново для каждой сессии, вместо этого держим пул соединений
+        if url.get_backend_name() == 'sqlite':
+            engine_options['poolclass'] = AsyncAdaptedQueuePool
+    
+    engine = create_async_engine(url, **engine_options)
+    instrument_engine(engine.sync_engine)
+    Session = async_sessionmaker(bind=engine, expire_on_commit=False)
+    
+    # Сессия создается лениво при первом обращении в рамках обработки обновления
+    # и живет до конца его обработки (см. DatabaseMiddleware)
+    return async_scoped_session(Session, scopefunc=asyncio.current_task)
+
+# Закрытие соединений с базой данных при остановке бота
+async def close_database(db_session):
+    await db_session.remove()
+    await db_session.bind.dispose()
\ No newline at end of file
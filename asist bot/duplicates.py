@@ -0,0 +1,85 @@
+"""Поиск одинаковых и почти одинаковых сообщений в чате (рейды и флуд копиями).
+
+Отпечаток сообщения - FINGERPRINT_SIZE наименьших хешей четырехсимвольных фрагментов
+его нормализованного текста (bottom-k MinHash). Сходство двух отпечатков - доля хешей,
+общих для обоих, среди FINGERPRINT_SIZE наименьших хешей их объединения: она
+приближает долю общих фрагментов текстов, поэтому копия с другим именем, ссылкой
+или эмодзи в конце остается похожей на исходное сообщение. Хеш фрагмента - CRC32,
+он не зависит от PYTHONHASHSEED, и одни и те же сообщения похожи при любом запуске.
+
+Отпечатки последних history сообщений чата хранятся в кольцевом буфере фиксированной
+длины, а сами чаты - в LRU-кэше на max_chats записей со временем жизни window:
+память ограничена независимо от числа чатов и сообщений.
+"""
+import time
+import zlib
+from collections import deque
+from cache import TTLCache
+
+# Длина фрагмента текста и число хешей в отпечатке
+SHINGLE_SIZE = 4
+FINGERPRINT_SIZE = 32
+
+# Отпечаток строится по началу сообщения: копии рейда отличаются не дальше первых строк
+FINGERPRINT_TEXT_LIMIT = 512
+
+def fingerprint(text):
+    """Отпечаток текста: множество наименьших хешей его фрагментов"""
+    # В UTF-32 каждый символ занимает 4 байта: фрагмент - срез байтов без кодирования каждой строки
+    data = text[:FINGERPRINT_TEXT_LIMIT].encode('utf-32-le')
+    width = SHINGLE_SIZE * 4
+    hashes = {zlib.crc32(data[i:i + width]) for i in range(0, max(len(data) - width, 0) + 1, 4)}
+    # Для сотни хешей sorted в C быстрее heapq.nsmallest
+    return frozenset(sorted(hashes)[:FINGERPRINT_SIZE])
+
+def similarity(first, second):
+    """Оценка доли общих фрагментов двух текстов по их отпечаткам (от 0 до 1)"""
+    shared = first & second
+    if not shared:
+        return 0.0
+    # Наименьшие хеши объединения - случайная выборка его фрагментов; считаем, сколько из них есть в обоих текстах
+    smallest = sorted(first | second)[:FINGERPRINT_SIZE]
+    return len(shared.intersection(smallest)) / len(smallest)
+
+class DuplicateDetector:
+    """Детектор повторов: сообщение нарушает правила, если вместе с ним в чате за window секунд
+    набралось threshold похожих сообщений (со сходством отпечатков не ниже min_similarity)"""
+    
+    def __init__(self, threshold=5, window=60, min_similarity=0.8, history=50, min_length=30, max_chats=10000,
+                 timer=time.monotonic):
+        self.threshold = threshold
+        self.window = window
+        self.min_similarity = min_similarity
+        self.history = history
+        self.min_length = min_length
+        self.timer = timer
+        # Чат без сообщений дольше window секунд забывается: в его буфере не осталось свежих отпечатков
+        self._chats = TTLCache(maxsize=max_chats, ttl=window, timer=timer)
+    
+    def __len__(self):
+        return len(self._chats)
+    
+    def check(self, chat_id, text):
+        """Учитывает нормализованный текст сообщения и возвращает True, если это повтор"""
+        # Короткие ответы ("спасибо", "+1") совпадают у разных людей и повтором не считаются
+        if len(text) < self.min_length:
+            return False
+        
+        now = self.timer()
+        recent = self._chats.get(chat_id)
+        if recent is None:
+            recent = deque(maxlen=self.history)
+        self._chats.set(chat_id, recent)
+        
+        current = fingerprint(text)
+        cutoff = now - self.window
+        similar = 1
+        # Буфер просматривается от новых сообщений к старым до границы окна
+        for seen_at, seen in reversed(recent):
+            if seen_at < cutoff or similar >= self.threshold:
+                break
+            if similarity(current, seen) >= self.min_similarity:
+                similar += 1
+        
+        recent.append((now, current))
+        return similar >= self.threshold
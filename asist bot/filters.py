@@ -1,8 +1,10 @@
-import re
 import logging
+import time
 from aiogram import types
 from aiogram.dispatcher.filters import BoundFilter
-from database import ChatSettings, BannedWord
+from matcher import WordMatcher
+from metrics import DETECTOR_SECONDS
+from normalize import normalize_text
 
 logger = logging.getLogger(__name__)
 
@@ -13,104 +15,174 @@ OBSCENE_WORDS = [
     'бля', 'нецензурное_слово2', 'оскорбление1', 'оскорбление2'
 ]
 
-# Регулярное выражение для поиска URL
-URL_PATTERN = r'(https?:\/\/)?([\da-z\.-]+)\.([a-z\.]{2,6})([\/\w\.-]*)*\/?'
+# Автомат для поиска нецензурных слов, компилируется один раз при загрузке модуля.
+# Слова нормализуются так же, как текст сообщений
+OBSCENE_MATCHER = WordMatcher(normalize_text(word) for word in OBSCENE_WORDS)
 
-class ObsceneFilter(BoundFilter):
-    """Фильтр для проверки сообщений на наличие нецензурной лексики"""
-    key = 'is_obscene'
+# Домены верхнего уровня, по которым текст без схемы считается ссылкой
+LINK_TLDS = frozenset((
+    'com', 'net', 'org', 'info', 'biz', 'pro', 'xyz', 'top', 'site', 'online', 'shop', 'store',
+    'club', 'live', 'link', 'click', 'app', 'dev', 'page', 'fun', 'icu', 'vip', 'win', 'bet',
+    'io', 'me', 'co', 'tv', 'cc', 'ws', 'gg', 'ly', 'to', 'ai', 'su', 'ru', 'рф', 'ua', 'by',
+    'kz', 'uz', 'am', 'ge', 'az', 'de', 'uk', 'us', 'fr', 'it', 'es', 'nl', 'pl', 'eu', 'cn',
+    'jp', 'kr', 'in', 'tk', 'ml', 'ga', 'cf', 'gq',
+))
+
+# Схемы, после которых любой хост с точкой считается ссылкой
+LINK_SCHEMES = ('http://', 'https://')
+
+# Типы сущностей Telegram, которыми размечаются ссылки
+LINK_ENTITY_TYPES = ('url', 'text_link')
+
+# Максимальная длина проверяемого токена: длиннее не бывает ни домена, ни разумной ссылки
+MAX_LINK_TOKEN_LENGTH = 2048
+
+# Символы, допустимые в метке домена (латиница, кириллица для IDN, цифры и дефис)
+_DOMAIN_LABEL_CHARS = frozenset('abcdefghijklmnopqrstuvwxyz0123456789-абвгдеёжзийклмнопрстуфхцчшщъыьэюя')
+
+# Знаки препинания, которые отделяют ссылку от окружающего текста
+_LINK_SEPARATORS = str.maketrans({char: ' ' for char in ',;!?()[]{}<>"\'«»|*`'})
+
+def extract_host(token):
+    """Выделяет хост из ссылки или домена, например 'https://www.Example.com/path' -> 'example.com'"""
+    token = token.lower()
+    has_scheme = token.startswith(LINK_SCHEMES)
+    if has_scheme:
+        token = token.split('://', 1)[1]
     
-    def __init__(self, is_obscene):
-        self.is_obscene = is_obscene
+    # Отбрасываем путь, параметры, порт и учетные данные
+    for separator in '/?#':
+        token = token.split(separator, 1)[0]
+    token = token.rsplit('@', 1)[-1].split(':', 1)[0].strip('.')
     
-    async def check(self, message: types.Message):
-        if not message.text:
-            return False
-        
-        # Получаем db_session из контекста бота
-        db_session = message.bot.get('db_session')
-        
-        # Проверяем, включен ли фильтр для этого чата
-        chat_settings = db_session.query(ChatSettings).filter(
-            ChatSettings.chat_id == str(message.chat.id)
-        ).first()
-        
-        if not chat_settings or not chat_settings.filter_obscene:
+    if token.startswith('www.'):
+        token = token[4:]
+    return token, has_scheme
+
+def is_domain(host, has_scheme=False):
+    """Проверяет, что хост похож на доменное имя с известной доменной зоной"""
+    labels = host.split('.')
+    if len(labels) < 2 or len(host) > 253:
+        return False
+    
+    for label in labels:
+        if not label or len(label) > 63 or not _DOMAIN_LABEL_CHARS.issuperset(label):
             return False
-        
-        # Проверяем наличие нецензурных слов
-        text = message.text.lower()
-        for word in OBSCENE_WORDS:
-            if word.lower() in text:
-                logger.info(f"Обнаружено нецензурное слово в сообщении от {message.from_user.id}")
-                return True
-        
+    
+    # Со схемой ссылкой считается любой хост, без схемы - только с известной зоной
+    return has_scheme or labels[-1] in LINK_TLDS
+
+def is_allowed_domain(host, allowed_domains):
+    """Проверяет, входит ли хост или один из его родительских доменов в белый список чата"""
+    if not allowed_domains:
         return False
+    
+    labels = host.split('.')
+    for i in range(len(labels) - 1):
+        if '.'.join(labels[i:]) in allowed_domains:
+            return True
+    
+    return False
 
-class LinkFilter(BoundFilter):
-    """Фильтр для проверки сообщений на наличие ссылок"""
-    key = 'has_link'
+def iter_entity_links(message: types.Message):
+    """Ссылки, размеченные самим Telegram"""
+    for entity in message.entities or ():
+        if entity.type == 'url':
+            yield entity.get_text(message.text)
+        elif entity.type == 'text_link':
+            yield entity.url
+
+def iter_text_links(text):
+    """Резервный поиск ссылок в тексте: один линейный проход по токенам, без регулярных выражений"""
+    for token in text.translate(_LINK_SEPARATORS).split():
+        if '.' not in token:
+            continue
+        
+        host, has_scheme = extract_host(token[:MAX_LINK_TOKEN_LENGTH])
+        if is_domain(host, has_scheme):
+            yield host
+
+def find_link(message: types.Message, allowed_domains=frozenset()):
+    """Возвращает первый найденный в сообщении хост не из белого списка или None"""
+    # Сначала используем разметку Telegram: она уже посчитана на стороне сервера
+    has_entities = False
+    for link in iter_entity_links(message):
+        has_entities = True
+        host, _ = extract_host(link)
+        if not is_allowed_domain(host, allowed_domains):
+            return host
     
-    def __init__(self, has_link):
-        self.has_link = has_link
+    # Резервный сканер нужен только если Telegram ничего не разметил, а в тексте есть точка
+    if has_entities or '.' not in message.text:
+        return None
     
-    async def check(self, message: types.Message):
-        if not message.text:
-            return False
-        
-        # Получаем db_session из контекста бота
-        db_session = message.bot.get('db_session')
-        
-        # Проверяем, включен ли фильтр для этого чата
-        chat_settings = db_session.query(ChatSettings).filter(
-            ChatSettings.chat_id == str(message.chat.id)
-        ).first()
-        
-        if not chat_settings or not chat_settings.filter_links:
-            return False
-        
-        # Проверяем наличие ссылок
-        if re.search(URL_PATTERN, message.text):
-            logger.info(f"Обнаружена ссылка в сообщении от {message.from_user.id}")
-            return True
-        
-        return False
+    for host in iter_text_links(message.text):
+        if not is_allowed_domain(host, allowed_domains):
+            return host
+    
+    return None
 
-class BannedWordFilter(BoundFilter):
-    """Фильтр для проверки сообщений на наличие запрещенных слов"""
-    key = 'has_banned_word'
+class ObsceneFilter:
+    """Детектор нецензурной лексики"""
+    violation_type = 'obscene'
+    setting = 'filter_obscene'
     
-    def __init__(self, has_banned_word):
-        self.has_banned_word = has_banned_word
+    def check(self, message: types.Message, text, rules):
+        return OBSCENE_MATCHER.find(text) is not None
+
+class LinkFilter:
+    """Детектор ссылок"""
+    violation_type = 'link'
+    setting = 'filter_links'
     
-    async def check(self, message: types.Message):
-        if not message.text:
-            return False
-        
-        # Получаем db_session из контекста бота
-        db_session = message.bot.get('db_session')
-        
-        # Проверяем, включен ли фильтр для этого чата
-        chat_settings = db_session.query(ChatSettings).filter(
-            ChatSettings.chat_id == str(message.chat.id)
-        ).first()
-        
-        if not chat_settings or not chat_settings.filter_keywords:
+    def check(self, message: types.Message, text, rules):
+        return find_link(message, rules.allowed_domains) is not None
+
+class BannedWordFilter:
+    """Детектор запрещенных слов чата"""
+    violation_type = 'keyword'
+    setting = 'filter_keywords'
+    
+    def check(self, message: types.Message, text, rules):
+        if not rules.banned_words:
             return False
         
-        # Получаем список запрещенных слов для этого чата
-        banned_words = db_session.query(BannedWord).filter(
-            BannedWord.chat_id == str(message.chat.id)
-        ).all()
-        
-        # Проверяем наличие запрещенных слов
-        text = message.text.lower()
-        for banned_word in banned_words:
-            if banned_word.word.lower() in text:
-                logger.info(f"Обнаружено запрещенное слово в сообщении от {message.from_user.id}")
-                return True
-        
-        return False
+        return rules.banned_matcher.find(text) is not None
+
+class DuplicateFilter:
+    """Детектор повторов: одинаковые или почти одинаковые сообщения в чате за короткое время"""
+    violation_type = 'flood_dup'
+    setting = 'filter_duplicates'
+    
+    def check(self, message: types.Message, text, rules):
+        duplicate_detector = message.bot.get('duplicate_detector')
+        return duplicate_detector is not None and duplicate_detector.check(message.chat.id, text)
+
+# Детекторы в порядке проверки: первый сработавший определяет тип нарушения.
+# Детектор повторов последний: он запоминает только сообщения, прошедшие остальные проверки
+DETECTORS = (ObsceneFilter(), LinkFilter(), BannedWordFilter(), DuplicateFilter())
+
+def detect_violation(message: types.Message, rules, detectors=DETECTORS):
+    """Прогоняет все включенные в чате детекторы за один проход и возвращает тип первого нарушения"""
+    if not message.text:
+        return None
+    
+    # Текст нормализуется один раз для всех детекторов слов; ссылки ищутся в исходном тексте
+    started = time.perf_counter()
+    text = normalize_text(message.text)
+    DETECTOR_SECONDS.labels('normalize').observe(time.perf_counter() - started)
+    
+    for detector in detectors:
+        if not getattr(rules, detector.setting):
+            continue
+        
+        started = time.perf_counter()
+        found = detector.check(message, text, rules)
+        DETECTOR_SECONDS.labels(type(detector).__name__).observe(time.perf_counter() - started)
+        if found:
+            return detector.violation_type
+    
+    return None
 
 class IsAdmin(BoundFilter):
     """Фильтр для проверки, является ли пользователь администратором чата"""
@@ -123,15 +195,9 @@ class IsAdmin(BoundFilter):
         if message.chat.type == 'private':
             return False
         
-        # Получаем информацию о пользователе в чате
-        member = await message.chat.get_member(message.from_user.id)
-        
-        # Проверяем, является ли пользователь администратором или создателем
-        return member.is_chat_admin() or member.is_chat_creator()
+        # Список администраторов берем из кэша, а не запрашиваем у Telegram на каждую команду
+        return await message.bot['admin_cache'].is_admin(message.chat.id, message.from_user.id, message.chat.title)
 
 def setup_filters(dp):
     """Регистрация фильтров в диспетчере"""
-    dp.filters_factory.bind(ObsceneFilter)
-    dp.filters_factory.bind(LinkFilter)
-    dp.filters_factory.bind(BannedWordFilter)
     dp.filters_factory.bind(IsAdmin)
\ No newline at end of file
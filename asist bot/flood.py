@@ -0,0 +1,73 @@
+"""Ограничение частоты сообщений пользователя в чате (антифлуд).
+
+Окно в window секунд разбито на BUCKETS корзин одинаковой длины. Для каждой пары
+(чат, пользователь) хранятся только счетчики корзин по кругу и их сумма, поэтому
+проверка сообщения - несколько арифметических операций без списков времен сообщений.
+Сумма охватывает текущую корзину и BUCKETS - 1 предыдущих, то есть от (BUCKETS - 1) / BUCKETS
+окна до целого окна: лимит может сработать чуть позже, но не срабатывает у пользователя,
+который в него укладывается.
+
+Записи упорядочены по последней активности: пользователи, которые молчат дольше
+окна, вытесняются с начала словаря, а общее число записей не превышает maxsize.
+"""
+import time
+from collections import OrderedDict
+
+# Число корзин в окне
+BUCKETS = 5
+
+class _Window:
+    __slots__ = ('window', 'bucket', 'counts', 'total', 'expires')
+    
+    def __init__(self, window, bucket):
+        self.window = window
+        self.bucket = bucket
+        self.counts = [0] * BUCKETS
+        self.total = 0
+        self.expires = 0
+
+class FloodLimiter:
+    """Скользящее окно сообщений по паре (чат, пользователь) с вытеснением неактивных записей"""
+    
+    def __init__(self, maxsize=100000, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.timer = timer
+        self._entries = OrderedDict()
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def hit(self, chat_id, user_id, limit, window):
+        """Учитывает сообщение и возвращает True, если за последние window секунд их больше limit"""
+        now = self.timer()
+        bucket = int(now * BUCKETS // window)
+        key = (chat_id, user_id)
+        
+        entry = self._entries.get(key)
+        # Номер корзины зависит от длины окна: после смены окна (/setflood) счет начинается заново
+        if entry is None or entry.window != window or bucket < entry.bucket:
+            entry = self._entries[key] = _Window(window, bucket)
+        self._entries.move_to_end(key)
+        
+        # Корзины, из которых окно ушло с прошлого сообщения, обнуляются (не больше BUCKETS штук)
+        counts = entry.counts
+        for passed in range(entry.bucket + 1, min(bucket, entry.bucket + BUCKETS) + 1):
+            entry.total -= counts[passed % BUCKETS]
+            counts[passed % BUCKETS] = 0
+        entry.bucket = bucket
+        
+        counts[bucket % BUCKETS] += 1
+        entry.total += 1
+        entry.expires = now + window
+        
+        self._evict(now)
+        return entry.total > limit
+    
+    def _evict(self, now):
+        # В начале словаря - записи, активные давнее всего; обычно вытесняется не больше одной
+        entries = self._entries
+        while entries:
+            key, entry = next(iter(entries.items()))
+            if entry.expires > now and len(entries) <= self.maxsize:
+                break
+            del entries[key]
@@ -1,12 +1,27 @@
 import logging
 import datetime
+import re
+from functools import partial
+from sqlalchemy import select
 from aiogram import types, Bot
-from aiogram.dispatcher import Dispatcher
-from aiogram.utils.exceptions import ChatNotFound, BotBlocked, CantRestrictChatOwner, UserIsAnAdministratorOfTheChat
-from database import ChatSettings, BannedWord, Violation, UserWarnings
+from aiogram.dispatcher import Dispatcher, FSMContext
+from aiogram.utils.exceptions import ChatNotFound, CantRestrictChatOwner, UserIsAnAdministratorOfTheChat
+from database import ChatSettings, ChatRules, BannedWord, AllowedDomain, Violation, get_ladder, increment_warnings
+from filters import extract_host, is_domain
+from admins import is_admin_change
+from outbox import PRIORITY_ACTION
+from pages import violations_cb, violations_page, words_cb, words_page
+from policy import parse_policy
+from states import ConfigStates
 
 logger = logging.getLogger(__name__)
 
+# Сброс закэшированных правил чата после изменения настроек или списка слов
+def invalidate_chat_rules(bot: Bot, chat_id):
+    rules_cache = bot.get('rules_cache')
+    if rules_cache is not None:
+        rules_cache.invalidate(str(chat_id))
+
 # Обработчик команды /start
 async def cmd_start(message: types.Message):
     if message.chat.type == 'private':
@@ -34,10 +49,14 @@ async def cmd_help(message: types.Message):
             "/addword <слово> - Добавить запрещенное слово\n"
             "/delword <слово> - Удалить запрещенное слово\n"
             "/listwords - Показать список запрещенных слов\n"
+            "/allowdomain <домен> - Разрешить ссылки на домен\n"
+            "/deldomain <домен> - Убрать домен из разрешенных\n"
             "/setaction <delete|warn|mute|ban> - Установить действие при нарушении\n"
+            "/setpolicy <политика> - Задать лестницу наказаний, например: warn, warn, mute 1h, mute 1d, ban\n"
+            "/setflood <сообщений> <секунд> - Ограничить частоту сообщений пользователя (/setflood off - отключить)\n"
             "/mute @user <время в минутах> - Замутить пользователя\n"
             "/ban @user - Забанить пользователя\n"
-            "/violations - Показать список нарушений"
+            "/violations [@user|id] [тип] - Показать нарушения, можно выбрать пользователя и тип"
         )
     else:
         help_text = "Отправил справку в личные сообщения."
@@ -53,31 +72,40 @@ async def cmd_settings(message: types.Message):
         return
     
     # Проверяем, является ли пользователь администратором
-    member = await message.chat.get_member(message.from_user.id)
-    if not (member.is_chat_admin() or member.is_chat_creator()):
+    if not await message.bot['admin_cache'].is_admin(message.chat.id, message.from_user.id, message.chat.title):
         await message.reply("Эта команда доступна только администраторам чата.")
         return
     
     db_session = message.bot.get('db_session')
     
     # Получаем или создаем настройки для чата
-    chat_settings = db_session.query(ChatSettings).filter(
+    chat_settings = await db_session.scalar(select(ChatSettings).where(
         ChatSettings.chat_id == str(message.chat.id)
-    ).first()
+    ).limit(1))
     
     if not chat_settings:
         chat_settings = ChatSettings(chat_id=str(message.chat.id))
         db_session.add(chat_settings)
-        db_session.commit()
+        await db_session.commit()
+        invalidate_chat_rules(message.bot, message.chat.id)
+    
+    # Получаем белый список доменов для ссылок
+    allowed_domains = (await db_session.scalars(select(AllowedDomain).where(
+        AllowedDomain.chat_id == str(message.chat.id)
+    ))).all()
     
     # Формируем текст с текущими настройками
     settings_text = (
         f"Настройки для чата {message.chat.title}:\n\n"
         f"Фильтр мата: {'Включен' if chat_settings.filter_obscene else 'Выключен'}\n"
         f"Фильтр ссылок: {'Включен' if chat_settings.filter_links else 'Выключен'}\n"
+        f"Разрешенные домены: {', '.join(domain.domain for domain in allowed_domains) or 'нет'}\n"
         f"Фильтр ключевых слов: {'Включен' if chat_settings.filter_keywords else 'Выключен'}\n"
+        f"Фильтр повторов: {'Включен' if chat_settings.filter_duplicates else 'Выключен'}\n"
         f"Действие при нарушении: {chat_settings.action_type}\n"
-        f"Длительность мута: {chat_settings.mute_duration // 60} минут"
+        f"Длительность мута: {chat_settings.mute_duration // 60} минут\n"
+        f"Политика наказаний: {get_ladder(chat_settings).text}\n"
+        f"Антифлуд: {format_flood_limit(chat_settings)}"
     )
     
     await message.reply(settings_text)
@@ -99,10 +127,10 @@ async def cmd_addword(message: types.Message):
     db_session = message.bot.get('db_session')
     
     # Проверяем, есть ли уже такое слово в базе
-    existing_word = db_session.query(BannedWord).filter(
+    existing_word = await db_session.scalar(select(BannedWord).where(
         BannedWord.chat_id == str(message.chat.id),
         BannedWord.word == word
-    ).first()
+    ).limit(1))
     
     if existing_word:
         await message.reply(f"Слово '{word}' уже в списке запрещенных.")
@@ -111,7 +139,8 @@ async def cmd_addword(message: types.Message):
     # Добавляем слово в базу
     banned_word = BannedWord(chat_id=str(message.chat.id), word=word)
     db_session.add(banned_word)
-    db_session.commit()
+    await db_session.commit()
+    invalidate_chat_rules(message.bot, message.chat.id)
     
     await message.reply(f"Слово '{word}' добавлено в список запрещенных.")
 
@@ -132,18 +161,19 @@ async def cmd_delword(message: types.Message):
     db_session = message.bot.get('db_session')
     
     # Ищем слово в базе
-    banned_word = db_session.query(BannedWord).filter(
+    banned_word = await db_session.scalar(select(BannedWord).where(
         BannedWord.chat_id == str(message.chat.id),
         BannedWord.word == word
-    ).first()
+    ).limit(1))
     
     if not banned_word:
         await message.reply(f"Слово '{word}' не найдено в списке запрещенных.")
         return
     
     # Удаляем слово из базы
-    db_session.delete(banned_word)
-    db_session.commit()
+    await db_session.delete(banned_word)
+    await db_session.commit()
+    invalidate_chat_rules(message.bot, message.chat.id)
     
     await message.reply(f"Слово '{word}' удалено из списка запрещенных.")
 
@@ -156,21 +186,84 @@ async def cmd_listwords(message: types.Message):
     
     db_session = message.bot.get('db_session')
     
-    # Получаем список запрещенных слов для этого чата
-    banned_words = db_session.query(BannedWord).filter(
-        BannedWord.chat_id == str(message.chat.id)
-    ).all()
-    
-    if not banned_words:
+    # Первая страница списка, остальные - кнопками под сообщением
+    text, keyboard, page = await words_page(db_session, message.chat.id)
+    if not page.lines:
         await message.reply("Список запрещенных слов пуст.")
         return
     
-    # Формируем текст со списком запрещенных слов
-    words_text = "Список запрещенных слов:\n\n"
-    for word in banned_words:
-        words_text += f"- {word.word}\n"
+    await message.reply(text, reply_markup=keyboard)
+
+# Обработчик команды /allowdomain
+async def cmd_allowdomain(message: types.Message):
+    # Проверяем, что команда вызвана в группе и пользователь - администратор
+    if message.chat.type == 'private':
+        await message.reply("Эта команда доступна только в группах.")
+        return
+    
+    # Получаем домен из аргументов команды
+    args = message.get_args().split()
+    if not args:
+        await message.reply("Укажите домен, ссылки на который разрешены. Например: /allowdomain example.com")
+        return
     
-    await message.reply(words_text)
+    domain, _ = extract_host(args[0])
+    if not is_domain(domain, has_scheme=True):
+        await message.reply(f"'{args[0]}' не похоже на доменное имя.")
+        return
+    
+    db_session = message.bot.get('db_session')
+    
+    # Проверяем, есть ли уже такой домен в белом списке
+    existing_domain = await db_session.scalar(select(AllowedDomain).where(
+        AllowedDomain.chat_id == str(message.chat.id),
+        AllowedDomain.domain == domain
+    ).limit(1))
+    
+    if existing_domain:
+        await message.reply(f"Домен '{domain}' уже в списке разрешенных.")
+        return
+    
+    # Добавляем домен в базу
+    allowed_domain = AllowedDomain(chat_id=str(message.chat.id), domain=domain)
+    db_session.add(allowed_domain)
+    await db_session.commit()
+    invalidate_chat_rules(message.bot, message.chat.id)
+    
+    await message.reply(f"Ссылки на домен '{domain}' и его поддомены разрешены.")
+
+# Обработчик команды /deldomain
+async def cmd_deldomain(message: types.Message):
+    # Проверяем, что команда вызвана в группе и пользователь - администратор
+    if message.chat.type == 'private':
+        await message.reply("Эта команда доступна только в группах.")
+        return
+    
+    # Получаем домен из аргументов команды
+    args = message.get_args().split()
+    if not args:
+        await message.reply("Укажите домен для удаления из разрешенных.")
+        return
+    
+    domain, _ = extract_host(args[0])
+    db_session = message.bot.get('db_session')
+    
+    # Ищем домен в базе
+    allowed_domain = await db_session.scalar(select(AllowedDomain).where(
+        AllowedDomain.chat_id == str(message.chat.id),
+        AllowedDomain.domain == domain
+    ).limit(1))
+    
+    if not allowed_domain:
+        await message.reply(f"Домен '{domain}' не найден в списке разрешенных.")
+        return
+    
+    # Удаляем домен из базы
+    await db_session.delete(allowed_domain)
+    await db_session.commit()
+    invalidate_chat_rules(message.bot, message.chat.id)
+    
+    await message.reply(f"Домен '{domain}' удален из списка разрешенных.")
 
 # Обработчик команды /setaction
 async def cmd_setaction(message: types.Message):
@@ -196,9 +289,9 @@ async def cmd_setaction(message: types.Message):
     db_session = message.bot.get('db_session')
     
     # Получаем или создаем настройки для чата
-    chat_settings = db_session.query(ChatSettings).filter(
+    chat_settings = await db_session.scalar(select(ChatSettings).where(
         ChatSettings.chat_id == str(message.chat.id)
-    ).first()
+    ).limit(1))
     
     if not chat_settings:
         chat_settings = ChatSettings(chat_id=str(message.chat.id))
@@ -206,9 +299,118 @@ async def cmd_setaction(message: types.Message):
     
     # Обновляем действие при нарушении
     chat_settings.action_type = action
-    db_session.commit()
+    await db_session.commit()
+    invalidate_chat_rules(message.bot, message.chat.id)
+    
+    reply_text = f"Действие при нарушении установлено: {action}"
+    if chat_settings.escalation_policy:
+        reply_text += "\nВ чате задана политика наказаний, она действует вместо этого действия. Сбросить ее: /setpolicy default"
+    await message.reply(reply_text)
+
+# Обработчик команды /setpolicy
+async def cmd_setpolicy(message: types.Message):
+    # Проверяем, что команда вызвана в группе и пользователь - администратор
+    if message.chat.type == 'private':
+        await message.reply("Эта команда доступна только в группах.")
+        return
+    
+    db_session = message.bot.get('db_session')
+    
+    # Получаем или создаем настройки для чата
+    chat_settings = await db_session.scalar(select(ChatSettings).where(
+        ChatSettings.chat_id == str(message.chat.id)
+    ).limit(1))
+    
+    if not chat_settings:
+        chat_settings = ChatSettings(chat_id=str(message.chat.id))
+        db_session.add(chat_settings)
+        await db_session.flush()
+    
+    policy_text = message.get_args().strip()
+    if not policy_text:
+        await message.reply(
+            f"Текущая политика наказаний: {get_ladder(chat_settings).text}\n\n"
+            "Укажите шаги через запятую: delete, warn, mute <время>, ban. "
+            "Время мута - число с единицей m, h, d или w (без единицы - минуты).\n"
+            "Например: /setpolicy warn, warn, mute 1h, mute 1d, ban\n"
+            "Вернуть политику по действию из /setaction: /setpolicy default"
+        )
+        return
+    
+    if policy_text.lower() == 'default':
+        chat_settings.escalation_policy = None
+    else:
+        # Политика проверяется и приводится к единой записи при сохранении
+        try:
+            chat_settings.escalation_policy = parse_policy(policy_text, chat_settings.mute_duration).text
+        except ValueError as e:
+            await message.reply(str(e))
+            return
+    
+    await db_session.commit()
+    invalidate_chat_rules(message.bot, message.chat.id)
+    
+    await message.reply(f"Политика наказаний установлена: {get_ladder(chat_settings).text}")
+
+# Допустимые значения /setflood: сообщений и длина окна в секундах
+FLOOD_LIMIT_RANGE = range(1, 1001)
+FLOOD_WINDOW_RANGE = range(1, 3601)
+
+def format_flood_limit(chat_settings):
+    if not chat_settings.flood_limit:
+        return "выключен"
+    return f"не больше {chat_settings.flood_limit} сообщений за {chat_settings.flood_window} с"
+
+# Обработчик команды /setflood
+async def cmd_setflood(message: types.Message):
+    # Проверяем, что команда вызвана в группе и пользователь - администратор
+    if message.chat.type == 'private':
+        await message.reply("Эта команда доступна только в группах.")
+        return
+    
+    db_session = message.bot.get('db_session')
+    
+    # Получаем или создаем настройки для чата
+    chat_settings = await db_session.scalar(select(ChatSettings).where(
+        ChatSettings.chat_id == str(message.chat.id)
+    ).limit(1))
+    
+    if not chat_settings:
+        chat_settings = ChatSettings(chat_id=str(message.chat.id))
+        db_session.add(chat_settings)
+        await db_session.flush()
+    
+    args = message.get_args().split()
+    if not args:
+        await message.reply(
+            f"Антифлуд: {format_flood_limit(chat_settings)}\n\n"
+            "Укажите, сколько сообщений пользователь может отправить и за сколько секунд.\n"
+            "Например: /setflood 10 10\n"
+            "Отключить ограничение: /setflood off"
+        )
+        return
+    
+    if args[0].lower() == 'off':
+        chat_settings.flood_limit = 0
+    else:
+        try:
+            limit = int(args[0])
+            window = int(args[1]) if len(args) > 1 else chat_settings.flood_window
+        except ValueError:
+            await message.reply("Число сообщений и длительность окна должны быть целыми числами.")
+            return
+        
+        if limit not in FLOOD_LIMIT_RANGE or window not in FLOOD_WINDOW_RANGE:
+            await message.reply("Допустимо от 1 до 1000 сообщений за окно от 1 до 3600 секунд.")
+            return
+        
+        chat_settings.flood_limit = limit
+        chat_settings.flood_window = window
+    
+    await db_session.commit()
+    invalidate_chat_rules(message.bot, message.chat.id)
     
-    await message.reply(f"Действие при нарушении установлено: {action}")
+    await message.reply(f"Антифлуд: {format_flood_limit(chat_settings)}")
 
 # Обработчик команды /mute
 async def cmd_mute(message: types.Message):
@@ -253,7 +455,7 @@ async def cmd_mute(message: types.Message):
     except (CantRestrictChatOwner, UserIsAnAdministratorOfTheChat):
         await message.reply(f"Невозможно замутить пользователя {user_mention}, так как он является администратором.")
     except Exception as e:
-        logger.error(f"Ошибка при муте пользователя: {e}")
+        logger.error("Ошибка при муте пользователя: %s", e)
         await message.reply(f"Произошла ошибка при муте пользователя: {e}")
 
 # Обработчик команды /ban
@@ -293,9 +495,37 @@ async def cmd_ban(message: types.Message):
     except (CantRestrictChatOwner, UserIsAnAdministratorOfTheChat):
         await message.reply(f"Невозможно забанить пользователя {user_mention}, так как он является администратором.")
     except Exception as e:
-        logger.error(f"Ошибка при бане пользователя: {e}")
+        logger.error("Ошибка при бане пользователя: %s", e)
         await message.reply(f"Произошла ошибка при бане пользователя: {e}")
 
+# Тип нарушения в фильтре /violations: obscene, link, keyword и т. д.
+VIOLATION_TYPE_RE = re.compile(r'^[a-z_]{1,32}$')
+
+# Фильтры /violations: пользователь (ответ на его сообщение, id или @username) и тип нарушения
+async def parse_violations_filters(message: types.Message):
+    user_id, violation_type = None, None
+    if message.reply_to_message:
+        user_id = message.reply_to_message.from_user.id
+    
+    for arg in message.get_args().split():
+        if arg.lstrip('-').isdigit():
+            user_id = int(arg)
+        elif arg.startswith('@'):
+            # В нарушениях хранится имя пользователя на момент нарушения: берем id из последнего
+            db_session = message.bot.get('db_session')
+            user_id = await db_session.scalar(select(Violation.user_id).where(
+                Violation.chat_id == str(message.chat.id),
+                Violation.username == arg[1:]
+            ).order_by(Violation.id.desc()).limit(1))
+            if user_id is None:
+                raise ValueError(f"Нарушений пользователя {arg} не найдено.")
+        elif VIOLATION_TYPE_RE.match(arg.lower()):
+            violation_type = arg.lower()
+        else:
+            raise ValueError(f"Не удалось разобрать фильтр '{arg}'. Укажите @username или id пользователя и тип нарушения.")
+    
+    return user_id, violation_type
+
 # Обработчик команды /violations
 async def cmd_violations(message: types.Message):
     # Проверяем, что команда вызвана в группе и пользователь - администратор
@@ -305,199 +535,207 @@ async def cmd_violations(message: types.Message):
     
     db_session = message.bot.get('db_session')
     
-    # Получаем список последних нарушений для этого чата (максимум 10)
-    violations = db_session.query(Violation).filter(
-        Violation.chat_id == str(message.chat.id)
-    ).order_by(Violation.timestamp.desc()).limit(10).all()
+    # Дописываем нарушения из очереди, чтобы в списке были и самые свежие
+    await message.bot['violation_log'].flush()
+    
+    try:
+        user_id, violation_type = await parse_violations_filters(message)
+    except ValueError as e:
+        await message.reply(str(e))
+        return
     
-    if not violations:
+    # Первая страница последних нарушений, более старые - кнопками под сообщением
+    text, keyboard, page = await violations_page(db_session, message.chat.id, user_id, violation_type)
+    if not page.lines:
         await message.reply("Список нарушений пуст.")
         return
     
-    # Формируем текст со списком нарушений
-    violations_text = "Последние нарушения:\n\n"
-    for violation in violations:
-        username = violation.username or f"ID: {violation.user_id}"
-        violations_text += (
-            f"Пользователь: {username}\n"
-            f"Тип нарушения: {violation.violation_type}\n"
-            f"Действие: {violation.action_taken}\n"
-            f"Время: {violation.timestamp}\n"
-            f"Сообщение: {violation.message_text[:50]}...\n\n"
-        )
+    await message.reply(text, reply_markup=keyboard)
+
+# Листание списка кнопками доступно только администраторам чата, к которому относится список
+async def check_page_access(callback: types.CallbackQuery, chat_id):
+    if await callback.bot['admin_cache'].is_admin(chat_id, callback.from_user.id):
+        return True
+    await callback.answer("Листать список могут только администраторы чата.", show_alert=True)
+    return False
+
+# Обработчик кнопок навигации по списку нарушений
+async def handle_violations_page(callback: types.CallbackQuery, callback_data: dict):
+    chat_id = int(callback_data['chat'])
+    if not await check_page_access(callback, chat_id):
+        return
     
-    await message.reply(violations_text)
+    text, keyboard, page = await violations_page(
+        callback.bot.get('db_session'),
+        chat_id,
+        callback_data['user'] or None,
+        callback_data['type'] or None,
+        callback_data['dir'],
+        int(callback_data['cursor'])
+    )
+    await show_page(callback, text, keyboard, page)
+
+# Обработчик кнопок навигации по списку запрещенных слов (в группе и в меню /config)
+async def handle_words_page(callback: types.CallbackQuery, callback_data: dict):
+    chat_id = int(callback_data['chat'])
+    if not await check_page_access(callback, chat_id):
+        return
+    
+    footer = BANNED_WORDS_MENU if callback.message.chat.type == 'private' else ''
+    text, keyboard, page = await words_page(
+        callback.bot.get('db_session'),
+        chat_id,
+        callback_data['dir'],
+        int(callback_data['cursor']),
+        footer
+    )
+    await show_page(callback, text, keyboard, page)
+
+async def show_page(callback: types.CallbackQuery, text, keyboard, page):
+    # Записи страницы могли удалить, пока список был открыт
+    if not page.lines:
+        await callback.answer("Записей больше нет.")
+        return
+    
+    await callback.message.edit_text(text, reply_markup=keyboard)
+    await callback.answer()
 
 # Обработчик для фильтрации сообщений
-async def handle_violation(message: types.Message, violation_type: str):
+async def handle_violation(message: types.Message, violation_type: str, chat_settings=None):
     db_session = message.bot.get('db_session')
     
-    # Получаем настройки чата
-    chat_settings = db_session.query(ChatSettings).filter(
-        ChatSettings.chat_id == str(message.chat.id)
-    ).first()
-    
-    if not chat_settings:
-        chat_settings = ChatSettings(chat_id=str(message.chat.id))
-        db_session.add(chat_settings)
-        db_session.commit()
-    
-    # Получаем или создаем счетчик предупреждений для пользователя
-    user_warnings = db_session.query(UserWarnings).filter(
-        UserWarnings.chat_id == str(message.chat.id),
-        UserWarnings.user_id == str(message.from_user.id)
-    ).first()
-    
-    if not user_warnings:
-        user_warnings = UserWarnings(
-            chat_id=str(message.chat.id),
-            user_id=str(message.from_user.id),
-            warnings_count=0
+    # Получаем настройки чата, если они не были переданы этапом модерации
+    if chat_settings is None:
+        chat_settings = await db_session.scalar(select(ChatSettings).where(
+            ChatSettings.chat_id == str(message.chat.id)
+        ).limit(1))
+        
+        if not chat_settings:
+            chat_settings = ChatSettings(chat_id=str(message.chat.id))
+            db_session.add(chat_settings)
+            await db_session.commit()
+            invalidate_chat_rules(message.bot, message.chat.id)
+        
+        chat_settings = ChatRules(chat_settings)
+    
+    # Наказание определяется лестницей политики чата по номеру нарушения пользователя.
+    # Счетчик нужен только многоступенчатой политике: он увеличивается одним атомарным запросом
+    ladder = chat_settings.ladder
+    count = 1
+    if len(ladder) > 1:
+        count = await increment_warnings(
+            db_session,
+            message.chat.id,
+            message.from_user.id,
+            limit=len(ladder),
+            decay=message.bot.get('warnings_decay')
         )
-        db_session.add(user_warnings)
+        # Номер нарушения определяет наказание, поэтому фиксируется сразу
+        await db_session.commit()
+    
+    step = ladder.step(count)
     
-    # Создаем запись о нарушении
-    violation = Violation(
-        chat_id=str(message.chat.id),
-        user_id=str(message.from_user.id),
+    # Ставим запись о нарушении в очередь, в базу она попадет пачкой в фоне
+    message.bot['violation_log'].add(
+        chat_id=message.chat.id,
+        user_id=message.from_user.id,
         username=message.from_user.username,
         message_text=message.text,
         violation_type=violation_type,
-        action_taken=chat_settings.action_type
+        action_taken=step.action
     )
-    db_session.add(violation)
     
-    # Выполняем действие в зависимости от настроек
-    action = chat_settings.action_type
+    # Запросы к Telegram идут через общую очередь с учетом лимитов: удаление и ограничения раньше уведомлений
+    outbox = message.bot['outbox']
+    user_label = message.from_user.username or message.from_user.id
+    reason = f"за {count}-е нарушение правил" if count > 1 else "за нарушение правил"
     
-    # Удаляем сообщение в любом случае
-    try:
-        await message.delete()
-    except Exception as e:
-        logger.error(f"Ошибка при удалении сообщения: {e}")
+    # Во время рейда сообщения удаляются пачками, а уведомления о каждом нарушении заменяются общей сводкой
+    raid_guard = message.bot['raid_guard']
+    raid = raid_guard.track(message.chat.id)
     
-    if action == 'warn':
-        # Увеличиваем счетчик предупреждений
-        user_warnings.warnings_count += 1
-        db_session.commit()
-        
-        # Отправляем предупреждение пользователю в личные сообщения
-        try:
-            await message.bot.send_message(
+    # Удаляем сообщение в любом случае: если чат не принял его в пачку, удаляем сразу
+    if not (raid and raid_guard.add(message)):
+        outbox.post(message.delete, priority=PRIORITY_ACTION)
+    
+    if step.action == 'warn':
+        if not raid:
+            # Сообщаем номер предупреждения и нарушение, за которым последует наказание
+            next_punishment = ladder.next_punishment(count)
+            warning_text = f"Предупреждение {count}/{next_punishment}." if next_punishment else f"Предупреждение {count}."
+            
+            # Отправляем предупреждение пользователю в личные сообщения
+            outbox.post(lambda: message.bot.send_message(
                 message.from_user.id,
                 f"Ваше сообщение в чате {message.chat.title} было удалено за нарушение правил. "
                 f"Тип нарушения: {violation_type}. "
-                f"Предупреждение {user_warnings.warnings_count}/3."
-            )
-        except (BotBlocked, ChatNotFound):
-            logger.warning(f"Не удалось отправить предупреждение пользователю {message.from_user.id}")
-        
-        # Отправляем предупреждение в чат с упоминанием пользователя
-        user_mention = f"@{message.from_user.username}" if message.from_user.username else f"[Пользователь](tg://user?id={message.from_user.id})"
-        await message.bot.send_message(
-            message.chat.id,
-            f"{user_mention}, ваше сообщение было удалено за нарушение правил. "
-            f"Тип нарушения: {violation_type}. "
-            f"Предупреждение {user_warnings.warnings_count}/3.",
-            parse_mode="Markdown"
-        )
-        
-        # Если у пользователя 3 предупреждения, применяем более строгое наказание
-        if user_warnings.warnings_count >= 3:
-            if chat_settings.action_type == 'warn':
-                # Если действие по умолчанию - предупреждение, то мутим пользователя
-                try:
-                    until_date = datetime.datetime.now() + datetime.timedelta(seconds=chat_settings.mute_duration)
-                    await message.chat.restrict(
-                        message.from_user.id,
-                        until_date=until_date,
-                        can_send_messages=False
-                    )
-                    
-                    await message.bot.send_message(
-                        message.chat.id,
-                        f"Пользователь @{message.from_user.username or message.from_user.id} получил мут на "
-                        f"{chat_settings.mute_duration // 60} минут за накопление 3 предупреждений."
-                    )
-                except Exception as e:
-                    logger.error(f"Ошибка при муте пользователя: {e}")
+                f"{warning_text}"
+            ), chat_id=message.from_user.id)
             
-            # Сбрасываем счетчик предупреждений
-            user_warnings.warnings_count = 0
-            db_session.commit()
+            # Отправляем предупреждение в чат с упоминанием пользователя
+            user_mention = f"@{message.from_user.username}" if message.from_user.username else f"[Пользователь](tg://user?id={message.from_user.id})"
+            outbox.post(lambda: message.bot.send_message(
+                message.chat.id,
+                f"{user_mention}, ваше сообщение было удалено за нарушение правил. "
+                f"Тип нарушения: {violation_type}. "
+                f"{warning_text}",
+                parse_mode="Markdown"
+            ), chat_id=message.chat.id)
     
-    elif action == 'mute':
-        # Мутим пользователя
+    elif step.action == 'mute':
+        # Мутим пользователя на длительность шага
         try:
-            until_date = datetime.datetime.now() + datetime.timedelta(seconds=chat_settings.mute_duration)
-            await message.chat.restrict(
+            until_date = datetime.datetime.now() + datetime.timedelta(seconds=step.duration)
+            await outbox.run(lambda: message.chat.restrict(
                 message.from_user.id,
                 until_date=until_date,
                 can_send_messages=False
-            )
+            ), priority=PRIORITY_ACTION)
             
-            await message.bot.send_message(
-                message.chat.id,
-                f"Пользователь @{message.from_user.username or message.from_user.id} получил мут на "
-                f"{chat_settings.mute_duration // 60} минут за нарушение правил."
-            )
+            if raid:
+                raid_guard.add_action(message.chat.id, 'mute')
+            else:
+                outbox.post(lambda: message.bot.send_message(
+                    message.chat.id,
+                    f"Пользователь @{user_label} получил мут на {step.duration // 60} минут {reason}."
+                ), chat_id=message.chat.id)
         except Exception as e:
-            logger.error(f"Ошибка при муте пользователя: {e}")
+            logger.error("Ошибка при муте пользователя %s: %s", message.from_user.id, e)
     
-    elif action == 'ban':
+    elif step.action == 'ban':
         # Баним пользователя
         try:
-            await message.chat.kick(message.from_user.id)
+            await outbox.run(lambda: message.chat.kick(message.from_user.id), priority=PRIORITY_ACTION)
             
-            await message.bot.send_message(
-                message.chat.id,
-                f"Пользователь @{message.from_user.username or message.from_user.id} забанен за нарушение правил."
-            )
+            if raid:
+                raid_guard.add_action(message.chat.id, 'ban')
+            else:
+                outbox.post(lambda: message.bot.send_message(
+                    message.chat.id,
+                    f"Пользователь @{user_label} забанен {reason}."
+                ), chat_id=message.chat.id)
         except Exception as e:
-            logger.error(f"Ошибка при бане пользователя: {e}")
-    
-    db_session.commit()
-
-# Обработчик сообщений с нецензурной лексикой
-async def handle_obscene(message: types.Message):
-    await handle_violation(message, 'obscene')
-
-# Обработчик сообщений со ссылками
-async def handle_link(message: types.Message):
-    await handle_violation(message, 'link')
-
-# Обработчик сообщений с запрещенными словами
-async def handle_banned_word(message: types.Message):
-    await handle_violation(message, 'keyword')
+            logger.error("Ошибка при бане пользователя %s: %s", message.from_user.id, e)
 
 # Обработчик команды /config для настройки бота через личные сообщения
-async def cmd_config(message: types.Message):
+async def cmd_config(message: types.Message, state: FSMContext):
     # Проверяем, что команда вызвана в личных сообщениях
     if message.chat.type != 'private':
         await message.reply("Эта команда доступна только в личных сообщениях с ботом.")
         return
     
-    db_session = message.bot.get('db_session')
-    
-    # Получаем список чатов, где пользователь является администратором
-    user_chats = []
+    admin_cache = message.bot['admin_cache']
     
-    # Получаем все настройки чатов из базы данных
-    all_chats = db_session.query(ChatSettings).all()
+    # Чаты, которые бот знает, но администраторов которых еще нет в индексе, один раз опрашиваем параллельно
+    unindexed_chats = await admin_cache.index.get_unindexed_chats()
+    if unindexed_chats:
+        await admin_cache.refresh_chats(unindexed_chats)
     
-    for chat_settings in all_chats:
-        try:
-            chat_id = int(chat_settings.chat_id)
-            chat = await message.bot.get_chat(chat_id)
-            member = await chat.get_member(message.from_user.id)
-            
-            if member.is_chat_admin() or member.is_chat_creator():
-                user_chats.append({
-                    'id': chat_id,
-                    'title': chat.title
-                })
-        except Exception as e:
-            logger.error(f"Ошибка при получении информации о чате {chat_settings.chat_id}: {e}")
+    # Список чатов, где пользователь является администратором, берем из индекса без запросов к Telegram
+    user_chats = [
+        {'id': chat_id, 'title': title or str(chat_id)}
+        for chat_id, title in await admin_cache.index.get_user_chats(message.from_user.id)
+    ]
     
     if not user_chats:
         await message.reply(
@@ -513,160 +751,156 @@ async def cmd_config(message: types.Message):
     
     chat_list += "\nОтправьте номер чата для настройки."
     
-    # Сохраняем список чатов в контексте пользователя
-    message.bot['user_chats'] = message.bot.get('user_chats', {})
-    message.bot['user_chats'][message.from_user.id] = user_chats
-    
-    # Устанавливаем состояние пользователя
-    message.bot['user_states'] = message.bot.get('user_states', {})
-    message.bot['user_states'][message.from_user.id] = 'select_chat'
+    # Сохраняем список чатов (только id и названия) в состоянии диалога
+    await state.set_data({'user_chats': user_chats})
+    await state.set_state(ConfigStates.select_chat)
     
     await message.reply(chat_list)
 
+# Выбранный в диалоге чат: в состоянии хранятся только его id и название
+async def get_selected_chat(state: FSMContext):
+    return (await state.get_data()).get('selected_chat')
+
 # Обработчик для выбора чата
-async def handle_chat_selection(message: types.Message):
-    user_id = message.from_user.id
-    user_chats = message.bot.get('user_chats', {}).get(user_id, [])
+async def handle_chat_selection(message: types.Message, state: FSMContext):
+    user_chats = (await state.get_data()).get('user_chats', [])
     
     try:
         chat_index = int(message.text) - 1
         if 0 <= chat_index < len(user_chats):
             selected_chat = user_chats[chat_index]
             
-            # Сохраняем выбранный чат
-            message.bot['selected_chat'] = message.bot.get('selected_chat', {})
-            message.bot['selected_chat'][user_id] = selected_chat
+            # Сохраняем выбранный чат, список чатов больше не нужен
+            await state.set_data({'selected_chat': selected_chat})
             
             # Показываем меню настроек
-            await show_settings_menu(message, selected_chat['id'])
+            await show_settings_menu(message, state, selected_chat)
         else:
             await message.reply("Неверный номер чата. Пожалуйста, выберите чат из списка.")
     except ValueError:
         await message.reply("Пожалуйста, введите номер чата из списка.")
 
 # Функция для отображения меню настроек
-async def show_settings_menu(message: types.Message, chat_id):
+async def show_settings_menu(message: types.Message, state: FSMContext, selected_chat):
     db_session = message.bot.get('db_session')
+    chat_id = selected_chat['id']
     
     # Получаем настройки чата
-    chat_settings = db_session.query(ChatSettings).filter(
+    chat_settings = await db_session.scalar(select(ChatSettings).where(
         ChatSettings.chat_id == str(chat_id)
-    ).first()
+    ).limit(1))
     
     if not chat_settings:
         chat_settings = ChatSettings(chat_id=str(chat_id))
         db_session.add(chat_settings)
-        db_session.commit()
+        await db_session.commit()
+        invalidate_chat_rules(message.bot, chat_id)
     
     # Формируем меню настроек
     settings_menu = (
-        f"Настройки для чата {message.bot['selected_chat'][message.from_user.id]['title']}:\n\n"
+        f"Настройки для чата {selected_chat['title']}:\n\n"
         f"1. Фильтр мата: {'Включен' if chat_settings.filter_obscene else 'Выключен'}\n"
         f"2. Фильтр ссылок: {'Включен' if chat_settings.filter_links else 'Выключен'}\n"
         f"3. Фильтр ключевых слов: {'Включен' if chat_settings.filter_keywords else 'Выключен'}\n"
-        f"4. Действие при нарушении: {chat_settings.action_type}\n"
-        f"5. Длительность мута: {chat_settings.mute_duration // 60} минут\n"
-        f"6. Управление запрещенными словами\n\n"
+        f"4. Фильтр повторов: {'Включен' if chat_settings.filter_duplicates else 'Выключен'}\n"
+        f"5. Действие при нарушении: {chat_settings.action_type}\n"
+        f"6. Длительность мута: {chat_settings.mute_duration // 60} минут\n"
+        f"7. Управление запрещенными словами\n\n"
+        f"Политика наказаний: {get_ladder(chat_settings).text} (меняется командой /setpolicy в группе)\n"
+        f"Антифлуд: {format_flood_limit(chat_settings)} (меняется командой /setflood в группе)\n\n"
         f"Отправьте номер настройки, которую хотите изменить, или 'назад' для возврата к выбору чата."
     )
     
     # Устанавливаем состояние пользователя
-    message.bot['user_states'][message.from_user.id] = 'settings_menu'
+    await state.set_state(ConfigStates.settings_menu)
     
     await message.reply(settings_menu)
 
+# Пункты меню настроек: номер -> (состояние, текст запроса)
+SETTINGS_MENU_OPTIONS = {
+    1: (ConfigStates.toggle_obscene, (
+        "Фильтр мата:\n\n"
+        "1. Включить\n"
+        "2. Выключить\n\n"
+        "Выберите опцию."
+    )),
+    2: (ConfigStates.toggle_links, (
+        "Фильтр ссылок:\n\n"
+        "1. Включить\n"
+        "2. Выключить\n\n"
+        "Выберите опцию."
+    )),
+    3: (ConfigStates.toggle_keywords, (
+        "Фильтр ключевых слов:\n\n"
+        "1. Включить\n"
+        "2. Выключить\n\n"
+        "Выберите опцию."
+    )),
+    4: (ConfigStates.toggle_duplicates, (
+        "Фильтр повторов (одинаковые сообщения в чате за короткое время):\n\n"
+        "1. Включить\n"
+        "2. Выключить\n\n"
+        "Выберите опцию."
+    )),
+    5: (ConfigStates.set_action, (
+        "Действие при нарушении:\n\n"
+        "1. Удалить сообщение\n"
+        "2. Предупредить пользователя\n"
+        "3. Замутить пользователя\n"
+        "4. Забанить пользователя\n\n"
+        "Выберите опцию."
+    )),
+    6: (ConfigStates.set_mute_duration, "Введите длительность мута в минутах (от 1 до 10080)."),
+}
+
 # Обработчик для меню настроек
-async def handle_settings_menu(message: types.Message):
-    user_id = message.from_user.id
-    selected_chat = message.bot.get('selected_chat', {}).get(user_id)
+async def handle_settings_menu(message: types.Message, state: FSMContext):
+    selected_chat = await get_selected_chat(state)
     
     if not selected_chat:
         await message.reply("Произошла ошибка. Пожалуйста, начните настройку заново с команды /config")
         return
     
     if message.text.lower() == 'назад':
-        await cmd_config(message)
+        await cmd_config(message, state)
         return
     
     try:
         option = int(message.text)
-        if 1 <= option <= 6:
-            if option == 1:  # Фильтр мата
-                message.bot['user_states'][user_id] = 'toggle_obscene'
-                await message.reply(
-                    "Фильтр мата:\n\n"
-                    "1. Включить\n"
-                    "2. Выключить\n\n"
-                    "Выберите опцию."
-                )
-            elif option == 2:  # Фильтр ссылок
-                message.bot['user_states'][user_id] = 'toggle_links'
-                await message.reply(
-                    "Фильтр ссылок:\n\n"
-                    "1. Включить\n"
-                    "2. Выключить\n\n"
-                    "Выберите опцию."
-                )
-            elif option == 3:  # Фильтр ключевых слов
-                message.bot['user_states'][user_id] = 'toggle_keywords'
-                await message.reply(
-                    "Фильтр ключевых слов:\n\n"
-                    "1. Включить\n"
-                    "2. Выключить\n\n"
-                    "Выберите опцию."
-                )
-            elif option == 4:  # Действие при нарушении
-                message.bot['user_states'][user_id] = 'set_action'
-                await message.reply(
-                    "Действие при нарушении:\n\n"
-                    "1. Удалить сообщение\n"
-                    "2. Предупредить пользователя\n"
-                    "3. Замутить пользователя\n"
-                    "4. Забанить пользователя\n\n"
-                    "Выберите опцию."
-                )
-            elif option == 5:  # Длительность мута
-                message.bot['user_states'][user_id] = 'set_mute_duration'
-                await message.reply(
-                    "Введите длительность мута в минутах (от 1 до 10080)."
-                )
-            elif option == 6:  # Управление запрещенными словами
-                await show_banned_words_menu(message, selected_chat['id'])
+        if option in SETTINGS_MENU_OPTIONS:
+            next_state, prompt = SETTINGS_MENU_OPTIONS[option]
+            await state.set_state(next_state)
+            await message.reply(prompt)
+        elif option == 7:  # Управление запрещенными словами
+            await show_banned_words_menu(message, state, selected_chat['id'])
         else:
             await message.reply("Неверный номер опции. Пожалуйста, выберите опцию из меню.")
     except ValueError:
         await message.reply("Пожалуйста, введите номер опции из меню.")
 
+# Действия меню управления запрещенными словами
+BANNED_WORDS_MENU = (
+    "Выберите действие:\n"
+    "1. Добавить слово\n"
+    "2. Удалить слово\n"
+    "3. Назад к настройкам"
+)
+
 # Функция для отображения меню управления запрещенными словами
-async def show_banned_words_menu(message: types.Message, chat_id):
+async def show_banned_words_menu(message: types.Message, state: FSMContext, chat_id):
     db_session = message.bot.get('db_session')
     
-    # Получаем список запрещенных слов
-    banned_words = db_session.query(BannedWord).filter(
-        BannedWord.chat_id == str(chat_id)
-    ).all()
-    
-    words_list = "Список запрещенных слов:\n\n"
-    if banned_words:
-        for i, word in enumerate(banned_words, 1):
-            words_list += f"{i}. {word.word}\n"
-    else:
-        words_list += "Список пуст\n"
-    
-    words_list += "\nВыберите действие:\n"
-    words_list += "1. Добавить слово\n"
-    words_list += "2. Удалить слово\n"
-    words_list += "3. Назад к настройкам\n"
+    # Первая страница списка слов, остальные - кнопками под сообщением
+    text, keyboard, _ = await words_page(db_session, chat_id, footer=BANNED_WORDS_MENU)
     
     # Устанавливаем состояние пользователя
-    message.bot['user_states'][message.from_user.id] = 'banned_words_menu'
+    await state.set_state(ConfigStates.banned_words_menu)
     
-    await message.reply(words_list)
+    await message.reply(text, reply_markup=keyboard)
 
 # Обработчик для меню управления запрещенными словами
-async def handle_banned_words_menu(message: types.Message):
-    user_id = message.from_user.id
-    selected_chat = message.bot.get('selected_chat', {}).get(user_id)
+async def handle_banned_words_menu(message: types.Message, state: FSMContext):
+    selected_chat = await get_selected_chat(state)
     
     if not selected_chat:
         await message.reply("Произошла ошибка. Пожалуйста, начните настройку заново с команды /config")
@@ -675,40 +909,22 @@ async def handle_banned_words_menu(message: types.Message):
     try:
         option = int(message.text)
         if option == 1:  # Добавить слово
-            message.bot['user_states'][user_id] = 'add_banned_word'
+            await state.set_state(ConfigStates.add_banned_word)
             await message.reply("Введите слово, которое нужно добавить в список запрещенных.")
         elif option == 2:  # Удалить слово
-            db_session = message.bot.get('db_session')
-            banned_words = db_session.query(BannedWord).filter(
-                BannedWord.chat_id == str(selected_chat['id'])
-            ).all()
-            
-            if not banned_words:
-                await message.reply("Список запрещенных слов пуст.")
-                await show_banned_words_menu(message, selected_chat['id'])
-                return
-            
-            words_list = "Выберите номер слова для удаления:\n\n"
-            for i, word in enumerate(banned_words, 1):
-                words_list += f"{i}. {word.word}\n"
-            
-            # Сохраняем список слов в контексте пользователя
-            message.bot['banned_words'] = message.bot.get('banned_words', {})
-            message.bot['banned_words'][user_id] = banned_words
-            
-            message.bot['user_states'][user_id] = 'delete_banned_word'
-            await message.reply(words_list)
+            # Список слов может быть длинным и листается кнопками, поэтому слово вводится текстом, а не номером
+            await state.set_state(ConfigStates.delete_banned_word)
+            await message.reply("Введите слово, которое нужно удалить из списка запрещенных.")
         elif option == 3:  # Назад к настройкам
-            await show_settings_menu(message, selected_chat['id'])
+            await show_settings_menu(message, state, selected_chat)
         else:
             await message.reply("Неверный номер опции. Пожалуйста, выберите опцию из меню.")
     except ValueError:
         await message.reply("Пожалуйста, введите номер опции из меню.")
 
 # Обработчик для добавления запрещенного слова
-async def handle_add_banned_word(message: types.Message):
-    user_id = message.from_user.id
-    selected_chat = message.bot.get('selected_chat', {}).get(user_id)
+async def handle_add_banned_word(message: types.Message, state: FSMContext):
+    selected_chat = await get_selected_chat(state)
     
     if not selected_chat:
         await message.reply("Произошла ошибка. Пожалуйста, начните настройку заново с команды /config")
@@ -718,10 +934,10 @@ async def handle_add_banned_word(message: types.Message):
     db_session = message.bot.get('db_session')
     
     # Проверяем, есть ли уже такое слово в базе
-    existing_word = db_session.query(BannedWord).filter(
+    existing_word = await db_session.scalar(select(BannedWord).where(
         BannedWord.chat_id == str(selected_chat['id']),
         BannedWord.word == word
-    ).first()
+    ).limit(1))
     
     if existing_word:
         await message.reply(f"Слово '{word}' уже в списке запрещенных.")
@@ -729,44 +945,42 @@ async def handle_add_banned_word(message: types.Message):
         # Добавляем слово в базу
         banned_word = BannedWord(chat_id=str(selected_chat['id']), word=word)
         db_session.add(banned_word)
-        db_session.commit()
+        await db_session.commit()
+        invalidate_chat_rules(message.bot, selected_chat['id'])
         await message.reply(f"Слово '{word}' добавлено в список запрещенных.")
     
     # Возвращаемся к меню управления запрещенными словами
-    await show_banned_words_menu(message, selected_chat['id'])
+    await show_banned_words_menu(message, state, selected_chat['id'])
 
 # Обработчик для удаления запрещенного слова
-async def handle_delete_banned_word(message: types.Message):
-    user_id = message.from_user.id
-    selected_chat = message.bot.get('selected_chat', {}).get(user_id)
-    banned_words = message.bot.get('banned_words', {}).get(user_id, [])
+async def handle_delete_banned_word(message: types.Message, state: FSMContext):
+    selected_chat = await get_selected_chat(state)
     
-    if not selected_chat or not banned_words:
+    if not selected_chat:
         await message.reply("Произошла ошибка. Пожалуйста, начните настройку заново с команды /config")
         return
     
-    try:
-        word_index = int(message.text) - 1
-        if 0 <= word_index < len(banned_words):
-            db_session = message.bot.get('db_session')
-            word_to_delete = banned_words[word_index]
-            
-            db_session.delete(word_to_delete)
-            db_session.commit()
-            
-            await message.reply(f"Слово '{word_to_delete.word}' удалено из списка запрещенных.")
-        else:
-            await message.reply("Неверный номер слова. Пожалуйста, выберите слово из списка.")
-    except ValueError:
-        await message.reply("Пожалуйста, введите номер слова из списка.")
+    word = message.text.lower()
+    db_session = message.bot.get('db_session')
+    word_to_delete = await db_session.scalar(select(BannedWord).where(
+        BannedWord.chat_id == str(selected_chat['id']),
+        BannedWord.word == word
+    ).limit(1))
+    
+    if word_to_delete:
+        await db_session.delete(word_to_delete)
+        await db_session.commit()
+        invalidate_chat_rules(message.bot, selected_chat['id'])
+        await message.reply(f"Слово '{word}' удалено из списка запрещенных.")
+    else:
+        await message.reply(f"Слово '{word}' не найдено в списке запрещенных.")
     
     # Возвращаемся к меню управления запрещенными словами
-    await show_banned_words_menu(message, selected_chat['id'])
+    await show_banned_words_menu(message, state, selected_chat['id'])
 
 # Обработчики для изменения настроек
-async def handle_toggle_setting(message: types.Message, setting_name):
-    user_id = message.from_user.id
-    selected_chat = message.bot.get('selected_chat', {}).get(user_id)
+async def handle_toggle_setting(message: types.Message, state: FSMContext, setting_name):
+    selected_chat = await get_selected_chat(state)
     
     if not selected_chat:
         await message.reply("Произошла ошибка. Пожалуйста, начните настройку заново с команды /config")
@@ -776,9 +990,9 @@ async def handle_toggle_setting(message: types.Message, setting_name):
         option = int(message.text)
         db_session = message.bot.get('db_session')
         
-        chat_settings = db_session.query(ChatSettings).filter(
+        chat_settings = await db_session.scalar(select(ChatSettings).where(
             ChatSettings.chat_id == str(selected_chat['id'])
-        ).first()
+        ).limit(1))
         
         if not chat_settings:
             chat_settings = ChatSettings(chat_id=str(selected_chat['id']))
@@ -793,8 +1007,12 @@ async def handle_toggle_setting(message: types.Message, setting_name):
         elif setting_name == 'keywords':
             chat_settings.filter_keywords = (option == 1)
             setting_text = "Фильтр ключевых слов"
+        elif setting_name == 'duplicates':
+            chat_settings.filter_duplicates = (option == 1)
+            setting_text = "Фильтр повторов"
         
-        db_session.commit()
+        await db_session.commit()
+        invalidate_chat_rules(message.bot, selected_chat['id'])
         
         status = "включен" if option == 1 else "выключен"
         await message.reply(f"{setting_text} {status}.")
@@ -802,12 +1020,11 @@ async def handle_toggle_setting(message: types.Message, setting_name):
         await message.reply("Пожалуйста, выберите 1 (Включить) или 2 (Выключить).")
     
     # Возвращаемся к меню настроек
-    await show_settings_menu(message, selected_chat['id'])
+    await show_settings_menu(message, state, selected_chat)
 
 # Обработчик для изменения действия при нарушении
-async def handle_set_action(message: types.Message):
-    user_id = message.from_user.id
-    selected_chat = message.bot.get('selected_chat', {}).get(user_id)
+async def handle_set_action(message: types.Message, state: FSMContext):
+    selected_chat = await get_selected_chat(state)
     
     if not selected_chat:
         await message.reply("Произошла ошибка. Пожалуйста, начните настройку заново с команды /config")
@@ -817,9 +1034,9 @@ async def handle_set_action(message: types.Message):
         option = int(message.text)
         db_session = message.bot.get('db_session')
         
-        chat_settings = db_session.query(ChatSettings).filter(
+        chat_settings = await db_session.scalar(select(ChatSettings).where(
             ChatSettings.chat_id == str(selected_chat['id'])
-        ).first()
+        ).limit(1))
         
         if not chat_settings:
             chat_settings = ChatSettings(chat_id=str(selected_chat['id']))
@@ -841,19 +1058,19 @@ async def handle_set_action(message: types.Message):
             await message.reply("Неверный номер опции. Пожалуйста, выберите опцию из меню.")
             return
         
-        db_session.commit()
+        await db_session.commit()
+        invalidate_chat_rules(message.bot, selected_chat['id'])
         
         await message.reply(f"Действие при нарушении установлено: {action_text}.")
     except ValueError:
         await message.reply("Пожалуйста, введите номер опции из меню.")
     
     # Возвращаемся к меню настроек
-    await show_settings_menu(message, selected_chat['id'])
+    await show_settings_menu(message, state, selected_chat)
 
 # Обработчик для изменения длительности мута
-async def handle_set_mute_duration(message: types.Message):
-    user_id = message.from_user.id
-    selected_chat = message.bot.get('selected_chat', {}).get(user_id)
+async def handle_set_mute_duration(message: types.Message, state: FSMContext):
+    selected_chat = await get_selected_chat(state)
     
     if not selected_chat:
         await message.reply("Произошла ошибка. Пожалуйста, начните настройку заново с команды /config")
@@ -864,16 +1081,17 @@ async def handle_set_mute_duration(message: types.Message):
         if 1 <= duration <= 10080:  # от 1 минуты до 7 дней
             db_session = message.bot.get('db_session')
             
-            chat_settings = db_session.query(ChatSettings).filter(
+            chat_settings = await db_session.scalar(select(ChatSettings).where(
                 ChatSettings.chat_id == str(selected_chat['id'])
-            ).first()
+            ).limit(1))
             
             if not chat_settings:
                 chat_settings = ChatSettings(chat_id=str(selected_chat['id']))
                 db_session.add(chat_settings)
             
             chat_settings.mute_duration = duration * 60  # переводим минуты в секунды
-            db_session.commit()
+            await db_session.commit()
+            invalidate_chat_rules(message.bot, selected_chat['id'])
             
             await message.reply(f"Длительность мута установлена: {duration} минут.")
         else:
@@ -883,59 +1101,84 @@ async def handle_set_mute_duration(message: types.Message):
         await message.reply("Пожалуйста, введите числовое значение.")
     
     # Возвращаемся к меню настроек
-    await show_settings_menu(message, selected_chat['id'])
+    await show_settings_menu(message, state, selected_chat)
+
+# Шаги диалога /config: состояние -> обработчик
+CONFIG_STEPS = {
+    ConfigStates.select_chat.state: handle_chat_selection,
+    ConfigStates.settings_menu.state: handle_settings_menu,
+    ConfigStates.banned_words_menu.state: handle_banned_words_menu,
+    ConfigStates.add_banned_word.state: handle_add_banned_word,
+    ConfigStates.delete_banned_word.state: handle_delete_banned_word,
+    ConfigStates.toggle_obscene.state: partial(handle_toggle_setting, setting_name='obscene'),
+    ConfigStates.toggle_links.state: partial(handle_toggle_setting, setting_name='links'),
+    ConfigStates.toggle_keywords.state: partial(handle_toggle_setting, setting_name='keywords'),
+    ConfigStates.toggle_duplicates.state: partial(handle_toggle_setting, setting_name='duplicates'),
+    ConfigStates.set_action.state: handle_set_action,
+    ConfigStates.set_mute_duration.state: handle_set_mute_duration,
+}
 
 # Обработчик для всех сообщений в личных чатах (для работы с состояниями)
-async def handle_private_messages(message: types.Message):
-    user_id = message.from_user.id
-    user_state = message.bot.get('user_states', {}).get(user_id)
-    
-    if not user_state:
-        return
-    
-    if user_state == 'select_chat':
-        await handle_chat_selection(message)
-    elif user_state == 'settings_menu':
-        await handle_settings_menu(message)
-    elif user_state == 'banned_words_menu':
-        await handle_banned_words_menu(message)
-    elif user_state == 'add_banned_word':
-        await handle_add_banned_word(message)
-    elif user_state == 'delete_banned_word':
-        await handle_delete_banned_word(message)
-    elif user_state == 'toggle_obscene':
-        await handle_toggle_setting(message, 'obscene')
-    elif user_state == 'toggle_links':
-        await handle_toggle_setting(message, 'links')
-    elif user_state == 'toggle_keywords':
-        await handle_toggle_setting(message, 'keywords')
-    elif user_state == 'set_action':
-        await handle_set_action(message)
-    elif user_state == 'set_mute_duration':
-        await handle_set_mute_duration(message)
+async def handle_private_messages(message: types.Message, state: FSMContext):
+    handler = CONFIG_STEPS.get(await state.get_state())
+    if handler is not None:
+        await handler(message, state)
+
+# Обновление кэша и индекса администраторов при изменении прав участника или самого бота
+async def handle_chat_member_update(update: types.ChatMemberUpdated):
+    admin_cache = update.bot['admin_cache']
+    new_member = update.new_chat_member
+    
+    if new_member.user.id == update.bot.id:
+        admin_cache.invalidate(update.chat.id)
+        # Бота исключили из группы - настраивать ее больше нельзя
+        if new_member.status in (types.ChatMemberStatus.LEFT, types.ChatMemberStatus.KICKED):
+            await admin_cache.index.remove_chat(update.chat.id)
+    elif is_admin_change(update):
+        admin_cache.invalidate(update.chat.id)
+        await admin_cache.index.update_member(
+            update.chat.id,
+            new_member.user.id,
+            new_member.is_chat_admin(),
+            update.chat.title
+        )
 
 # Регистрация всех обработчиков
+# Команды, которые обрабатывает бот в группах: от администраторов они не проходят модерацию,
+# потому что /addword и /allowdomain содержат запрещенное слово или домен в аргументах
+BOT_COMMANDS = frozenset((
+    'start', 'help', 'config', 'settings', 'addword', 'delword', 'listwords', 'allowdomain', 'deldomain',
+    'setaction', 'setpolicy', 'setflood', 'mute', 'ban', 'violations',
+))
+
 def register_handlers(dp: Dispatcher, bot: Bot, db_session):
     # Сохраняем сессию базы данных в боте для доступа из обработчиков
     bot['db_session'] = db_session
     
-    # Регистрация команд
-    dp.register_message_handler(cmd_start, commands=['start'])
-    dp.register_message_handler(cmd_help, commands=['help'])
-    dp.register_message_handler(cmd_config, commands=['config'])
-    dp.register_message_handler(cmd_settings, commands=['settings'])
-    dp.register_message_handler(cmd_addword, commands=['addword'], is_admin=True)
-    dp.register_message_handler(cmd_delword, commands=['delword'], is_admin=True)
-    dp.register_message_handler(cmd_listwords, commands=['listwords'], is_admin=True)
-    dp.register_message_handler(cmd_setaction, commands=['setaction'], is_admin=True)
-    dp.register_message_handler(cmd_mute, commands=['mute'], is_admin=True)
-    dp.register_message_handler(cmd_ban, commands=['ban'], is_admin=True)
-    dp.register_message_handler(cmd_violations, commands=['violations'], is_admin=True)
+    # Регистрация команд: state='*' - команды работают на любом шаге диалога и не читают хранилище состояний
+    dp.register_message_handler(cmd_start, commands=['start'], state='*')
+    dp.register_message_handler(cmd_help, commands=['help'], state='*')
+    dp.register_message_handler(cmd_config, commands=['config'], state='*')
+    dp.register_message_handler(cmd_settings, commands=['settings'], state='*')
+    dp.register_message_handler(cmd_addword, commands=['addword'], is_admin=True, state='*')
+    dp.register_message_handler(cmd_delword, commands=['delword'], is_admin=True, state='*')
+    dp.register_message_handler(cmd_listwords, commands=['listwords'], is_admin=True, state='*')
+    dp.register_message_handler(cmd_allowdomain, commands=['allowdomain'], is_admin=True, state='*')
+    dp.register_message_handler(cmd_deldomain, commands=['deldomain'], is_admin=True, state='*')
+    dp.register_message_handler(cmd_setaction, commands=['setaction'], is_admin=True, state='*')
+    dp.register_message_handler(cmd_setpolicy, commands=['setpolicy'], is_admin=True, state='*')
+    dp.register_message_handler(cmd_setflood, commands=['setflood'], is_admin=True, state='*')
+    dp.register_message_handler(cmd_mute, commands=['mute'], is_admin=True, state='*')
+    dp.register_message_handler(cmd_ban, commands=['ban'], is_admin=True, state='*')
+    dp.register_message_handler(cmd_violations, commands=['violations'], is_admin=True, state='*')
+    
+    # Кнопки листания страниц /violations и /listwords
+    dp.register_callback_query_handler(handle_violations_page, violations_cb.filter(), state='*')
+    dp.register_callback_query_handler(handle_words_page, words_cb.filter(), state='*')
+    
+    # Изменения состава администраторов
+    dp.register_chat_member_handler(handle_chat_member_update, state='*')
+    dp.register_my_chat_member_handler(handle_chat_member_update, state='*')
     
     # Регистрация обработчика для личных сообщений
-    dp.register_message_handler(handle_private_messages, lambda message: message.chat.type == 'private', content_types=types.ContentTypes.TEXT)
-    
-    # Регистрация обработчиков фильтров
-    dp.register_message_handler(handle_obscene, is_obscene=True)
-    dp.register_message_handler(handle_link, has_link=True)
-    dp.register_message_handler(handle_banned_word, has_banned_word=True)
\ No newline at end of file
+    dp.register_message_handler(handle_private_messages, lambda message: message.chat.type == 'private', content_types=types.ContentTypes.TEXT, state='*')
\ No newline at end of file
@@ -0,0 +1,80 @@
+"""Логирование через очередь: обработчики событий только кладут запись в очередь,
+форматирование и запись в поток выполняет фоновый поток QueueListener.
+
+Формат вывода - текст или JSON (LOG_FORMAT), дополнительные поля записи
+(extra=...) попадают в JSON как есть.
+"""
+import atexit
+import datetime
+import json
+import logging
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Атрибуты, которые есть у любой записи: все остальные пришли через extra
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON с временем, уровнем, логгером, сообщением и полями из extra"""
+    
+    def format(self, record):
+        data = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith('_'):
+                data[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exc_info'] = record.exc_text
+        if record.stack_info:
+            data['stack_info'] = self.formatStack(record.stack_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+# Форматирование трассировок в вызывающем потоке не зависит от формата вывода
+_TRACEBACK_FORMATTER = logging.Formatter()
+
+class LazyQueueHandler(QueueHandler):
+    """QueueHandler без форматирования в вызывающем потоке.
+    
+    Стандартный prepare() подставляет аргументы в сообщение до постановки в очередь,
+    то есть в цикле событий. Здесь сообщение собирается уже в потоке слушателя, поэтому
+    аргументами логов передаются только значения, которые после вызова не меняются:
+    строки, числа, идентификаторы и пойманные исключения. Трассировка ссылается на кадры
+    стека вызывающего кода и форматируется сразу, в очередь уходит только ее текст.
+    """
+    
+    def prepare(self, record):
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _TRACEBACK_FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def setup_logging(level='INFO', log_format='text', stream=None):
+    """Настраивает корневой логгер на запись через очередь и возвращает запущенный QueueListener"""
+    formatter = JsonFormatter() if log_format == 'json' else logging.Formatter(TEXT_FORMAT)
+    
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(formatter)
+    
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, output, respect_handler_level=True)
+    
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(LazyQueueHandler(log_queue))
+    root.setLevel(getattr(logging, level.upper(), logging.INFO))
+    
+    listener.start()
+    # При выходе слушатель дописывает все, что осталось в очереди
+    atexit.register(listener.stop)
+    return listener
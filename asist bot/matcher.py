@@ -0,0 +1,68 @@
+from collections import deque
+
+class WordMatcher:
+    """Автомат Ахо-Корасик: поиск любого из множества слов за один линейный проход по тексту"""
+    
+    def __init__(self, words=()):
+        # Переходы, суффиксные ссылки и найденное слово для каждого состояния автомата
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [None]
+        self.words = tuple(sorted({word for word in words if word}))
+        
+        for word in self.words:
+            self._add(word)
+        self._build()
+    
+    def __len__(self):
+        return len(self.words)
+    
+    def __bool__(self):
+        return bool(self.words)
+    
+    def _add(self, word):
+        state = 0
+        for char in word:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(None)
+            state = next_state
+        
+        if self._output[state] is None:
+            self._output[state] = word
+    
+    def _build(self):
+        # Обход в ширину: суффиксная ссылка состояния строится по ссылке его родителя
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                
+                # Слово, оканчивающееся в суффиксе, тоже считается найденным
+                if self._output[next_state] is None:
+                    self._output[next_state] = self._output[self._fail[next_state]]
+                queue.append(next_state)
+    
+    def find(self, text):
+        """Возвращает первое найденное в тексте слово или None"""
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        state = 0
+        
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state] is not None:
+                return output[state]
+        
+        return None
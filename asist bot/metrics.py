@@ -0,0 +1,321 @@
+"""Метрики бота в текстовом формате Prometheus.
+
+Счетчики и гистограммы обновляются на горячих путях (детекторы, запросы к базе
+и к Telegram), показатели очередей и кэшей считываются только в момент запроса
+метрик. Сервер метрик поднимается на METRICS_HOST:METRICS_PORT по пути /metrics.
+"""
+import bisect
+import logging
+import math
+import time
+from aiohttp import web
+from aiogram import Bot
+from aiogram.utils.exceptions import RetryAfter
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# Тип ответа /metrics (текстовый формат Prometheus 0.0.4)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Границы гистограмм задержек по умолчанию, в секундах
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+def _escape(value, quote=True):
+    value = str(value).replace('\\', '\\\\').replace('\n', '\\n')
+    return value.replace('"', '\\"') if quote else value
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Registry:
+    """Набор метрик, отдаваемых одним ответом /metrics"""
+    
+    def __init__(self):
+        self._metrics = {}
+    
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+        self._metrics[metric.name] = metric
+        return metric
+    
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {_escape(metric.documentation, quote=False)}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            try:
+                lines.extend(metric.samples())
+            except Exception as e:
+                # Ошибка одного источника не должна ломать весь ответ
+                logger.error("Ошибка при сборе метрики %s: %s", metric.name, e)
+        return '\n'.join(lines) + '\n'
+
+# Общий реестр метрик процесса
+REGISTRY = Registry()
+
+class _Metric:
+    type = 'untyped'
+    
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+        if registry is not None:
+            registry.register(self)
+    
+    def labels(self, *values):
+        """Значение метрики для набора меток; созданные значения переиспользуются"""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"Метрике {self.name} нужны метки {self.labelnames}")
+            child = self._children[values] = self._new_child()
+        return child
+    
+    def _new_child(self):
+        raise NotImplementedError
+    
+    def samples(self):
+        raise NotImplementedError
+
+class _CounterValue:
+    __slots__ = ('value',)
+    
+    def __init__(self):
+        self.value = 0
+    
+    def inc(self, amount=1):
+        self.value += amount
+
+class Counter(_Metric):
+    """Монотонно растущий счетчик"""
+    type = 'counter'
+    
+    def _new_child(self):
+        return _CounterValue()
+    
+    def inc(self, amount=1):
+        self._children[()].inc(amount)
+    
+    def total(self):
+        """Сумма счетчика по всем меткам"""
+        return sum(child.value for child in list(self._children.values()))
+    
+    def samples(self):
+        for values, child in list(self._children.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"
+
+class _HistogramValue:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+    
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value):
+        # Счетчики корзин хранятся без накопления, накопительные суммы считаются при выводе
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Histogram(_Metric):
+    """Распределение значений по корзинам (le - верхняя граница корзины)"""
+    type = 'histogram'
+    
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+    
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+    
+    def observe(self, value):
+        self._children[()].observe(value)
+    
+    def samples(self):
+        for values, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), child.counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, values, (('le', _format_value(bound)),))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, values)
+            yield f"{self.name}_sum{labels} {_format_value(child.sum)}"
+            yield f"{self.name}_count{labels} {child.count}"
+
+class CallbackMetric(_Metric):
+    """Метрика, значения которой считываются функцией в момент запроса /metrics.
+    
+    Функция возвращает число (метрика без меток) или словарь {значения меток: число}.
+    """
+    
+    def __init__(self, name, documentation, func, labelnames=(), type='gauge', registry=REGISTRY):
+        self.func = func
+        self.type = type
+        super().__init__(name, documentation, labelnames, registry)
+    
+    def _new_child(self):
+        return None
+    
+    def samples(self):
+        values = self.func()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in values.items():
+            if not isinstance(label_values, tuple):
+                label_values = (label_values,)
+            yield f"{self.name}{_format_labels(self.labelnames, label_values)} {_format_value(value)}"
+
+# Обновления и обработчики
+UPDATES = Counter('bot_updates_total', 'Обработано обновлений по типу', ['type'])
+UPDATE_SECONDS = Histogram('bot_update_seconds', 'Время обработки обновления', ['type'])
+
+# Детекторы нарушений: проверка одного сообщения занимает микросекунды
+DETECTOR_SECONDS = Histogram(
+    'bot_detector_seconds',
+    'Время проверки сообщения детектором',
+    ['detector'],
+    buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01)
+)
+VIOLATIONS = Counter('bot_violations_total', 'Обнаружено нарушений по типу', ['type'])
+
+# База данных
+DB_QUERIES = Counter('bot_db_queries_total', 'Запросов к базе данных по типу', ['statement'])
+DB_QUERY_SECONDS = Histogram('bot_db_query_seconds', 'Время выполнения запроса к базе данных', ['statement'])
+DB_ERRORS = Counter('bot_db_errors_total', 'Запросов к базе данных, завершившихся ошибкой', ['statement'])
+
+# Telegram Bot API
+API_SECONDS = Histogram('bot_telegram_request_seconds', 'Время запроса к Telegram Bot API', ['method'])
+API_ERRORS = Counter('bot_telegram_errors_total', 'Ошибок запросов к Telegram Bot API', ['method', 'error'])
+API_RETRY_AFTER = Counter('bot_telegram_retry_after_total', 'Ответов RetryAfter (превышен лимит запросов)', ['method'])
+
+# Шардированный режим: обновления, пересланные приемником обработчикам
+SHARD_UPDATES = Counter('bot_shard_updates_total', 'Обновлений, переданных обработчику', ['shard'])
+SHARD_ERRORS = Counter('bot_shard_errors_total', 'Обновлений, которые не удалось передать обработчику', ['shard'])
+
+def _statement_type(statement):
+    # Первое слово запроса: SELECT, INSERT, UPDATE, DELETE и т. д.
+    return statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'OTHER'
+
+def instrument_engine(engine):
+    """Подключает учет числа и времени запросов к движку SQLAlchemy (для асинхронного - к engine.sync_engine)"""
+    
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        context._metrics_started = time.perf_counter()
+    
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        statement_type = _statement_type(statement)
+        DB_QUERIES.labels(statement_type).inc()
+        DB_QUERY_SECONDS.labels(statement_type).observe(time.perf_counter() - context._metrics_started)
+    
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(exception_context):
+        statement = exception_context.statement
+        DB_ERRORS.labels(_statement_type(statement) if statement else 'OTHER').inc()
+
+class MetricsBot(Bot):
+    """Бот с учетом времени и ошибок запросов к Telegram по методам API"""
+    
+    async def request(self, method, data=None, files=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except RetryAfter:
+            API_RETRY_AFTER.labels(method).inc()
+            API_ERRORS.labels(method, 'RetryAfter').inc()
+            raise
+        except Exception as e:
+            API_ERRORS.labels(method, type(e).__name__).inc()
+            raise
+        finally:
+            API_SECONDS.labels(method).observe(time.perf_counter() - started)
+
+def _cache_stats(caches):
+    def collect(key):
+        return {name: cache.stats()[key] for name, cache in caches.items()}
+    return collect
+
+def register_bot_metrics(bot: Bot, scheduler=None, registry=REGISTRY):
+    """Показатели очередей и кэшей бота, которые считываются при каждом запросе /metrics"""
+    outbox = bot['outbox']
+    violation_log = bot['violation_log']
+    raid_guard = bot['raid_guard']
+    duplicate_detector = bot['duplicate_detector']
+    flood_limiter = bot['flood_limiter']
+    retention = bot['retention']
+    caches = {'rules': bot['rules_cache'], 'admins': bot['admin_cache']}
+    
+    CallbackMetric(
+        'bot_outbox_queue', 'Запросов в очереди к Telegram по состоянию',
+        lambda: {state: outbox.stats()[state] for state in ('queued', 'delayed', 'running')},
+        ['state'], registry=registry
+    )
+    CallbackMetric(
+        'bot_outbox_requests_total', 'Запросов из очереди к Telegram по результату',
+        lambda: {result: outbox.stats()[result] for result in ('sent', 'failed', 'retries')},
+        ['result'], type='counter', registry=registry
+    )
+    CallbackMetric('bot_violation_log_queue', 'Записей о нарушениях, ожидающих записи в базу',
+                   lambda: len(violation_log), registry=registry)
+    CallbackMetric('bot_violation_log_written_total', 'Записано нарушений в базу',
+                   lambda: violation_log.written, type='counter', registry=registry)
+    CallbackMetric('bot_violation_log_dropped_total', 'Отброшено записей о нарушениях при переполнении очереди',
+                   lambda: violation_log.dropped, type='counter', registry=registry)
+    CallbackMetric('bot_violations_archived_total', 'Перенесено нарушений в архив по сроку хранения',
+                   lambda: retention.archived, type='counter', registry=registry)
+    CallbackMetric('bot_raid_active_chats', 'Чатов в режиме защиты от рейда',
+                   lambda: len(raid_guard), registry=registry)
+    CallbackMetric('bot_duplicate_chats', 'Чатов с отпечатками недавних сообщений в фильтре повторов',
+                   lambda: len(duplicate_detector), registry=registry)
+    CallbackMetric('bot_flood_tracked_users', 'Пар (чат, пользователь) со счетчиками антифлуда',
+                   lambda: len(flood_limiter), registry=registry)
+    
+    if scheduler is not None:
+        CallbackMetric(
+            'bot_scheduler_updates', 'Принятых и еще не обработанных обновлений по состоянию',
+            lambda: {state: scheduler.stats()[state] for state in ('queued', 'running')},
+            ['state'], registry=registry
+        )
+        CallbackMetric('bot_scheduler_chats', 'Чатов с обновлениями в очереди',
+                       lambda: scheduler.stats()['chats'], registry=registry)
+    
+    collect = _cache_stats(caches)
+    CallbackMetric('bot_cache_size', 'Записей в кэше', lambda: collect('size'), ['cache'], registry=registry)
+    CallbackMetric('bot_cache_hits_total', 'Попаданий в кэш', lambda: collect('hits'), ['cache'],
+                   type='counter', registry=registry)
+    CallbackMetric('bot_cache_misses_total', 'Промахов кэша', lambda: collect('misses'), ['cache'],
+                   type='counter', registry=registry)
+    CallbackMetric('bot_cache_hit_ratio', 'Доля попаданий в кэш', lambda: collect('hit_rate'), ['cache'],
+                   registry=registry)
+
+async def start_metrics_server(host='127.0.0.1', port=9100, registry=REGISTRY):
+    """Запускает HTTP-сервер с метриками на /metrics; возвращает runner для остановки"""
+    
+    async def handle_metrics(request):
+        return web.Response(body=registry.render().encode('utf-8'), headers={'Content-Type': CONTENT_TYPE})
+    
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Метрики доступны на http://%s:%s/metrics", host, port)
+    return runner
@@ -0,0 +1,138 @@
+import logging
+import random
+import time
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from database import get_chat_rules
+from filters import detect_violation
+from handlers import BOT_COMMANDS, handle_violation
+from metrics import UPDATES, UPDATE_SECONDS, VIOLATIONS
+
+logger = logging.getLogger(__name__)
+
+def get_update_type(update: types.Update):
+    """Тип обновления: message, chat_member и т. д."""
+    return next((key for key in update.values if key != 'update_id'), 'unknown')
+
+def get_update_chat_id(update: types.Update, update_type):
+    event = getattr(update, update_type, None)
+    chat = getattr(event, 'chat', None) or getattr(getattr(event, 'message', None), 'chat', None)
+    return chat.id if chat is not None else None
+
+class MetricsMiddleware(BaseMiddleware):
+    """Число и время обработки обновлений по типу (message, chat_member и т. д.)"""
+    
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        data['_metrics_started'] = time.perf_counter()
+    
+    async def on_post_process_update(self, update: types.Update, results, data: dict):
+        update_type = get_update_type(update)
+        UPDATES.labels(update_type).inc()
+        UPDATE_SECONDS.labels(update_type).observe(time.perf_counter() - data['_metrics_started'])
+
+class UpdateLogMiddleware(BaseMiddleware):
+    """Журнал обработки обновлений вместо LoggingMiddleware aiogram: пишется случайная выборка
+    sample_rate обновлений и все обновления, обработка которых заняла больше slow_threshold секунд"""
+    
+    def __init__(self, sample_rate=0.01, slow_threshold=1.0):
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+    
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        data['_log_started'] = time.perf_counter()
+    
+    async def on_post_process_update(self, update: types.Update, results, data: dict):
+        duration = time.perf_counter() - data['_log_started']
+        slow = duration >= self.slow_threshold
+        if not slow and random.random() >= self.sample_rate:
+            return
+        
+        level = logging.WARNING if slow else logging.INFO
+        if not logger.isEnabledFor(level):
+            return
+        
+        update_type = get_update_type(update)
+        logger.log(level, "Обновление %s (%s) обработано за %.1f мс", update.update_id, update_type, duration * 1000, extra={
+            'update_id': update.update_id,
+            'update_type': update_type,
+            'chat_id': get_update_chat_id(update, update_type),
+            'duration_ms': round(duration * 1000, 1),
+            'slow': slow,
+        })
+
+class DatabaseMiddleware(BaseMiddleware):
+    """Область жизни сессии базы данных - одно обновление: в конце фиксируем или откатываем изменения"""
+    
+    def __init__(self, db_session):
+        super().__init__()
+        self.db_session = db_session
+    
+    async def on_pre_process_error(self, update: types.Update, exception, data: dict):
+        # Обработчик упал: отменяем его незафиксированные изменения, чтобы не закоммитить их в конце
+        if self.db_session.registry.has():
+            await self.db_session.rollback()
+    
+    async def on_post_process_update(self, update: types.Update, results, data: dict):
+        # Сессия не создавалась (например, правила чата взяты из кэша) - закрывать нечего
+        if not self.db_session.registry.has():
+            return
+        
+        try:
+            await self.db_session.commit()
+        except Exception as e:
+            logger.error("Ошибка при фиксации изменений обновления %s: %s", update.update_id, e)
+            await self.db_session.rollback()
+        finally:
+            # Возвращаем соединение в пул
+            await self.db_session.remove()
+
+class ModerationMiddleware(BaseMiddleware):
+    """Единый этап модерации: правила чата загружаются один раз, все детекторы проверяются за один проход"""
+    
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        # Модерируем только сообщения в группах
+        if message.chat.type == 'private':
+            return
+        
+        # Без проверки пропускаются только команды бота от администраторов: неизвестная команда
+        # или команда обычного участника ("/x http://spam.com") проверяется как любой текст
+        if message.is_command() and message.get_command(pure=True).lower() in BOT_COMMANDS:
+            admin_cache = message.bot['admin_cache']
+            if await admin_cache.is_admin(message.chat.id, message.from_user.id, message.chat.title):
+                return
+        
+        db_session = message.bot.get('db_session')
+        rules_cache = message.bot.get('rules_cache')
+        
+        # Правила чата берутся из кэша, при промахе загружаются одним запросом
+        rules = await get_chat_rules(db_session, rules_cache, message.chat.id)
+        if rules is None:
+            return
+        
+        # Частота считается по всем сообщениям (стикеры и медиа тоже) и проверяется раньше детекторов текста
+        flood_limiter = message.bot.get('flood_limiter')
+        if flood_limiter is not None and rules.flood_limit and flood_limiter.hit(
+            message.chat.id, message.from_user.id, rules.flood_limit, rules.flood_window
+        ):
+            violation_type = 'flood'
+        elif message.text:
+            violation_type = detect_violation(message, rules)
+        else:
+            return
+        
+        if violation_type is None:
+            return
+        
+        # Каждое нарушение и так попадает в журнал нарушений и метрики, здесь - только отладочная строка
+        logger.debug("Обнаружено нарушение %s в сообщении от %s", violation_type, message.from_user.id, extra={
+            'chat_id': message.chat.id,
+            'user_id': message.from_user.id,
+            'violation_type': violation_type,
+        })
+        VIOLATIONS.labels(violation_type).inc()
+        await handle_violation(message, violation_type, rules)
+        
+        # Сообщение уже обработано, остальные обработчики не вызываем
+        raise CancelHandler()
@@ -0,0 +1,181 @@
+"""Версионные миграции схемы базы данных.
+
+Текущая версия схемы хранится в таблице schema_version. Новая база создается
+сразу в актуальном виде, а существующая обновляется по шагам из MIGRATIONS,
+каждый шаг в отдельной транзакции.
+
+Ручной запуск (берет DATABASE_URL из окружения или .env): python migrations.py
+"""
+import asyncio
+import logging
+import os
+from dotenv import load_dotenv
+from sqlalchemy import MetaData, Table, Column, Integer, delete, func, insert, inspect, select, text, update
+from sqlalchemy.ext.asyncio import create_async_engine
+from database import (Base, AllowedDomain, BannedWord, ChatAdmin, ChatSettings, FSMState, UserWarnings, Violation,
+                      ViolationStats, get_async_database_url)
+
+logger = logging.getLogger(__name__)
+
+schema_metadata = MetaData()
+
+# Таблица с единственной строкой - номером текущей версии схемы
+schema_version = Table(
+    'schema_version', schema_metadata,
+    Column('version', Integer, nullable=False)
+)
+
+# Таблицы, созданные через create_all до появления миграций (версия 1)
+LEGACY_TABLES = {'chat_settings', 'banned_words', 'violations', 'user_warnings'}
+
+def get_index(model, name):
+    """Индекс модели по имени: миграция ссылается на конкретный индекс, а не на все индексы таблицы"""
+    return next(index for index in model.__table__.indexes if index.name == name)
+
+def delete_duplicates(connection, model, *columns):
+    """Удаляет дубликаты по набору колонок, оставляя самую раннюю запись"""
+    table = model.__table__
+    keep_ids = select(func.min(table.c.id)).group_by(*(table.c[column] for column in columns))
+    connection.execute(delete(table).where(table.c.id.not_in(keep_ids)))
+
+def add_column(connection, model, name):
+    """Добавляет в существующую таблицу колонку модели, если ее еще нет"""
+    table = model.__table__
+    if name in {column['name'] for column in inspect(connection).get_columns(table.name)}:
+        return
+    
+    preparer = connection.dialect.identifier_preparer
+    column_type = table.c[name].type.compile(dialect=connection.dialect)
+    connection.execute(text(
+        f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {preparer.quote(name)} {column_type}"
+    ))
+
+# Версия 2: белый список доменов для фильтра ссылок
+def create_allowed_domains(connection):
+    AllowedDomain.__table__.create(connection, checkfirst=True)
+
+# Версия 3: составные индексы под горячие запросы и уникальность счетчиков и слов
+def add_hot_path_indexes(connection):
+    # Перед созданием уникальных индексов сливаем накопившиеся дубликаты
+    warnings = UserWarnings.__table__
+    duplicate = warnings.alias('duplicate')
+    connection.execute(update(warnings).values(
+        warnings_count=select(func.max(duplicate.c.warnings_count)).where(
+            duplicate.c.chat_id == warnings.c.chat_id,
+            duplicate.c.user_id == warnings.c.user_id
+        ).scalar_subquery()
+    ))
+    delete_duplicates(connection, UserWarnings, 'chat_id', 'user_id')
+    delete_duplicates(connection, BannedWord, 'chat_id', 'word')
+    delete_duplicates(connection, AllowedDomain, 'chat_id', 'domain')
+    
+    get_index(UserWarnings, 'ix_user_warnings_chat_user').create(connection, checkfirst=True)
+    get_index(BannedWord, 'ix_banned_words_chat_word').create(connection, checkfirst=True)
+    get_index(AllowedDomain, 'ix_allowed_domains_chat_domain').create(connection, checkfirst=True)
+    get_index(Violation, 'ix_violations_chat_timestamp').create(connection, checkfirst=True)
+
+# Версия 4: индекс администраторов чатов для /config
+def create_chat_admins(connection):
+    ChatAdmin.__table__.create(connection, checkfirst=True)
+
+# Версия 5: состояния диалога /config
+def create_fsm_states(connection):
+    FSMState.__table__.create(connection, checkfirst=True)
+
+# Версия 6: политика наказаний чата и время последнего нарушения для сброса счетчика
+def add_escalation_policy(connection):
+    add_column(connection, ChatSettings, 'escalation_policy')
+    add_column(connection, UserWarnings, 'updated_at')
+
+# Версия 7: сводка нарушений, перенесенных в архив
+def create_violation_stats(connection):
+    ViolationStats.__table__.create(connection, checkfirst=True)
+
+# Версия 8: индекс для постраничного вывода нарушений
+def add_violations_page_index(connection):
+    get_index(Violation, 'ix_violations_chat_id').create(connection, checkfirst=True)
+
+# Версия 9: фильтр повторяющихся сообщений, в существующих чатах включен, как и в новых
+def add_filter_duplicates(connection):
+    add_column(connection, ChatSettings, 'filter_duplicates')
+    table = ChatSettings.__table__
+    connection.execute(update(table).where(table.c.filter_duplicates.is_(None)).values(filter_duplicates=True))
+
+# Версия 10: ограничение частоты сообщений, в существующих чатах - со значениями по умолчанию
+def add_flood_limit(connection):
+    add_column(connection, ChatSettings, 'flood_limit')
+    add_column(connection, ChatSettings, 'flood_window')
+    table = ChatSettings.__table__
+    connection.execute(update(table).where(table.c.flood_limit.is_(None)).values(
+        flood_limit=table.c.flood_limit.default.arg
+    ))
+    connection.execute(update(table).where(table.c.flood_window.is_(None)).values(
+        flood_window=table.c.flood_window.default.arg
+    ))
+
+# Шаги миграций по возрастанию версии: (версия, описание, функция)
+MIGRATIONS = [
+    (2, 'белый список доменов', create_allowed_domains),
+    (3, 'составные индексы и уникальные ограничения', add_hot_path_indexes),
+    (4, 'индекс администраторов чатов', create_chat_admins),
+    (5, 'хранилище состояний диалогов', create_fsm_states),
+    (6, 'политика наказаний', add_escalation_policy),
+    (7, 'сводка архивированных нарушений', create_violation_stats),
+    (8, 'индекс для постраничного вывода нарушений', add_violations_page_index),
+    (9, 'фильтр повторяющихся сообщений', add_filter_duplicates),
+    (10, 'ограничение частоты сообщений', add_flood_limit),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def get_schema_version(connection):
+    """Текущая версия схемы: 0 - пустая база, 1 - база без таблицы версий"""
+    tables = set(inspect(connection).get_table_names())
+    
+    if 'schema_version' in tables:
+        version = connection.execute(select(schema_version.c.version)).scalar()
+        if version is not None:
+            return version
+    
+    return 1 if LEGACY_TABLES & tables else 0
+
+def set_schema_version(connection, version):
+    schema_metadata.create_all(connection)
+    if connection.execute(update(schema_version).values(version=version)).rowcount == 0:
+        connection.execute(insert(schema_version).values(version=version))
+
+def create_schema(connection):
+    """Создание актуальной схемы в пустой базе"""
+    Base.metadata.create_all(connection)
+    set_schema_version(connection, LATEST_VERSION)
+
+# Обновление схемы базы данных до последней версии
+async def upgrade_database(engine):
+    async with engine.begin() as connection:
+        version = await connection.run_sync(get_schema_version)
+        
+        if version == 0:
+            await connection.run_sync(create_schema)
+            logger.info("Создана схема базы данных версии %s", LATEST_VERSION)
+            return
+    
+    for target_version, description, migrate in MIGRATIONS:
+        if target_version <= version:
+            continue
+        
+        logger.info("Миграция базы данных до версии %s: %s", target_version, description)
+        async with engine.begin() as connection:
+            await connection.run_sync(migrate)
+            await connection.run_sync(set_schema_version, target_version)
+
+async def main():
+    engine = create_async_engine(get_async_database_url(os.getenv('DATABASE_URL', 'sqlite:///bot_database.db')))
+    try:
+        await upgrade_database(engine)
+    finally:
+        await engine.dispose()
+
+if __name__ == '__main__':
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
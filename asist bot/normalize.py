@@ -0,0 +1,121 @@
+"""Нормализация текста перед поиском запрещенных слов.
+
+Обход фильтров обычно строится на подмене символов: латиница вместо похожей кириллицы
+("bлядь"), цифры вместо букв, невидимые символы и разделители между буквами ("б.л.я",
+"б л я"), повторы букв ("бляяяя"). Текст сообщения и слова-образцы приводятся к одному
+"скелету" одной и той же функцией, поэтому совпадение ищется уже среди скелетов.
+
+Склеивание не должно создавать слова, которых в тексте не было: разделитель удаляется,
+только если рядом с ним однобуквенный фрагмент ("б.л.я", "бля.д"), а между двумя
+словами ("хлеб,ляжки") заменяется пробелом. Цифры становятся буквами только рядом
+с буквами ("6ля"), отдельно стоящая цифра остается цифрой ("в 6 л я").
+
+Нормализация - это одна таблица перевода символов и несколько проходов регулярных
+выражений, все выполняются в C за линейное время от длины текста. Текст, который
+помещается в cp1251 (русский и латиница), переводится по байтовой таблице:
+bytes.translate в несколько раз быстрее str.translate со словарем.
+"""
+import re
+import unicodedata
+
+# Похожие на кириллицу латинские и греческие буквы и знаки, которыми заменяют буквы
+HOMOGLYPHS = {
+    'a': 'а', 'b': 'б', 'c': 'с', 'd': 'д', 'e': 'е', 'h': 'н', 'k': 'к', 'm': 'м', 'n': 'п',
+    'o': 'о', 'p': 'р', 'r': 'г', 't': 'т', 'u': 'и', 'x': 'х', 'y': 'у',
+    'α': 'а', 'β': 'в', 'γ': 'у', 'ε': 'е', 'η': 'п', 'ι': 'i', 'κ': 'к', 'μ': 'м', 'ν': 'v',
+    'ο': 'о', 'π': 'п', 'ρ': 'р', 'τ': 'т', 'υ': 'и', 'χ': 'х',
+    'ё': 'е', 'і': 'i', 'ї': 'i', 'ў': 'у', '@': 'а',
+}
+
+# Цифры, которыми заменяют буквы внутри слова
+DIGIT_HOMOGLYPHS = {'0': 'о', '3': 'з', '4': 'ч', '6': 'б', '8': 'в'}
+
+# Невидимые символы: пробелы нулевой ширины, мягкий перенос, управление направлением текста
+INVISIBLE = (
+    '\u00ad\u061c\u115f\u1160\u17b4\u17b5\u180e'
+    '\u200b\u200c\u200d\u200e\u200f\u202a\u202b\u202c\u202d\u202e'
+    '\u2060\u2061\u2062\u2063\u2064\u2066\u2067\u2068\u2069\u3164\ufeff\uffa0'
+)
+
+# Комбинируемые диакритические знаки: их навешивают на буквы, чтобы сломать совпадение
+COMBINING_MARKS = ''.join(chr(code) for code in range(0x0300, 0x0370))
+
+# Разделители, которые вставляют между буквами слова
+SEPARATORS = '.,-_*~|/\\\'"`+=^:;!?()[]{}<>«»…•·'
+
+# Все разделители переводятся в точку, а что с ней делать, решается по соседним символам
+_SEPARATOR = '.'
+
+# Символы без замены (латиница, греческий, кириллица) тоже есть в таблице: промах
+# в словаре str.translate обходится дороже, чем замена символа на себя
+_TABLE = str.maketrans({
+    **{chr(code): chr(code) for code in range(0x0500)},
+    **HOMOGLYPHS,
+    **{char: _SEPARATOR for char in SEPARATORS},
+    **{char: None for char in INVISIBLE + COMBINING_MARKS},
+})
+
+_BYTE_ENCODING = 'cp1251'
+
+def _build_byte_table():
+    # Та же таблица для байтов cp1251, вместе с переводом в нижний регистр
+    table = bytearray(range(256))
+    delete = bytearray()
+    for byte in range(256):
+        try:
+            char = bytes((byte,)).decode(_BYTE_ENCODING)
+        except UnicodeDecodeError:
+            continue
+        mapped = char.lower().translate(_TABLE)
+        if not mapped:
+            delete.append(byte)
+        else:
+            table[byte] = mapped.encode(_BYTE_ENCODING)[0]
+    return bytes(table), bytes(delete)
+
+_BYTE_TABLE, _BYTE_DELETE = _build_byte_table()
+
+# Разделители рядом с однобуквенным фрагментом, в начале и в конце слова удаляются,
+# оставшиеся (между двумя словами) заменяются пробелом. Каждая ветка берет серию
+# разделителей целиком: иначе хвост серии между словами удалился бы как "начало слова".
+# Выражение начинается с точки, поэтому остальной текст regex пропускает быстрым поиском
+_SEPARATOR_DROP_RE = re.compile(r'\.(?:(?<=\b\w\.)\.*|(?<![\w.]\.)\.*|(?<!\.\.)\.*(?:(?=\w\b)|(?![\w.])))')
+
+# Серии цифр, похожих на буквы: заменяются, только если примыкают к букве
+_DIGITS_RE = re.compile(r'[03468]+')
+_DIGIT_TABLE = str.maketrans(DIGIT_HOMOGLYPHS)
+
+# Повтор буквы ("бляяя") или три и больше однобуквенных слова подряд ("б л я"); цифры не склеиваются
+_CLEANUP_RE = re.compile(r'(\w)\1+|\b[^\W\d_](?:\s+[^\W\d_]\b){2,}')
+_WHITESPACE_RE = re.compile(r'\s+')
+
+def _digits(match):
+    text = match.string
+    start, end = match.span()
+    if (start and text[start - 1].isalpha()) or (end < len(text) and text[end].isalpha()):
+        return match.group(0).translate(_DIGIT_TABLE)
+    return match.group(0)
+
+def _cleanup(match):
+    if match.group(1):
+        return match.group(1)
+    return _WHITESPACE_RE.sub('', match.group(0))
+
+def normalize_text(text):
+    """Скелет текста для поиска запрещенных слов: 'Б.л.я', 'bляяя' и 'б л я' дают 'бля'"""
+    # Полноширинные и "математические" буквы (ｂ, 𝐛) приводятся к обычным только если они есть в тексте
+    if not text.isascii() and not unicodedata.is_normalized('NFKC', text):
+        text = unicodedata.normalize('NFKC', text)
+    try:
+        encoded = text.encode(_BYTE_ENCODING)
+    except UnicodeEncodeError:
+        # Эмодзи, греческий и прочие символы вне cp1251
+        text = text.lower().translate(_TABLE)
+    else:
+        text = encoded.translate(_BYTE_TABLE, _BYTE_DELETE).decode(_BYTE_ENCODING)
+    if _SEPARATOR in text:
+        # Знак препинания перед пробелом удаляется всегда; replace убирает большую часть совпадений до regex
+        text = _SEPARATOR_DROP_RE.sub('', text.replace(_SEPARATOR + ' ', ' ')).replace(_SEPARATOR, ' ')
+    if any(digit in text for digit in DIGIT_HOMOGLYPHS):
+        text = _DIGITS_RE.sub(_digits, text)
+    return _CLEANUP_RE.sub(_cleanup, text)
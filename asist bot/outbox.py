@@ -0,0 +1,238 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from aiogram.utils.exceptions import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты запросов: удаление сообщений и ограничения пользователей выполняются раньше уведомлений
+PRIORITY_ACTION = 0
+PRIORITY_NOTICE = 1
+
+class TokenBucket:
+    """Корзина токенов: пополняется со скоростью rate токенов в секунду, вмещает не больше capacity"""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+    
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+    
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+    
+    def delay(self, now):
+        """Через сколько секунд появится свободный токен"""
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+    
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+    
+    def block(self, now, seconds):
+        """Не выдавать токены ближайшие seconds секунд (ответ RetryAfter от Telegram)"""
+        self._refill(now)
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+    
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+class _Job:
+    __slots__ = ('call', 'chat_id', 'priority', 'future', 'attempts')
+    
+    def __init__(self, call, chat_id, priority, future):
+        self.call = call
+        self.chat_id = chat_id
+        self.priority = priority
+        self.future = future
+        self.attempts = 0
+
+class Outbox:
+    """Очередь исходящих запросов к Telegram с приоритетами и ограничением частоты.
+    
+    Все запросы проходят через общую корзину (global_rate в секунду), уведомления
+    в группы - еще и через корзину чата (group_rate в минуту). На RetryAfter запрос
+    откладывается на указанное Telegram время и повторяется.
+    """
+    
+    def __init__(self, global_rate=30, group_rate=20, max_retries=3, concurrency=30, timer=time.monotonic):
+        self.global_rate = global_rate
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.timer = timer
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self._global = TokenBucket(global_rate, global_rate, timer())
+        self._chat_buckets = {}
+        self._queue = []
+        self._delayed = []
+        self._seq = itertools.count()
+        self._running = set()
+        self._slots = asyncio.Semaphore(concurrency)
+        self._wakeup = asyncio.Event()
+        self._task = None
+    
+    def __len__(self):
+        return len(self._queue) + len(self._delayed)
+    
+    def _submit(self, call, chat_id, priority):
+        job = _Job(call, chat_id, priority, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._queue, (priority, next(self._seq), job))
+        self._wakeup.set()
+        return job.future
+    
+    async def run(self, call, chat_id=None, priority=PRIORITY_NOTICE):
+        """Ставит запрос в очередь и ждет его результата; call - функция без аргументов, возвращающая корутину"""
+        return await self._submit(call, chat_id, priority)
+    
+    def post(self, call, chat_id=None, priority=PRIORITY_NOTICE):
+        """Ставит запрос в очередь без ожидания: ошибки выполнения только записываются в лог"""
+        future = self._submit(call, chat_id, priority)
+        future.add_done_callback(self._log_failure)
+        return future
+    
+    @staticmethod
+    def _log_failure(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.warning("Запрос к Telegram не выполнен: %s", future.exception())
+    
+    def _chat_bucket(self, job, now):
+        # Ограничение 20 сообщений в минуту действует только для уведомлений в группы
+        if job.priority != PRIORITY_NOTICE or job.chat_id is None or int(job.chat_id) >= 0:
+            return None
+        
+        bucket = self._chat_buckets.get(job.chat_id)
+        if bucket is None:
+            # Корзины чатов, которые давно ничего не отправляли, полны и больше не нужны
+            if len(self._chat_buckets) >= 10000:
+                self._chat_buckets = {
+                    chat_id: chat_bucket for chat_id, chat_bucket in self._chat_buckets.items()
+                    if not chat_bucket.is_full(now)
+                }
+            bucket = self._chat_buckets[job.chat_id] = TokenBucket(self.group_rate / 60, self.group_rate, now)
+        return bucket
+    
+    def _delay(self, job, ready_at):
+        heapq.heappush(self._delayed, (ready_at, next(self._seq), job))
+    
+    async def _wait(self, timeout):
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+    
+    async def _run(self):
+        while True:
+            now = self.timer()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, seq, job = heapq.heappop(self._delayed)
+                heapq.heappush(self._queue, (job.priority, seq, job))
+            
+            if not self._queue:
+                await self._wait(self._delayed[0][0] - now if self._delayed else None)
+                continue
+            
+            # Общий лимит ждем до выбора запроса: за это время может прийти более срочный
+            delay = self._global.delay(now)
+            if delay > 0:
+                await self._wait(delay)
+                continue
+            
+            _, seq, job = heapq.heappop(self._queue)
+            if job.future.done():
+                continue
+            
+            # Чат исчерпал лимит - откладываем его запрос, не задерживая остальные чаты
+            bucket = self._chat_bucket(job, now)
+            if bucket is not None:
+                delay = bucket.delay(now)
+                if delay > 0:
+                    self._delay(job, now + delay)
+                    continue
+                bucket.take(now)
+            self._global.take(now)
+            
+            await self._slots.acquire()
+            task = asyncio.create_task(self._execute(job))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+    
+    async def _execute(self, job):
+        try:
+            result = await job.call()
+        except RetryAfter as e:
+            job.attempts += 1
+            self.retries += 1
+            if job.attempts > self.max_retries:
+                self.failed += 1
+                if not job.future.done():
+                    job.future.set_exception(e)
+                return
+            
+            # Telegram просит подождать: не шлем в этот чат (или вообще) до конца паузы и повторяем запрос
+            logger.warning("Превышен лимит запросов к Telegram, повтор через %s с", e.timeout)
+            now = self.timer()
+            bucket = self._chat_bucket(job, now)
+            if bucket is not None:
+                bucket.block(now, e.timeout)
+            else:
+                self._global.block(now, e.timeout)
+            self._delay(job, now + e.timeout)
+            self._wakeup.set()
+        except asyncio.CancelledError:
+            job.future.cancel()
+            raise
+        except Exception as e:
+            self.failed += 1
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            self.sent += 1
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._slots.release()
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self, timeout=10):
+        """Дожидается отправки очереди (не дольше timeout секунд) и останавливает обработку"""
+        deadline = self.timer() + timeout
+        while (self._queue or self._delayed or self._running) and self.timer() < deadline:
+            await asyncio.sleep(0.05)
+        
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        
+        for task in list(self._running):
+            task.cancel()
+        
+        pending = [job for _, _, job in self._queue + self._delayed if not job.future.done()]
+        for job in pending:
+            job.future.cancel()
+        if pending:
+            logger.warning("Не отправлено запросов к Telegram при остановке: %s", len(pending))
+        self._queue.clear()
+        self._delayed.clear()
+    
+    def stats(self):
+        return {
+            'queued': len(self._queue),
+            'delayed': len(self._delayed),
+            'running': len(self._running),
+            'sent': self.sent,
+            'failed': self.failed,
+            'retries': self.retries,
+        }
@@ -0,0 +1,118 @@
+"""Постраничный вывод списков (нарушения, запрещенные слова) с кнопками навигации.
+
+Страница выбирается по ключу - id крайней показанной записи, а не по смещению:
+запрос читает по индексу только строки текущей страницы, сколько бы записей ни было
+в чате. Страница заканчивается раньше, если следующая запись не помещается
+в одно сообщение Telegram.
+"""
+from collections import namedtuple
+from aiogram import types
+from aiogram.utils.callback_data import CallbackData
+from sqlalchemy import select
+from database import BannedWord, Violation
+
+# Максимальная длина сообщения Telegram (в единицах UTF-16)
+MESSAGE_LIMIT = 4096
+
+VIOLATIONS_PAGE_SIZE = 10
+WORDS_PAGE_SIZE = 50
+
+# Данные кнопок навигации: чат, направление (next - дальше по списку, prev - назад),
+# id крайней записи текущей страницы и фильтры списка нарушений
+violations_cb = CallbackData('vl', 'chat', 'dir', 'cursor', 'user', 'type')
+words_cb = CallbackData('bw', 'chat', 'dir', 'cursor')
+
+# Строки страницы, id их записей и есть ли записи до и после страницы
+Page = namedtuple('Page', 'lines ids has_prev has_next')
+
+def text_length(text):
+    # Telegram считает длину сообщения в единицах UTF-16: эмодзи занимают две
+    return len(text.encode('utf-16-le')) // 2
+
+async def load_page(db_session, query, id_column, render, direction=None, cursor=None, size=10, descending=False,
+                    reserved=0):
+    """Страница запроса query по ключу id_column: строки идут по убыванию id, если descending.
+    
+    render превращает строку результата в текст; reserved - длина заголовка и подписи сообщения.
+    """
+    forward = direction != 'prev'
+    # Назад читаем в обратном порядке от первой записи страницы, затем разворачиваем
+    newest_first = forward == descending
+    if cursor is not None:
+        query = query.where(id_column < cursor if newest_first else id_column > cursor)
+    query = query.order_by(id_column.desc() if newest_first else id_column.asc()).limit(size + 1)
+    rows = (await db_session.execute(query)).all()
+    
+    lines, ids = [], []
+    length = reserved
+    for row in rows[:size]:
+        line = render(row)
+        length += text_length(line) + 2
+        if length > MESSAGE_LIMIT:
+            break
+        lines.append(line)
+        ids.append(row.id)
+    
+    more = len(rows) > len(lines)
+    if forward:
+        return Page(lines, ids, has_prev=cursor is not None, has_next=more)
+    return Page(lines[::-1], ids[::-1], has_prev=more, has_next=True)
+
+def navigation_keyboard(page, make_data):
+    """Кнопки "назад" и "дальше"; make_data(direction, cursor) возвращает данные кнопки"""
+    buttons = []
+    if page.ids and page.has_prev:
+        buttons.append(types.InlineKeyboardButton("« Назад", callback_data=make_data('prev', page.ids[0])))
+    if page.ids and page.has_next:
+        buttons.append(types.InlineKeyboardButton("Дальше »", callback_data=make_data('next', page.ids[-1])))
+    return types.InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+
+def format_violation(row):
+    username = row.username or f"ID: {row.user_id}"
+    message_text = row.message_text or ''
+    return (
+        f"Пользователь: {username}\n"
+        f"Тип нарушения: {row.violation_type}\n"
+        f"Действие: {row.action_taken}\n"
+        f"Время: {row.timestamp:%Y-%m-%d %H:%M:%S}\n"
+        f"Сообщение: {message_text[:50]}{'...' if len(message_text) > 50 else ''}"
+    )
+
+async def violations_page(db_session, chat_id, user_id=None, violation_type=None, direction=None, cursor=None):
+    """Страница нарушений чата от новых к старым; возвращает текст, клавиатуру и страницу"""
+    query = select(
+        Violation.id, Violation.user_id, Violation.username, Violation.message_text,
+        Violation.violation_type, Violation.action_taken, Violation.timestamp
+    ).where(Violation.chat_id == str(chat_id))
+    
+    header = "Нарушения"
+    if user_id:
+        query = query.where(Violation.user_id == str(user_id))
+        header += f" пользователя {user_id}"
+    if violation_type:
+        query = query.where(Violation.violation_type == violation_type)
+        header += f" типа {violation_type}"
+    header += ":"
+    
+    page = await load_page(db_session, query, Violation.id, format_violation, direction, cursor,
+                           size=VIOLATIONS_PAGE_SIZE, descending=True, reserved=text_length(header))
+    keyboard = navigation_keyboard(page, lambda direction, cursor: violations_cb.new(
+        chat=chat_id, dir=direction, cursor=cursor, user=user_id or '', type=violation_type or ''
+    ))
+    return header + "\n\n" + "\n\n".join(page.lines), keyboard, page
+
+async def words_page(db_session, chat_id, direction=None, cursor=None, footer=''):
+    """Страница запрещенных слов чата в порядке добавления; footer дописывается после списка"""
+    header = "Список запрещенных слов:"
+    query = select(BannedWord.id, BannedWord.word).where(BannedWord.chat_id == str(chat_id))
+    
+    page = await load_page(db_session, query, BannedWord.id, lambda row: f"- {row.word}", direction, cursor,
+                           size=WORDS_PAGE_SIZE, reserved=text_length(header) + text_length(footer) + 2)
+    keyboard = navigation_keyboard(page, lambda direction, cursor: words_cb.new(
+        chat=chat_id, dir=direction, cursor=cursor
+    ))
+    # Слова идут строками подряд, без пустой строки между ними
+    text = header + "\n\n" + ("\n".join(page.lines) if page.lines else "Список пуст")
+    if footer:
+        text += "\n\n" + footer
+    return text, keyboard, page
@@ -0,0 +1,106 @@
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+# Действия, из которых состоит политика наказаний
+ACTIONS = ('delete', 'warn', 'mute', 'ban')
+
+# Единицы длительности мута; число без единицы - минуты, как в /mute
+DURATION_UNITS = {'m': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+# Telegram считает ограничения короче 30 секунд и длиннее 366 дней бессрочными
+MIN_MUTE_DURATION = 60
+MAX_MUTE_DURATION = 366 * 86400
+
+MAX_STEPS = 20
+
+_STEP_RE = re.compile(r'^(?P<action>[a-z]+)(?:\s+(?P<amount>\d+)\s*(?P<unit>[mhdw])?)?$')
+
+# Шаг политики: действие и длительность (только для mute)
+Step = namedtuple('Step', 'action duration')
+
+def format_duration(seconds):
+    """Длительность в записи политики: 3600 -> 1h"""
+    for unit, size in sorted(DURATION_UNITS.items(), key=lambda item: -item[1]):
+        if seconds % size == 0:
+            return f"{seconds // size}{unit}"
+    return f"{seconds // 60}m"
+
+class EscalationLadder:
+    """Скомпилированная политика наказаний: i-е нарушение пользователя получает i-й шаг,
+    после последнего шага повторяется последний"""
+    __slots__ = ('steps', 'text', '_next_punishment')
+    
+    def __init__(self, steps):
+        self.steps = tuple(steps)
+        self.text = ', '.join(
+            f"{step.action} {format_duration(step.duration)}" if step.action == 'mute' else step.action
+            for step in self.steps
+        )
+        
+        # Для каждого шага заранее считаем номер ближайшего шага с наказанием - он нужен в тексте предупреждения
+        next_punishment = [None] * len(self.steps)
+        upcoming = None
+        for index in range(len(self.steps) - 1, -1, -1):
+            if self.steps[index].action in ('mute', 'ban'):
+                upcoming = index + 1
+            next_punishment[index] = upcoming
+        self._next_punishment = tuple(next_punishment)
+    
+    def __len__(self):
+        return len(self.steps)
+    
+    def step(self, count):
+        """Шаг для нарушения с номером count (с единицы)"""
+        return self.steps[min(max(count, 1), len(self.steps)) - 1]
+    
+    def next_punishment(self, count):
+        """Номер нарушения, за которое последует мут или бан, или None"""
+        return self._next_punishment[min(max(count, 1), len(self.steps)) - 1]
+    
+    def __repr__(self):
+        return f"<EscalationLadder('{self.text}')>"
+
+def _parse_step(item, mute_duration):
+    match = _STEP_RE.match(item)
+    if match is None or match['action'] not in ACTIONS:
+        raise ValueError(f"Не удалось разобрать шаг '{item}'. Допустимые действия: {', '.join(ACTIONS)}.")
+    
+    action = match['action']
+    if match['amount'] is None:
+        return Step(action, mute_duration if action == 'mute' else 0)
+    
+    if action != 'mute':
+        raise ValueError(f"Длительность указывается только для mute: '{item}'.")
+    
+    duration = int(match['amount']) * DURATION_UNITS[match['unit'] or 'm']
+    if not MIN_MUTE_DURATION <= duration <= MAX_MUTE_DURATION:
+        raise ValueError(f"Длительность мута в шаге '{item}' должна быть от 1 минуты до 366 дней.")
+    return Step(action, duration)
+
+# Одинаковые политики разных чатов разбираются один раз
+@lru_cache(maxsize=1024)
+def parse_policy(text, mute_duration=3600):
+    """Разбор политики вида "warn, warn, mute 1h, mute 1d, ban"; ошибки - ValueError с текстом для пользователя"""
+    items = [item.strip() for item in re.split(r'[,;]', text.lower())]
+    if not any(items):
+        raise ValueError("Политика наказаний пуста.")
+    if len(items) > MAX_STEPS:
+        raise ValueError(f"В политике может быть не больше {MAX_STEPS} шагов.")
+    
+    steps = [_parse_step(' '.join(item.split()), mute_duration) for item in items]
+    if any(step.action == 'ban' for step in steps[:-1]):
+        raise ValueError("Бан может быть только последним шагом политики.")
+    return EscalationLadder(steps)
+
+@lru_cache(maxsize=64)
+def default_ladder(action_type, mute_duration):
+    """Политика по умолчанию из действия при нарушении (/setaction)"""
+    if action_type == 'warn':
+        # Два предупреждения, на третье нарушение - мут
+        return EscalationLadder([Step('warn', 0), Step('warn', 0), Step('mute', mute_duration)])
+    if action_type == 'mute':
+        return EscalationLadder([Step('mute', mute_duration)])
+    if action_type == 'ban':
+        return EscalationLadder([Step('ban', 0)])
+    return EscalationLadder([Step('delete', 0)])
@@ -0,0 +1,162 @@
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from aiogram import Bot
+from aiogram.utils.exceptions import BadRequest, NotFound
+from cache import TTLCache
+from outbox import PRIORITY_ACTION
+
+logger = logging.getLogger(__name__)
+
+# Максимум сообщений в одном запросе deleteMessages
+DELETE_BATCH_LIMIT = 100
+
+class _ChatRaid:
+    __slots__ = ('recent', 'active_until', 'message_ids', 'users', 'deleted', 'actions', 'last_notice', 'task')
+    
+    def __init__(self, threshold):
+        self.recent = deque(maxlen=threshold)
+        self.active_until = 0
+        self.message_ids = []
+        self.users = set()
+        self.deleted = 0
+        self.actions = {}
+        self.last_notice = 0
+        self.task = None
+
+class RaidGuard:
+    """Режим защиты от рейда: при всплеске нарушений в чате сообщения удаляются пачками,
+    а вместо уведомления на каждое нарушение отправляется одна сводка за интервал"""
+    
+    def __init__(self, bot: Bot, outbox, threshold=10, window=10, cooldown=60, batch_interval=2,
+                 notice_interval=30, maxsize=10000, timer=time.monotonic):
+        self.bot = bot
+        self.outbox = outbox
+        self.threshold = threshold
+        self.window = window
+        self.cooldown = cooldown
+        self.batch_interval = batch_interval
+        self.notice_interval = notice_interval
+        self.timer = timer
+        self._chats = TTLCache(maxsize=maxsize, ttl=max(window, cooldown), timer=timer)
+        # Чаты, в которых сейчас идет рейд
+        self._active = {}
+        self._stopping = False
+    
+    def __len__(self):
+        return len(self._active)
+    
+    def track(self, chat_id):
+        """Учитывает нарушение в чате и возвращает True, если его сообщения удаляются пачками (режим рейда)"""
+        now = self.timer()
+        state = self._chats.get(chat_id)
+        if state is None:
+            state = _ChatRaid(self.threshold)
+        # Запись продлевается при каждом нарушении, пока чат активен
+        self._chats.set(chat_id, state)
+        
+        state.recent.append(now)
+        if len(state.recent) == self.threshold and now - state.recent[0] <= self.window:
+            if state.active_until <= now:
+                logger.warning("Режим защиты от рейда включен в чате %s", chat_id)
+            state.active_until = now + self.cooldown
+        
+        if state.active_until <= now:
+            return False
+        
+        if state.task is None and not self._stopping:
+            state.task = asyncio.create_task(self._run(chat_id, state))
+            self._active[chat_id] = state
+        # Без фоновой задачи (например, при остановке бота) сообщения пачками не удаляются
+        return chat_id in self._active
+    
+    def add(self, message, action=None):
+        """Ставит сообщение нарушителя в пачку на удаление и учитывает его в сводке"""
+        state = self._active.get(message.chat.id)
+        if state is None:
+            return False
+        
+        state.message_ids.append(message.message_id)
+        state.users.add(message.from_user.username or message.from_user.id)
+        if action is not None:
+            self.add_action(message.chat.id, action)
+        if len(state.message_ids) >= DELETE_BATCH_LIMIT:
+            self._flush_deletes(message.chat.id, state)
+        return True
+    
+    def add_action(self, chat_id, action):
+        """Учитывает в сводке примененное к нарушителю наказание (mute, ban)"""
+        state = self._active.get(chat_id)
+        if state is not None:
+            state.actions[action] = state.actions.get(action, 0) + 1
+    
+    def _flush_deletes(self, chat_id, state):
+        message_ids, state.message_ids = state.message_ids, []
+        if message_ids:
+            state.deleted += len(message_ids)
+            self.outbox.post(lambda: self._delete_messages(chat_id, message_ids), priority=PRIORITY_ACTION)
+    
+    async def _delete_messages(self, chat_id, message_ids):
+        # deleteMessages удаляет до 100 сообщений одним запросом; если метод недоступен или отклонил пачку -
+        # удаляем по одному. RetryAfter и прочие ошибки уходят в очередь: пачку она повторит после паузы,
+        # а сотня одиночных запросов во время ограничения только продлила бы его
+        try:
+            return await self.bot.request('deleteMessages', {'chat_id': chat_id, 'message_ids': json.dumps(message_ids)})
+        except (BadRequest, NotFound) as e:
+            logger.warning("Пакетное удаление в чате %s не удалось (%s), удаляем сообщения по одному", chat_id, e)
+        
+        for message_id in message_ids:
+            self.outbox.post(
+                lambda message_id=message_id: self.bot.delete_message(chat_id, message_id),
+                priority=PRIORITY_ACTION
+            )
+    
+    def _flush_notice(self, chat_id, state):
+        if not state.deleted:
+            return
+        
+        text = (
+            f"Включена защита от рейда. Удалено сообщений: {state.deleted}, "
+            f"нарушителей: {len(state.users)}."
+        )
+        if state.actions.get('mute'):
+            text += f" Замучено: {state.actions['mute']}."
+        if state.actions.get('ban'):
+            text += f" Забанено: {state.actions['ban']}."
+        
+        self.outbox.post(lambda: self.bot.send_message(chat_id, text), chat_id=chat_id)
+        state.deleted = 0
+        state.users = set()
+        state.actions = {}
+        state.last_notice = self.timer()
+    
+    async def _run(self, chat_id, state):
+        """Фоновая задача чата на время рейда: удаление пачками и сводка раз в notice_interval"""
+        try:
+            while not self._stopping:
+                await asyncio.sleep(self.batch_interval)
+                self._flush_deletes(chat_id, state)
+                
+                now = self.timer()
+                active = state.active_until > now
+                if not active or now - state.last_notice >= self.notice_interval:
+                    self._flush_notice(chat_id, state)
+                if not active and not state.message_ids:
+                    logger.info("Режим защиты от рейда выключен в чате %s", chat_id)
+                    break
+        finally:
+            state.task = None
+            self._active.pop(chat_id, None)
+    
+    async def stop(self):
+        """Отправляет в очередь накопленные удаления и сводки и останавливает фоновые задачи"""
+        self._stopping = True
+        for chat_id, state in list(self._active.items()):
+            if state.task is not None:
+                state.task.cancel()
+            self._flush_deletes(chat_id, state)
+            self._flush_notice(chat_id, state)
+        # Отмененные задачи снимают чаты не сразу, а новые сообщения уже никто не удалит пачкой
+        self._active.clear()
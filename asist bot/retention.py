@@ -0,0 +1,129 @@
+"""Срок хранения нарушений: старые записи переносятся в архив и сводку по дням.
+
+Фоновая задача раз в interval секунд берет самые старые записи таблицы violations
+пачками по batch_size. Записи старше retention_days дописываются в сжатый архив
+(violations-ГГГГ-ММ.jsonl.gz в archive_dir, по файлу на месяц), их число по чату,
+дню и типу прибавляется к таблице violation_stats, и они удаляются из основной базы.
+Каждая пачка - одна короткая транзакция, между пачками задача уступает базу
+обработчикам обновлений.
+"""
+import asyncio
+import datetime
+import gzip
+import itertools
+import json
+import logging
+import os
+from collections import Counter, defaultdict
+from sqlalchemy import delete, select
+from sqlalchemy.dialects import postgresql, sqlite
+from database import Violation, ViolationStats
+
+logger = logging.getLogger(__name__)
+
+def write_archive(archive_dir, rows):
+    """Дописывает записи в архивы по месяцам; каждый вызов добавляет в файл отдельный блок gzip"""
+    os.makedirs(archive_dir, exist_ok=True)
+    
+    by_month = defaultdict(list)
+    for row in rows:
+        by_month[row['timestamp'].strftime('%Y-%m')].append(row)
+    
+    for month, month_rows in by_month.items():
+        lines = ''.join(json.dumps(row, ensure_ascii=False, default=str) + '\n' for row in month_rows)
+        with gzip.open(os.path.join(archive_dir, f'violations-{month}.jsonl.gz'), 'at', encoding='utf-8') as archive:
+            archive.write(lines)
+
+async def add_violation_stats(session, rows):
+    """Прибавляет записи к сводке по чату, дню и типу нарушения одним запросом"""
+    counts = Counter((row['chat_id'], row['timestamp'].date(), row['violation_type']) for row in rows)
+    table = ViolationStats.__table__
+    dialect = postgresql if session.bind.dialect.name == 'postgresql' else sqlite
+    
+    statement = dialect.insert(table).values([
+        {'chat_id': chat_id, 'day': day, 'violation_type': violation_type, 'count': count}
+        for (chat_id, day, violation_type), count in counts.items()
+    ])
+    await session.execute(statement.on_conflict_do_update(
+        index_elements=[table.c.chat_id, table.c.day, table.c.violation_type],
+        set_={'count': table.c.count + statement.excluded.count}
+    ))
+
+class ViolationRetention:
+    """Фоновый перенос нарушений старше retention_days в архив и сводку"""
+    
+    def __init__(self, session_factory, retention_days=90, archive_dir=None, batch_size=500, interval=3600,
+                 batch_pause=0.5):
+        self.session_factory = session_factory
+        self.retention_days = retention_days
+        self.archive_dir = archive_dir
+        self.batch_size = batch_size
+        self.interval = interval
+        self.batch_pause = batch_pause
+        self.archived = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._stopping = False
+    
+    async def archive_batch(self, cutoff):
+        """Переносит одну пачку записей старше cutoff; возвращает число перенесенных записей"""
+        table = Violation.__table__
+        async with self.session_factory() as session:
+            # Записи идут в порядке id, то есть времени: берем начало таблицы до первой свежей записи.
+            # Так запрос не просматривает всю таблицу, когда старых записей уже нет
+            result = await session.execute(select(table).order_by(table.c.id).limit(self.batch_size))
+            rows = [dict(row) for row in itertools.takewhile(
+                lambda row: row.timestamp < cutoff, result.mappings()
+            )]
+            if not rows:
+                return 0
+            
+            # Архив пишется до удаления: при сбое между ними запись окажется в архиве дважды, но не пропадет
+            if self.archive_dir:
+                await asyncio.to_thread(write_archive, self.archive_dir, rows)
+            
+            await add_violation_stats(session, rows)
+            await session.execute(delete(table).where(table.c.id.in_([row['id'] for row in rows])))
+            await session.commit()
+        
+        self.archived += len(rows)
+        return len(rows)
+    
+    async def run_once(self):
+        """Переносит все записи старше срока хранения; возвращает их число"""
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=self.retention_days)
+        total = 0
+        while not self._stopping:
+            count = await self.archive_batch(cutoff)
+            total += count
+            if count < self.batch_size:
+                break
+            await asyncio.sleep(self.batch_pause)
+        
+        if total:
+            logger.info("Перенесено в архив нарушений: %s", total)
+        return total
+    
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error("Ошибка при переносе нарушений в архив: %s", e)
+            
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+    
+    def start(self):
+        if self._task is None and self.retention_days > 0:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        # Как и очередь нарушений, задачу не отменяем: пачка дописывается до конца
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
@@ -0,0 +1,226 @@
+"""Планировщик обновлений: обновления разных чатов обрабатываются параллельно,
+обновления одного чата - строго по очереди в порядке получения.
+
+У каждого чата своя очередь и одна задача-обработчик, которая живет, пока очередь
+не опустеет. Общее число одновременно обрабатываемых обновлений ограничено
+concurrency, а число принятых и еще не обработанных - max_pending: когда лимит
+исчерпан, submit() ждет, и получение новых обновлений приостанавливается.
+"""
+import asyncio
+import itertools
+import logging
+from collections import deque
+import aiohttp
+from aiohttp.helpers import sentinel
+from aiogram import Bot, Dispatcher
+from aiogram.dispatcher.webhook import BaseResponse
+from aiogram.utils.exceptions import TelegramAPIError
+from middlewares import get_update_chat_id, get_update_type
+
+logger = logging.getLogger(__name__)
+
+def get_update_key(update):
+    """Ключ очереди обновления: чат, для обновлений без чата (inline и т. п.) - пользователь"""
+    update_type = get_update_type(update)
+    chat_id = get_update_chat_id(update, update_type)
+    if chat_id is not None:
+        return chat_id
+    user = getattr(getattr(update, update_type, None), 'from_user', None)
+    return user.id if user is not None else None
+
+class UpdateScheduler:
+    """Очереди обновлений по чатам с общим ограничением параллельности и числа ожидающих обновлений"""
+    
+    def __init__(self, process, concurrency=100, max_pending=10000):
+        self.process = process
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self._slots = asyncio.Semaphore(concurrency)
+        self._capacity = asyncio.Semaphore(max_pending)
+        self._queues = {}
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.pending = 0
+        self.running = 0
+        self.processed = 0
+        self.failed = 0
+    
+    def __len__(self):
+        return self.pending
+    
+    def stats(self):
+        return {
+            'pending': self.pending,
+            'queued': self.pending - self.running,
+            'running': self.running,
+            'chats': len(self._queues),
+            'processed': self.processed,
+            'failed': self.failed,
+        }
+    
+    async def submit(self, update):
+        """Ставит обновление в очередь его чата и возвращает future с результатом обработки.
+        
+        Если принято max_pending необработанных обновлений, ждет, пока освободится место.
+        """
+        await self._capacity.acquire()
+        self.pending += 1
+        self._idle.clear()
+        
+        future = asyncio.get_running_loop().create_future()
+        key = get_update_key(update)
+        if key is None:
+            # Порядок обновлений без чата и пользователя не важен
+            asyncio.create_task(self._execute(update, future))
+            return future
+        
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+            asyncio.create_task(self._work(key, queue))
+        queue.append((update, future))
+        return future
+    
+    async def run(self, update):
+        """Обрабатывает обновление в очереди его чата и возвращает результат"""
+        return await (await self.submit(update))
+    
+    async def _work(self, key, queue):
+        # Задача-обработчик чата: пока в очереди есть обновления, обрабатывает их по одному
+        try:
+            while queue:
+                update, future = queue.popleft()
+                await self._execute(update, future)
+        finally:
+            del self._queues[key]
+            # Задачу отменили при остановке: оставшиеся обновления чата уже не будут обработаны
+            while queue:
+                _, future = queue.popleft()
+                future.cancel()
+                self._release()
+    
+    async def _execute(self, update, future):
+        try:
+            async with self._slots:
+                self.running += 1
+                try:
+                    result = await self.process(update)
+                finally:
+                    self.running -= 1
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            self.failed += 1
+            if not future.cancelled():
+                future.set_exception(e)
+        else:
+            self.processed += 1
+            if not future.cancelled():
+                future.set_result(result)
+        finally:
+            self._release()
+    
+    def _release(self):
+        self.pending -= 1
+        self._capacity.release()
+        if not self.pending:
+            self._idle.set()
+    
+    async def drain(self, timeout=None):
+        """Ждет обработки всех принятых обновлений; возвращает False, если не дождались за timeout секунд"""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Не дождались обработки обновлений: %s", self.pending)
+            return False
+        return True
+
+class ScheduledDispatcher(Dispatcher):
+    """Диспетчер, который обрабатывает обновления через UpdateScheduler.
+    
+    В aiogram long polling запускает каждую полученную пачку отдельной задачей и сразу
+    запрашивает следующую, поэтому при медленной обработке задачи копятся без ограничений.
+    Здесь цикл получения ждет, пока планировщик примет все обновления пачки.
+    """
+    
+    def __init__(self, bot, *args, concurrency=100, max_pending=10000, **kwargs):
+        super().__init__(bot, *args, **kwargs)
+        self.scheduler = UpdateScheduler(self.updates_handler.notify, concurrency, max_pending)
+    
+    async def process_updates(self, updates, fast=True):
+        futures = [await self.scheduler.submit(update) for update in updates]
+        return await self._collect_results(updates, futures)
+    
+    async def _collect_results(self, updates, futures):
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        for update, result in zip(updates, results):
+            if isinstance(result, Exception):
+                logger.error("Ошибка при обработке обновления %s: %s", update.update_id, result, exc_info=result)
+        return [[] if isinstance(result, BaseException) else result for result in results]
+    
+    async def _execute_responses(self, updates, futures):
+        # Ответы обработчиков через webhook-ответы (BaseResponse) в polling выполняются запросами
+        need_to_call = []
+        for responses in itertools.chain.from_iterable(await self._collect_results(updates, futures)):
+            for response in responses:
+                if isinstance(response, BaseResponse):
+                    need_to_call.append(response.execute_response(self.bot))
+        if need_to_call:
+            try:
+                await asyncio.gather(*need_to_call)
+            except TelegramAPIError:
+                logger.exception("Ошибка при выполнении ответов обработчиков")
+    
+    async def start_polling(self, timeout=20, relax=0.1, limit=None, reset_webhook=None, fast=True,
+                            error_sleep=5, allowed_updates=None):
+        """Long polling с обратным давлением: следующая пачка запрашивается после того,
+        как планировщик принял предыдущую"""
+        if self._polling:
+            raise RuntimeError('Polling already started')
+        
+        logger.info("Запуск long polling")
+        Dispatcher.set_current(self)
+        Bot.set_current(self.bot)
+        
+        if reset_webhook is None:
+            await self.reset_webhook(check=False)
+        if reset_webhook:
+            await self.reset_webhook(check=True)
+        
+        self._polling = True
+        offset = None
+        try:
+            current_request_timeout = self.bot.timeout
+            if current_request_timeout is not sentinel and timeout is not None:
+                request_timeout = aiohttp.ClientTimeout(total=current_request_timeout.total + timeout or 1)
+            else:
+                request_timeout = None
+            
+            while self._polling:
+                try:
+                    with self.bot.request_timeout(request_timeout):
+                        updates = await self.bot.get_updates(
+                            limit=limit,
+                            offset=offset,
+                            timeout=timeout,
+                            allowed_updates=allowed_updates
+                        )
+                except asyncio.CancelledError:
+                    break
+                except Exception:
+                    logger.exception("Ошибка при получении обновлений")
+                    await asyncio.sleep(error_sleep)
+                    continue
+                
+                if updates:
+                    offset = updates[-1].update_id + 1
+                    # Ждем места в планировщике; результаты собирает отдельная задача
+                    futures = [await self.scheduler.submit(update) for update in updates]
+                    asyncio.create_task(self._execute_responses(updates, futures))
+                
+                if relax:
+                    await asyncio.sleep(relax)
+        finally:
+            self._close_waiter.set_result(None)
+            logger.warning("Long polling остановлен")
@@ -0,0 +1,336 @@
+"""Шардированный режим: процесс-приемник вебхука и SHARD_WORKERS процессов-обработчиков.
+
+Приемник не разбирает обновления: он берет из JSON идентификатор чата (для обновлений
+без чата - пользователя) и пересылает запрос обработчику с номером id % SHARD_WORKERS
+через unix-сокет. Обработчик - обычный bot.py в режиме BOT_MODE=worker, поэтому все
+обновления чата попадают в один процесс: кэши, очереди и защита от рейдов чата остаются
+локальными, а общее состояние хранится в базе. Сброс кэша в одном обработчике рассылается
+остальным, чтобы настройки, измененные через /config в личном чате, сразу применялись в группе.
+
+Запуск: python shard.py
+"""
+import asyncio
+import logging
+import os
+import secrets
+import signal
+import sys
+from aiohttp import ClientError, ClientSession, ClientTimeout, UnixConnector, web
+from aiogram import Bot, Dispatcher
+from aiogram.dispatcher.webhook import RESPONSE_TIMEOUT
+from aiogram.utils.executor import Executor
+from metrics import SHARD_ERRORS, SHARD_UPDATES, start_metrics_server
+from webhook import (ALLOWED_UPDATES, DRAINING_KEY, INFLIGHT_KEY, SECRET_TOKEN_HEADER, SECRET_TOKEN_KEY,
+                     ModeratorWebhookHandler, drain_updates, secret_matches)
+
+logger = logging.getLogger(__name__)
+
+# Пути HTTP-сервера обработчика на его unix-сокете
+WORKER_UPDATE_PATH = '/update'
+WORKER_INVALIDATE_PATH = '/invalidate'
+
+# Сколько ждать появления сокетов обработчиков при запуске (секунды)
+WORKER_START_TIMEOUT = 60
+
+def socket_path(socket_dir, index):
+    return os.path.join(socket_dir, f'shard-{index}.sock')
+
+def shard_for(key, workers):
+    # Остаток в Python неотрицателен и для отрицательных id групп
+    return key % workers
+
+def get_raw_update_key(data):
+    """Ключ шарда по JSON обновления: id чата, для обновлений без чата - id пользователя, иначе 0"""
+    for name, event in data.items():
+        if name == 'update_id' or not isinstance(event, dict):
+            continue
+        chat = event.get('chat') or (event.get('message') or {}).get('chat')
+        if chat:
+            return chat['id']
+        user = event.get('from')
+        if user:
+            return user['id']
+    return 0
+
+async def _post_to_worker(socket_dir, index, path, secret, **kwargs):
+    async with ClientSession(connector=UnixConnector(path=socket_path(socket_dir, index))) as session:
+        async with session.post(f'http://shard{path}', headers={SECRET_TOKEN_HEADER: secret}, **kwargs) as response:
+            response.raise_for_status()
+
+class ShardedCache:
+    """Кэш обработчика, сброс которого рассылается остальным обработчикам.
+    
+    Остальные методы передаются исходному кэшу, поэтому обработчики команд не знают о шардах.
+    """
+    
+    def __init__(self, cache, name, index, workers, socket_dir, secret):
+        self._cache = cache
+        self._name = name
+        self._index = index
+        self._workers = workers
+        self._socket_dir = socket_dir
+        self._secret = secret
+        self._tasks = set()
+    
+    def __getattr__(self, name):
+        return getattr(self._cache, name)
+    
+    def __len__(self):
+        return len(self._cache)
+    
+    def invalidate(self, key):
+        self._cache.invalidate(key)
+        for index in range(self._workers):
+            if index != self._index:
+                task = asyncio.create_task(self._notify(index, key))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+    
+    def invalidate_local(self, key):
+        """Сброс по сообщению другого обработчика"""
+        self._cache.invalidate(key)
+    
+    async def _notify(self, index, key):
+        try:
+            await _post_to_worker(self._socket_dir, index, WORKER_INVALIDATE_PATH, self._secret,
+                                  json={'cache': self._name, 'key': key})
+        except (ClientError, OSError) as e:
+            # Обработчик перезапускается: его кэш и так пуст
+            logger.warning("Не удалось передать сброс кэша %s обработчику %s: %s", self._name, index, e)
+
+def start_worker(dp: Dispatcher, socket_dir, index, secret, drain_timeout=30, on_startup=None, on_shutdown=None):
+    """Запуск обработчика: обновления от приемника принимаются на unix-сокете вместо вебхука Telegram"""
+    web_app = web.Application()
+    web_app[SECRET_TOKEN_KEY] = secret
+    web_app[INFLIGHT_KEY] = set()
+    web_app[DRAINING_KEY] = asyncio.Event()
+    
+    async def handle_invalidate(request):
+        if not secret_matches(request, secret):
+            raise web.HTTPUnauthorized()
+        data = await request.json()
+        cache = dp.bot.get(data['cache'])
+        if isinstance(cache, ShardedCache):
+            cache.invalidate_local(data['key'])
+        return web.Response(text='ok')
+    
+    web_app.router.add_post(WORKER_INVALIDATE_PATH, handle_invalidate)
+    
+    async def startup(dispatcher: Dispatcher):
+        if on_startup is not None:
+            await on_startup(dispatcher)
+        logger.info("Обработчик %s готов", index)
+    
+    async def shutdown(dispatcher: Dispatcher):
+        await drain_updates(web_app, drain_timeout)
+        if on_shutdown is not None:
+            await on_shutdown(dispatcher)
+    
+    path = socket_path(socket_dir, index)
+    # Сокет мог остаться от упавшего процесса
+    if os.path.exists(path):
+        os.unlink(path)
+    
+    runner = Executor(dp, skip_updates=False)
+    runner.on_startup(startup, polling=False)
+    runner.on_shutdown(shutdown, polling=False)
+    runner.set_webhook(webhook_path=WORKER_UPDATE_PATH, request_handler=ModeratorWebhookHandler, web_app=web_app)
+    runner.run_app(path=path, access_log=None)
+
+class ShardReceiver:
+    """Приемник вебхука: проверяет секретный токен Telegram и пересылает обновление обработчику его чата"""
+    
+    def __init__(self, workers, socket_dir, worker_env=None, webhook_secret=None, drain_timeout=30, metrics_port=0):
+        self.workers = workers
+        self.socket_dir = socket_dir
+        self.worker_env = worker_env or {}
+        self.metrics_port = metrics_port
+        self.webhook_secret = webhook_secret
+        self.drain_timeout = drain_timeout
+        # Токен для запросов между процессами, обработчики получают его в окружении
+        self.secret = secrets.token_urlsafe(32)
+        self._sessions = []
+        self._processes = [None] * workers
+        self._supervisors = []
+        self._inflight = set()
+        self._stopping = False
+    
+    def worker_environment(self, index):
+        env = dict(os.environ, **self.worker_env)
+        env.update({
+            'BOT_MODE': 'worker',
+            'SHARD_INDEX': str(index),
+            'SHARD_WORKERS': str(self.workers),
+            'SHARD_SOCKET_DIR': self.socket_dir,
+            'SHARD_SECRET': self.secret,
+            # Метрики приемника на METRICS_PORT, обработчиков - на следующих портах
+            'METRICS_PORT': str(self.metrics_port + 1 + index if self.metrics_port else 0),
+        })
+        return env
+    
+    async def _supervise(self, index):
+        # Упавший обработчик перезапускается; обновления его чатов Telegram доставит повторно
+        while not self._stopping:
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py'),
+                env=self.worker_environment(index),
+                # Сигналы терминала не доходят до обработчиков: их останавливает приемник после пересланных обновлений
+                start_new_session=True
+            )
+            self._processes[index] = process
+            code = await process.wait()
+            if not self._stopping:
+                logger.error("Обработчик %s завершился с кодом %s, перезапуск", index, code)
+                await asyncio.sleep(1)
+    
+    async def start(self):
+        os.makedirs(self.socket_dir, exist_ok=True)
+        for index in range(self.workers):
+            path = socket_path(self.socket_dir, index)
+            if os.path.exists(path):
+                os.unlink(path)
+            self._supervisors.append(asyncio.create_task(self._supervise(index)))
+        
+        # Ответ обработчика ждем столько же, сколько Telegram ждет ответа на вебхук
+        timeout = ClientTimeout(total=RESPONSE_TIMEOUT + 5)
+        self._sessions = [
+            ClientSession(connector=UnixConnector(path=socket_path(self.socket_dir, index)), timeout=timeout)
+            for index in range(self.workers)
+        ]
+        
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + WORKER_START_TIMEOUT
+        while not all(os.path.exists(socket_path(self.socket_dir, index)) for index in range(self.workers)):
+            if loop.time() > deadline:
+                raise RuntimeError("Обработчики не запустились")
+            await asyncio.sleep(0.2)
+        logger.info("Запущено обработчиков: %s", self.workers)
+    
+    async def stop(self):
+        # Дожидаемся пересланных обновлений, затем останавливаем обработчики (они дообрабатывают свои очереди)
+        self._stopping = True
+        if self._inflight:
+            await asyncio.wait(set(self._inflight), timeout=self.drain_timeout)
+        
+        for process in self._processes:
+            if process is not None and process.returncode is None:
+                process.send_signal(signal.SIGTERM)
+        for index, process in enumerate(self._processes):
+            if process is None:
+                continue
+            try:
+                await asyncio.wait_for(process.wait(), self.drain_timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Обработчик %s не остановился, завершаем принудительно", index)
+                process.kill()
+                await process.wait()
+        
+        for task in self._supervisors:
+            task.cancel()
+        for session in self._sessions:
+            await session.close()
+    
+    async def handle_update(self, request):
+        if self.webhook_secret and not secret_matches(request, self.webhook_secret):
+            logger.warning("Запрос к вебхуку с неверным секретным токеном от %s", request.remote)
+            raise web.HTTPUnauthorized()
+        if self._stopping:
+            raise web.HTTPServiceUnavailable()
+        
+        body = await request.read()
+        try:
+            index = shard_for(get_raw_update_key(await request.json()), self.workers)
+        except (ValueError, KeyError, TypeError):
+            raise web.HTTPBadRequest()
+        
+        task = asyncio.current_task()
+        self._inflight.add(task)
+        try:
+            SHARD_UPDATES.labels(index).inc()
+            async with self._sessions[index].post(
+                f'http://shard{WORKER_UPDATE_PATH}',
+                data=body,
+                headers={SECRET_TOKEN_HEADER: self.secret, 'Content-Type': 'application/json'}
+            ) as response:
+                return web.Response(
+                    status=response.status,
+                    body=await response.read(),
+                    content_type=response.content_type
+                )
+        except (ClientError, OSError, asyncio.TimeoutError) as e:
+            # Обработчик недоступен: Telegram доставит обновление повторно
+            SHARD_ERRORS.labels(index).inc()
+            logger.warning("Не удалось передать обновление обработчику %s: %s", index, e)
+            raise web.HTTPServiceUnavailable()
+        finally:
+            self._inflight.discard(task)
+
+async def prepare_database(database_url):
+    """Миграции выполняет приемник один раз до запуска обработчиков"""
+    from database import close_database, setup_database
+    from migrations import upgrade_database
+    
+    db_session = setup_database(database_url)
+    try:
+        await upgrade_database(db_session.bind)
+    finally:
+        await close_database(db_session)
+
+def main():
+    from dotenv import load_dotenv
+    from logs import setup_logging
+    
+    load_dotenv()
+    setup_logging(os.getenv('LOG_LEVEL', 'INFO'), os.getenv('LOG_FORMAT', 'text'))
+    
+    workers = int(os.getenv('SHARD_WORKERS') or os.cpu_count() or 1)
+    metrics_port = int(os.getenv('METRICS_PORT', '0'))
+    webhook_path = os.getenv('WEBHOOK_PATH', '/webhook')
+    webhook_url = os.getenv('WEBHOOK_HOST', '').rstrip('/') + webhook_path
+    webhook_secret = os.getenv('WEBHOOK_SECRET') or None
+    
+    receiver = ShardReceiver(
+        workers,
+        os.getenv('SHARD_SOCKET_DIR', '/tmp/moderator-shards'),
+        worker_env={
+            # Лимит Telegram на число запросов в секунду общий для всех процессов
+            'OUTBOX_GLOBAL_RATE': str(max(1, int(os.getenv('OUTBOX_GLOBAL_RATE', '30')) // workers)),
+        },
+        webhook_secret=webhook_secret,
+        drain_timeout=float(os.getenv('WEBHOOK_DRAIN_TIMEOUT', '30')),
+        metrics_port=metrics_port
+    )
+    
+    web_app = web.Application()
+    web_app.router.add_post(webhook_path, receiver.handle_update)
+    
+    async def startup(app):
+        await prepare_database(os.getenv('DATABASE_URL', 'sqlite:///bot_database.db'))
+        await receiver.start()
+        if metrics_port:
+            app['metrics_runner'] = await start_metrics_server(os.getenv('METRICS_HOST', '127.0.0.1'), metrics_port)
+        
+        bot = Bot(token=os.getenv('BOT_TOKEN'))
+        try:
+            await bot.set_webhook(
+                webhook_url,
+                secret_token=webhook_secret,
+                max_connections=int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40')),
+                allowed_updates=ALLOWED_UPDATES
+            )
+        finally:
+            await bot.session.close()
+        logger.info("Вебхук установлен: %s", webhook_url)
+    
+    async def shutdown(app):
+        await receiver.stop()
+        if 'metrics_runner' in app:
+            await app['metrics_runner'].cleanup()
+    
+    web_app.on_startup.append(startup)
+    web_app.on_shutdown.append(shutdown)
+    web.run_app(web_app, host=os.getenv('WEBAPP_HOST', '0.0.0.0'), port=int(os.getenv('WEBAPP_PORT', '8080')),
+                access_log=None)
+
+if __name__ == '__main__':
+    main()
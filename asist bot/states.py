@@ -0,0 +1,15 @@
+from aiogram.dispatcher.filters.state import State, StatesGroup
+
+# Шаги диалога настройки бота через /config
+class ConfigStates(StatesGroup):
+    select_chat = State()
+    settings_menu = State()
+    banned_words_menu = State()
+    add_banned_word = State()
+    delete_banned_word = State()
+    toggle_obscene = State()
+    toggle_links = State()
+    toggle_keywords = State()
+    toggle_duplicates = State()
+    set_action = State()
+    set_mute_duration = State()
@@ -0,0 +1,201 @@
+import copy
+import datetime
+import json
+import logging
+from urllib.parse import urlsplit
+from aiogram.dispatcher.storage import BaseStorage
+from sqlalchemy import delete, select, update
+from sqlalchemy.exc import IntegrityError
+from cache import TTLCache
+from database import FSMState
+
+logger = logging.getLogger(__name__)
+
+class RecordStorage(BaseStorage):
+    """Общая часть хранилищ состояний: состояние, данные и bucket пользователя хранятся одной записью"""
+    
+    async def _load(self, key):
+        raise NotImplementedError
+    
+    async def _store(self, key, record):
+        raise NotImplementedError
+    
+    async def close(self):
+        pass
+    
+    async def wait_closed(self):
+        pass
+    
+    def _key(self, chat, user):
+        chat, user = self.check_address(chat=chat, user=user)
+        return str(chat), str(user)
+    
+    async def _record(self, chat, user):
+        key = self._key(chat, user)
+        record = await self._load(key)
+        if record is None:
+            record = {'state': None, 'data': {}, 'bucket': {}}
+        return key, record
+    
+    async def _save(self, key, record):
+        # Пустую запись не храним: закончившийся диалог не занимает место
+        await self._store(key, record if record['state'] or record['data'] or record['bucket'] else None)
+    
+    async def get_state(self, *, chat=None, user=None, default=None):
+        _, record = await self._record(chat, user)
+        return record['state'] or self.resolve_state(default)
+    
+    async def get_data(self, *, chat=None, user=None, default=None):
+        _, record = await self._record(chat, user)
+        return copy.deepcopy(record['data'])
+    
+    async def set_state(self, *, chat=None, user=None, state=None):
+        key, record = await self._record(chat, user)
+        record['state'] = self.resolve_state(state)
+        await self._save(key, record)
+    
+    async def set_data(self, *, chat=None, user=None, data=None):
+        key, record = await self._record(chat, user)
+        record['data'] = copy.deepcopy(data or {})
+        await self._save(key, record)
+    
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        key, record = await self._record(chat, user)
+        record['data'].update(copy.deepcopy(data or {}), **kwargs)
+        await self._save(key, record)
+    
+    async def reset_state(self, *, chat=None, user=None, with_data=True):
+        # Сброс одной записью вместо отдельных set_state и set_data
+        key, record = await self._record(chat, user)
+        record['state'] = None
+        if with_data:
+            record['data'] = {}
+        await self._save(key, record)
+    
+    def has_bucket(self):
+        return True
+    
+    async def get_bucket(self, *, chat=None, user=None, default=None):
+        _, record = await self._record(chat, user)
+        return copy.deepcopy(record['bucket'])
+    
+    async def set_bucket(self, *, chat=None, user=None, bucket=None):
+        key, record = await self._record(chat, user)
+        record['bucket'] = copy.deepcopy(bucket or {})
+        await self._save(key, record)
+    
+    async def update_bucket(self, *, chat=None, user=None, bucket=None, **kwargs):
+        key, record = await self._record(chat, user)
+        record['bucket'].update(copy.deepcopy(bucket or {}), **kwargs)
+        await self._save(key, record)
+
+class TTLMemoryStorage(RecordStorage):
+    """Хранилище состояний в памяти: ограничено по числу записей, запись живет ttl секунд с последнего изменения"""
+    
+    def __init__(self, maxsize=10000, ttl=86400):
+        self._records = TTLCache(maxsize=maxsize, ttl=ttl)
+    
+    def __len__(self):
+        return len(self._records)
+    
+    async def _load(self, key):
+        return self._records.get(key)
+    
+    async def _store(self, key, record):
+        if record is None:
+            self._records.invalidate(key)
+        else:
+            self._records.set(key, record)
+    
+    async def close(self):
+        self._records.clear()
+
+class DatabaseStorage(RecordStorage):
+    """Хранилище состояний в таблице fsm_states основной базы: переживает перезапуск и доступно всем процессам бота"""
+    
+    def __init__(self, session_factory, ttl=86400, purge_interval=3600):
+        self.session_factory = session_factory
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._purged_at = None
+    
+    def _where(self, key):
+        return FSMState.chat == key[0], FSMState.user == key[1]
+    
+    async def _load(self, key):
+        async with self.session_factory() as session:
+            row = await session.scalar(select(FSMState).where(*self._where(key)).limit(1))
+        
+        # Брошенный диалог считается закончившимся через ttl секунд
+        if row is None or row.updated_at < datetime.datetime.utcnow() - datetime.timedelta(seconds=self.ttl):
+            return None
+        
+        return {
+            'state': row.state,
+            'data': json.loads(row.data) if row.data else {},
+            'bucket': json.loads(row.bucket) if row.bucket else {},
+        }
+    
+    async def _store(self, key, record):
+        async with self.session_factory() as session:
+            if record is None:
+                await session.execute(delete(FSMState).where(*self._where(key)))
+                await session.commit()
+            else:
+                values = {
+                    'state': record['state'],
+                    'data': json.dumps(record['data'], ensure_ascii=False) if record['data'] else None,
+                    'bucket': json.dumps(record['bucket'], ensure_ascii=False) if record['bucket'] else None,
+                    'updated_at': datetime.datetime.utcnow(),
+                }
+                result = await session.execute(update(FSMState).where(*self._where(key)).values(**values))
+                if result.rowcount == 0:
+                    session.add(FSMState(chat=key[0], user=key[1], **values))
+                
+                # Запись мог одновременно создать другой процесс - тогда просто обновляем ее
+                try:
+                    await session.commit()
+                except IntegrityError:
+                    await session.rollback()
+                    await session.execute(update(FSMState).where(*self._where(key)).values(**values))
+                    await session.commit()
+        
+        await self._purge()
+    
+    async def _purge(self):
+        """Удаляет просроченные записи не чаще раза в purge_interval секунд"""
+        now = datetime.datetime.utcnow()
+        if self._purged_at is not None and (now - self._purged_at).total_seconds() < self.purge_interval:
+            return
+        self._purged_at = now
+        
+        async with self.session_factory() as session:
+            result = await session.execute(delete(FSMState).where(
+                FSMState.updated_at < now - datetime.timedelta(seconds=self.ttl)
+            ))
+            await session.commit()
+        if result.rowcount:
+            logger.info("Удалено просроченных состояний диалогов: %s", result.rowcount)
+
+def create_storage(backend='database', session_factory=None, ttl=86400, maxsize=10000, redis_url=None):
+    """Хранилище состояний диалогов по имени: memory, database или redis"""
+    if backend == 'redis':
+        # Необязательная зависимость: нужна только для хранения состояний в Redis
+        from aiogram.contrib.fsm_storage.redis import RedisStorage2
+        
+        url = urlsplit(redis_url or 'redis://localhost:6379/0')
+        return RedisStorage2(
+            host=url.hostname or 'localhost',
+            port=url.port or 6379,
+            db=int(url.path.lstrip('/') or 0),
+            password=url.password,
+            ssl=url.scheme == 'rediss',
+            state_ttl=ttl,
+            data_ttl=ttl,
+            bucket_ttl=ttl
+        )
+    
+    if backend == 'memory':
+        return TTLMemoryStorage(maxsize=maxsize, ttl=ttl)
+    
+    return DatabaseStorage(session_factory, ttl=ttl)
@@ -0,0 +1,56 @@
+import os
+import sys
+import pytest
+import aiogram.bot.api
+
+# Модули бота лежат в корне каталога и импортируются по имени, как при запуске bot.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+class FakeTelegram:
+    """Подмена Bot API без сети: запоминает вызовы и отвечает как Telegram"""
+    
+    def __init__(self):
+        self.calls = []
+    
+    async def make_request(self, session, server, token, method, data=None, files=None, **kwargs):
+        self.calls.append((method, data or {}))
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'test', 'username': 'test_bot'}
+        if method == 'sendMessage':
+            return {'message_id': 1, 'date': 0, 'chat': {'id': int(data['chat_id']), 'type': 'supergroup'},
+                    'text': data.get('text')}
+        return True
+    
+    def methods(self):
+        return [method for method, _ in self.calls]
+
+class FakeTimer:
+    """Часы для тестов с ограничениями по времени: время меняется только присваиванием now"""
+    
+    def __init__(self):
+        self.now = 0.0
+    
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def timer():
+    return FakeTimer()
+
+@pytest.fixture
+def fake_telegram(monkeypatch):
+    fake = FakeTelegram()
+    monkeypatch.setattr(aiogram.bot.api, 'make_request', fake.make_request)
+    return fake
+
+def make_update(update_id, chat_id=-100, user_id=1000, text='привет'):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'text': text,
+            'chat': {'id': chat_id, 'type': 'supergroup', 'title': 'Test'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'user'},
+        },
+    }
@@ -0,0 +1,67 @@
+import asyncio
+import database
+from cache import TTLCache
+
+def test_ttl_and_lru_eviction(timer):
+    cache = TTLCache(maxsize=2, ttl=10, timer=timer)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    # 'b' использовался давнее всего
+    assert cache.get('b') is None
+    
+    timer.now = 11
+    assert cache.get('a') is None
+    assert cache.stats()['hits'] == 1
+
+def test_invalidate_during_load_is_not_cached():
+    cache = TTLCache()
+    token = cache.begin_load('chat')
+    cache.invalidate('chat')
+    assert not cache.set_loaded('chat', 'stale', token)
+    assert cache.get('chat') is None
+    
+    token = cache.begin_load('chat')
+    assert cache.set_loaded('chat', 'fresh', token)
+    assert cache.get('chat') == 'fresh'
+
+def test_get_chat_rules_drops_snapshot_invalidated_during_load(monkeypatch):
+    cache = TTLCache()
+    loads = []
+    
+    async def load_chat_rules(db_session, chat_id):
+        loads.append(chat_id)
+        if len(loads) == 1:
+            # Пока идет запрос, администратор меняет правила и сбрасывает кэш
+            await asyncio.sleep(0)
+            cache.invalidate(chat_id)
+            return 'stale'
+        return 'fresh'
+    
+    monkeypatch.setattr(database, 'load_chat_rules', load_chat_rules)
+    
+    async def scenario():
+        assert await database.get_chat_rules(None, cache, -1) == 'stale'
+        assert await database.get_chat_rules(None, cache, -1) == 'fresh'
+        assert await database.get_chat_rules(None, cache, -1) == 'fresh'
+    
+    asyncio.run(scenario())
+    assert loads == ['-1', '-1']
+
+def test_failed_load_is_forgotten(monkeypatch):
+    cache = TTLCache()
+    
+    async def load_chat_rules(db_session, chat_id):
+        raise RuntimeError('database is down')
+    
+    monkeypatch.setattr(database, 'load_chat_rules', load_chat_rules)
+    
+    async def scenario():
+        try:
+            await database.get_chat_rules(None, cache, -1)
+        except RuntimeError:
+            pass
+    
+    asyncio.run(scenario())
+    assert cache._loading == {}
@@ -0,0 +1,71 @@
+import os
+import subprocess
+import sys
+from duplicates import FINGERPRINT_SIZE, DuplicateDetector, fingerprint, similarity
+
+SPAM = 'заходите в наш канал, там раздают бесплатные подписки каждый день'
+
+def test_fingerprint_is_bounded_and_tolerates_small_edits():
+    original = fingerprint(SPAM)
+    assert len(original) == FINGERPRINT_SIZE
+    assert similarity(original, fingerprint(SPAM)) == 1
+    assert similarity(original, fingerprint(SPAM + ' !!!')) >= 0.8
+    assert similarity(original, fingerprint('совсем другое сообщение о погоде и планах на выходные')) < 0.5
+
+def test_similarity_is_the_same_in_every_process():
+    # Хеши фрагментов не зависят от PYTHONHASHSEED: отпечаток в другом процессе тот же
+    code = 'import sys; from duplicates import fingerprint; print(sorted(fingerprint(sys.argv[1])))'
+    bot_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for seed in ('0', '4'):
+        output = subprocess.run(
+            [sys.executable, '-c', code, SPAM], cwd=bot_dir, env={**os.environ, 'PYTHONHASHSEED': seed},
+            capture_output=True, text=True, check=True
+        ).stdout
+        assert output.strip() == str(sorted(fingerprint(SPAM)))
+    
+    assert similarity(fingerprint(SPAM), fingerprint(SPAM + ' (от ивана)')) == 29 / 32
+    assert similarity(fingerprint(SPAM), fingerprint(SPAM + ' (от петра)')) == 30 / 32
+
+def test_near_duplicates_trigger_at_threshold(timer):
+    detector = DuplicateDetector(threshold=3, timer=timer)
+    variants = [SPAM, SPAM + ' (от ивана)', SPAM + ' (от петра)']
+    assert [detector.check(-100, text) for text in variants] == [False, False, True]
+    # Похожие сообщения в другом чате считаются отдельно
+    assert not detector.check(-200, SPAM)
+
+def test_short_and_different_messages_are_not_duplicates(timer):
+    detector = DuplicateDetector(threshold=2, timer=timer)
+    assert not detector.check(-100, 'спасибо')
+    assert not detector.check(-100, 'спасибо')
+    assert not detector.check(-100, SPAM)
+    assert not detector.check(-100, 'совсем другое сообщение о погоде и планах на выходные')
+
+def test_messages_outside_window_are_not_counted(timer):
+    detector = DuplicateDetector(threshold=2, window=60, timer=timer)
+    assert not detector.check(-100, SPAM)
+    timer.now += 61
+    assert not detector.check(-100, SPAM)
+    timer.now += 30
+    assert detector.check(-100, SPAM)
+
+def test_history_is_bounded_per_chat(timer):
+    detector = DuplicateDetector(threshold=3, history=2, timer=timer)
+    assert not detector.check(-100, SPAM)
+    # Буфер хранит только history последних отпечатков: копия, вытесненная другими сообщениями, забывается
+    for index in range(2):
+        detector.check(-100, f'сообщение номер {index} про что-то совсем другое и длинное')
+    assert not detector.check(-100, SPAM)
+    assert not detector.check(-100, SPAM)
+    assert detector.check(-100, SPAM)
+    assert len(detector._chats.get(-100)) == 2
+
+def test_chats_are_evicted_by_count_and_inactivity(timer):
+    detector = DuplicateDetector(threshold=2, window=60, max_chats=2, timer=timer)
+    for chat_id in (-1, -2, -3):
+        detector.check(chat_id, SPAM)
+    assert len(detector) == 2
+    # Первый чат вытеснен вместе со своими отпечатками
+    assert not detector.check(-1, SPAM)
+    
+    timer.now += 61
+    assert detector._chats.get(-3) is None
@@ -0,0 +1,57 @@
+from flood import BUCKETS, FloodLimiter
+
+def test_limit_within_window(timer):
+    limiter = FloodLimiter(timer=timer)
+    results = []
+    for _ in range(4):
+        results.append(limiter.hit(-100, 1, limit=3, window=10))
+        timer.now += 1
+    assert results == [False, False, False, True]
+    # Другой пользователь и другой чат считаются отдельно
+    assert not limiter.hit(-100, 2, limit=3, window=10)
+    assert not limiter.hit(-200, 1, limit=3, window=10)
+
+def test_window_boundary(timer):
+    limiter = FloodLimiter(timer=timer)
+    limiter.hit(-100, 1, limit=1, window=10)
+    
+    # Сообщение из последних (BUCKETS - 1) / BUCKETS окна всегда учитывается
+    timer.now = 10 * (BUCKETS - 1) / BUCKETS - 0.1
+    assert limiter.hit(-100, 1, limit=1, window=10)
+    
+    # Через целое окно после сообщения оно уже не учитывается
+    timer.now = 20
+    assert not limiter.hit(-100, 1, limit=1, window=10)
+
+def test_window_change_resets_counts(timer):
+    timer.now = 100
+    limiter = FloodLimiter(timer=timer)
+    for _ in range(3):
+        limiter.hit(-100, 1, limit=3, window=10)
+    
+    # С другим окном номера корзин другие: старые счетчики не переносятся
+    timer.now = 101
+    assert not limiter.hit(-100, 1, limit=3, window=60)
+    for _ in range(2):
+        limiter.hit(-100, 1, limit=3, window=60)
+    assert limiter.hit(-100, 1, limit=3, window=60)
+
+def test_clock_going_back_resets_counts(timer):
+    timer.now = 100
+    limiter = FloodLimiter(timer=timer)
+    limiter.hit(-100, 1, limit=1, window=10)
+    timer.now = 50
+    assert not limiter.hit(-100, 1, limit=1, window=10)
+    assert limiter.hit(-100, 1, limit=1, window=10)
+
+def test_inactive_and_excess_entries_are_evicted(timer):
+    limiter = FloodLimiter(maxsize=2, timer=timer)
+    for user_id in (1, 2, 3):
+        limiter.hit(-100, user_id, limit=5, window=10)
+    assert len(limiter) == 2
+    assert (-100, 1) not in limiter._entries
+    
+    # Записи пользователей, которые молчат дольше окна, вытесняются при следующем сообщении
+    timer.now = 11
+    limiter.hit(-100, 4, limit=5, window=10)
+    assert list(limiter._entries) == [(-100, 4)]
@@ -0,0 +1,47 @@
+import atexit
+import io
+import json
+import logging
+import pytest
+from logs import setup_logging
+
+@pytest.fixture
+def read_records():
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    stream = io.StringIO()
+    listener = setup_logging(log_format='json', stream=stream)
+    atexit.unregister(listener.stop)
+    stopped = []
+    
+    def read():
+        # stop() дожидается, пока слушатель запишет все записи из очереди; повторно его вызывать нельзя
+        if not stopped:
+            listener.stop()
+            stopped.append(True)
+        return [json.loads(line) for line in stream.getvalue().splitlines()]
+    
+    yield read
+    read()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
+
+def test_message_is_formatted_with_args_and_extra(read_records):
+    logging.getLogger('test').warning("Рейд в чате %s: %s", -100, ValueError('flood'), extra={'chat_id': -100})
+    record, = read_records()
+    assert record['message'] == 'Рейд в чате -100: flood'
+    assert record['chat_id'] == -100 and record['level'] == 'WARNING'
+
+def test_traceback_is_formatted_in_calling_thread(read_records):
+    try:
+        raise RuntimeError('boom')
+    except RuntimeError:
+        logging.getLogger('test').exception("Ошибка обработки")
+    
+    record, = read_records()
+    assert record['message'] == 'Ошибка обработки'
+    assert 'RuntimeError: boom' in record['exc_info']
+    assert 'Traceback' in record['exc_info']
@@ -0,0 +1,77 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from aiogram import Bot, types
+from aiogram.dispatcher.handler import CancelHandler
+import middlewares
+from cache import TTLCache
+from conftest import make_update
+from database import ChatRules
+from middlewares import ModerationMiddleware
+
+ADMIN_ID = 1
+USER_ID = 1000
+
+class FakeAdminCache:
+    async def is_admin(self, chat_id, user_id, title=None):
+        return user_id == ADMIN_ID
+
+def make_rules(chat_id, banned_words=()):
+    settings = SimpleNamespace(
+        chat_id=str(chat_id), filter_obscene=True, filter_links=True, filter_keywords=True,
+        filter_duplicates=False, action_type='delete', mute_duration=3600, escalation_policy=None,
+        flood_limit=None, flood_window=None
+    )
+    return ChatRules(settings, banned_words=banned_words)
+
+@pytest.fixture
+def moderate(monkeypatch):
+    """Прогоняет текст через ModerationMiddleware и возвращает найденное нарушение или None"""
+    violations = []
+    
+    async def handle_violation(message, violation_type, rules):
+        violations.append(violation_type)
+    
+    monkeypatch.setattr(middlewares, 'handle_violation', handle_violation)
+    
+    def run(text, user_id=USER_ID, chat_id=-100):
+        async def scenario():
+            bot = Bot(token='123456:test-token')
+            rules_cache = TTLCache()
+            rules_cache.set(str(chat_id), make_rules(chat_id, banned_words=['спам']))
+            bot['rules_cache'] = rules_cache
+            bot['admin_cache'] = FakeAdminCache()
+            Bot.set_current(bot)
+            
+            update = make_update(1, chat_id=chat_id, user_id=user_id, text=text)
+            if text.startswith('/'):
+                update['message']['entities'] = [
+                    {'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}
+                ]
+            message = types.Message.to_object(update['message'])
+            try:
+                await ModerationMiddleware().on_pre_process_message(message, {})
+            except CancelHandler:
+                pass
+            finally:
+                await (await bot.get_session()).close()
+        
+        violations.clear()
+        asyncio.run(scenario())
+        return violations[0] if violations else None
+    
+    return run
+
+# handle_violation удаляет сообщение на любом шаге политики: достаточно, что нарушение до него дошло
+def test_unknown_command_with_link_is_deleted(moderate):
+    assert moderate('/x http://spam.com') == 'link'
+    assert moderate('/x спам') == 'keyword'
+
+def test_bot_command_from_member_is_moderated(moderate):
+    assert moderate('/addword спам') == 'keyword'
+
+def test_bot_command_from_admin_is_not_moderated(moderate):
+    assert moderate('/addword спам', user_id=ADMIN_ID) is None
+    assert moderate('/allowdomain spam.com', user_id=ADMIN_ID) is None
+    # Вне команды сообщение администратора проверяется как обычно
+    assert moderate('заходите на http://spam.com', user_id=ADMIN_ID) == 'link'
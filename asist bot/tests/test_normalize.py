@@ -0,0 +1,24 @@
+import pytest
+from benchmarks.bench_normalize import FALSE_POSITIVE_SAMPLES, OBFUSCATED_SAMPLES
+from filters import OBSCENE_MATCHER
+from normalize import normalize_text
+
+@pytest.mark.parametrize('text', OBFUSCATED_SAMPLES)
+def test_obfuscated_words_are_found(text):
+    assert OBSCENE_MATCHER.find(normalize_text(text)) is not None
+
+@pytest.mark.parametrize('text', FALSE_POSITIVE_SAMPLES)
+def test_neighbouring_words_are_not_glued(text):
+    assert OBSCENE_MATCHER.find(normalize_text(text)) is None
+
+@pytest.mark.parametrize('text, expected', [
+    ('б.л.я', 'бля'),
+    ('бля.д', 'бляд'),
+    ('хлеб,ляжки', 'хлеб ляжки'),
+    ('клуб...лягушка', 'клуб   лягушка'),
+    ('привет, как дела? т.е. нормально...', 'привет как дела те нормально'),
+    ('п0рн0 в 2024', 'порно в 2024'),
+    ('в 6 л я', 'в 6 л я'),
+])
+def test_separators_and_digits(text, expected):
+    assert normalize_text(text) == expected
@@ -0,0 +1,145 @@
+import asyncio
+import pytest
+from aiogram.utils.exceptions import RetryAfter
+from outbox import PRIORITY_ACTION, PRIORITY_NOTICE, Outbox, TokenBucket
+
+def recorder(calls, name, result=None):
+    async def call():
+        calls.append(name)
+        return result
+    return call
+
+async def settle():
+    # Даем очереди выбрать и выполнить все готовые запросы
+    for _ in range(20):
+        await asyncio.sleep(0)
+
+async def advance(outbox, timer, seconds):
+    timer.now += seconds
+    outbox._wakeup.set()
+    await settle()
+
+def test_token_bucket_refills_with_time():
+    bucket = TokenBucket(rate=2, capacity=2, now=0)
+    bucket.take(0)
+    bucket.take(0)
+    assert bucket.delay(0) == pytest.approx(0.5)
+    assert bucket.delay(0.5) == 0
+    
+    bucket.block(1, 3)
+    assert bucket.delay(1) == pytest.approx(3.5)
+    assert bucket.is_full(10)
+
+def test_actions_go_before_notices_in_submission_order(timer):
+    calls = []
+    
+    async def scenario():
+        outbox = Outbox(global_rate=100, concurrency=1, timer=timer)
+        outbox.post(recorder(calls, 'notice-1'), chat_id=-1)
+        outbox.post(recorder(calls, 'delete-1'), priority=PRIORITY_ACTION)
+        outbox.post(recorder(calls, 'notice-2'), chat_id=-1, priority=PRIORITY_NOTICE)
+        outbox.post(recorder(calls, 'delete-2'), priority=PRIORITY_ACTION)
+        outbox.start()
+        await settle()
+        await outbox.stop(timeout=0)
+    
+    asyncio.run(scenario())
+    assert calls == ['delete-1', 'delete-2', 'notice-1', 'notice-2']
+
+def test_global_rate_limit(timer):
+    calls = []
+    
+    async def scenario():
+        outbox = Outbox(global_rate=2, timer=timer)
+        for index in range(5):
+            outbox.post(recorder(calls, index), priority=PRIORITY_ACTION)
+        outbox.start()
+        
+        await settle()
+        sent_at_start = len(calls)
+        await advance(outbox, timer, 0.5)
+        sent_after_half_second = len(calls)
+        await advance(outbox, timer, 1)
+        await outbox.stop(timeout=0)
+        return sent_at_start, sent_after_half_second
+    
+    # Корзина вмещает 2 запроса и пополняется 2 токенами в секунду
+    assert asyncio.run(scenario()) == (2, 3)
+    assert calls == [0, 1, 2, 3, 4]
+
+def test_group_rate_limit_delays_only_that_chat(timer):
+    calls = []
+    
+    async def scenario():
+        outbox = Outbox(global_rate=100, group_rate=2, timer=timer)
+        for index in range(3):
+            outbox.post(recorder(calls, f'chat-1 #{index}'), chat_id=-1)
+        outbox.post(recorder(calls, 'chat-2'), chat_id=-2)
+        # Личные сообщения и действия лимитом группы не ограничены
+        outbox.post(recorder(calls, 'private'), chat_id=5)
+        outbox.post(recorder(calls, 'delete'), chat_id=-1, priority=PRIORITY_ACTION)
+        outbox.start()
+        
+        await settle()
+        before = list(calls)
+        stats = outbox.stats()
+        # 2 сообщения в минуту: следующий токен через 30 секунд
+        await advance(outbox, timer, 30)
+        await outbox.stop(timeout=0)
+        return before, stats
+    
+    before, stats = asyncio.run(scenario())
+    assert sorted(before) == ['chat-1 #0', 'chat-1 #1', 'chat-2', 'delete', 'private']
+    assert stats['delayed'] == 1
+    assert calls[-1] == 'chat-1 #2'
+
+def test_run_returns_result_and_propagates_errors(timer):
+    async def failing():
+        raise ValueError('bad request')
+    
+    async def scenario():
+        outbox = Outbox(timer=timer)
+        outbox.start()
+        try:
+            result = await outbox.run(recorder([], 'ok', result=42))
+            with pytest.raises(ValueError, match='bad request'):
+                await outbox.run(failing)
+            # Ошибка запроса без ожидания только записывается в лог
+            outbox.post(failing)
+            await settle()
+            return result, outbox.stats()
+        finally:
+            await outbox.stop(timeout=0)
+    
+    result, stats = asyncio.run(scenario())
+    assert result == 42
+    assert stats['sent'] == 1 and stats['failed'] == 2
+
+def test_retry_after_delays_and_repeats_request(timer):
+    attempts = []
+    
+    async def flaky():
+        attempts.append(len(attempts))
+        if len(attempts) == 1:
+            raise RetryAfter(5)
+        return 'sent'
+    
+    async def scenario():
+        outbox = Outbox(timer=timer)
+        outbox.start()
+        try:
+            future = outbox.post(flaky, priority=PRIORITY_ACTION)
+            await settle()
+            assert not future.done() and outbox.stats()['delayed'] == 1
+            # Пауза блокирует и общую корзину: до ее конца повтор не отправляется
+            await advance(outbox, timer, 4)
+            assert not future.done()
+            await advance(outbox, timer, 2)
+            return await future, outbox.stats()
+        finally:
+            await outbox.stop(timeout=0)
+    
+    result, stats = asyncio.run(scenario())
+    assert result == 'sent'
+    assert attempts == [0, 1]
+    assert stats['retries'] == 1 and stats['sent'] == 1
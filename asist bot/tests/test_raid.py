@@ -0,0 +1,78 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from aiogram.utils.exceptions import MethodNotKnown, RetryAfter
+from outbox import PRIORITY_ACTION
+from raid import RaidGuard
+
+class FakeOutbox:
+    def __init__(self):
+        self.posted = []
+    
+    def post(self, call, chat_id=None, priority=None):
+        self.posted.append((call, chat_id, priority))
+
+def make_message(message_id, chat_id=-100, user_id=1000):
+    return SimpleNamespace(
+        message_id=message_id,
+        chat=SimpleNamespace(id=chat_id),
+        from_user=SimpleNamespace(id=user_id, username=None)
+    )
+
+def test_raid_mode_starts_after_threshold_violations(timer):
+    async def scenario():
+        guard = RaidGuard(None, FakeOutbox(), threshold=3, window=10, timer=timer)
+        results = [guard.track(-100) for _ in range(3)]
+        accepted = guard.add(make_message(1))
+        await guard.stop()
+        return results, accepted
+    
+    assert asyncio.run(scenario()) == ([False, False, True], True)
+
+def test_track_is_false_when_messages_are_not_batched(timer):
+    async def scenario():
+        outbox = FakeOutbox()
+        guard = RaidGuard(None, outbox, threshold=2, window=10, timer=timer)
+        guard.track(-100)
+        assert guard.track(-100)
+        await guard.stop()
+        
+        # Рейд в чате еще не закончился, но фоновой задачи больше нет: сообщение нужно удалить сразу
+        timer.now += 1
+        return guard.track(-100), guard.add(make_message(2)), len(guard)
+    
+    assert asyncio.run(scenario()) == (False, False, 0)
+
+class FakeBot:
+    def __init__(self, error):
+        self.error = error
+        self.deleted = []
+    
+    async def request(self, method, data):
+        raise self.error
+    
+    async def delete_message(self, chat_id, message_id):
+        self.deleted.append(message_id)
+
+def test_batch_is_retried_when_rate_limited(timer):
+    async def scenario():
+        outbox = FakeOutbox()
+        guard = RaidGuard(FakeBot(RetryAfter(5)), outbox, timer=timer)
+        # Ошибка уходит в очередь, и она повторит пачку: одиночные удаления не ставятся
+        with pytest.raises(RetryAfter):
+            await guard._delete_messages(-100, [1, 2, 3])
+        return outbox.posted
+    
+    assert asyncio.run(scenario()) == []
+
+def test_rejected_batch_falls_back_to_single_deletes(timer):
+    async def scenario():
+        outbox = FakeOutbox()
+        bot = FakeBot(MethodNotKnown('Method not found'))
+        guard = RaidGuard(bot, outbox, timer=timer)
+        await guard._delete_messages(-100, [1, 2, 3])
+        for call, _, _ in outbox.posted:
+            await call()
+        return bot.deleted, {priority for _, _, priority in outbox.posted}
+    
+    assert asyncio.run(scenario()) == ([1, 2, 3], {PRIORITY_ACTION})
@@ -0,0 +1,154 @@
+import asyncio
+from aiogram import Bot, types
+from conftest import make_update
+from scheduler import ScheduledDispatcher, UpdateScheduler
+
+def update(update_id, chat_id=-100):
+    return types.Update.to_object(make_update(update_id, chat_id=chat_id))
+
+def test_updates_of_one_chat_run_in_order_and_chats_in_parallel():
+    events = []
+    
+    async def process(update):
+        events.append(('start', update.update_id))
+        # Первое обновление чата -100 обрабатывается дольше остальных
+        await asyncio.sleep(0.05 if update.update_id == 1 else 0)
+        events.append(('end', update.update_id))
+        return update.update_id
+    
+    async def scenario():
+        scheduler = UpdateScheduler(process)
+        futures = [await scheduler.submit(update(1)), await scheduler.submit(update(2)),
+                   await scheduler.submit(update(3, chat_id=-200))]
+        results = await asyncio.gather(*futures)
+        assert await scheduler.drain(timeout=1)
+        return results, scheduler.stats()
+    
+    results, stats = asyncio.run(scenario())
+    assert results == [1, 2, 3]
+    # Обновление 2 ждет окончания 1, а обновление другого чата - нет
+    assert events.index(('end', 1)) < events.index(('start', 2))
+    assert events.index(('end', 3)) < events.index(('end', 1))
+    assert stats['processed'] == 3 and stats['pending'] == 0 and stats['chats'] == 0
+
+def test_concurrency_limit():
+    running = []
+    peak = []
+    
+    async def scenario():
+        release = asyncio.Event()
+        
+        async def process(update):
+            running.append(update.update_id)
+            peak.append(len(running))
+            await release.wait()
+            running.remove(update.update_id)
+        
+        scheduler = UpdateScheduler(process, concurrency=2)
+        futures = [await scheduler.submit(update(chat_id, chat_id=-chat_id)) for chat_id in range(1, 6)]
+        await asyncio.sleep(0.01)
+        stats = scheduler.stats()
+        release.set()
+        await asyncio.gather(*futures)
+        return stats
+    
+    stats = asyncio.run(scenario())
+    assert max(peak) == 2
+    assert stats['running'] == 2 and stats['queued'] == 3 and stats['chats'] == 5
+
+def test_submit_waits_when_max_pending_reached():
+    async def scenario():
+        release = asyncio.Event()
+        
+        async def process(update):
+            await release.wait()
+        
+        scheduler = UpdateScheduler(process, max_pending=2)
+        await scheduler.submit(update(1))
+        await scheduler.submit(update(2, chat_id=-200))
+        blocked = asyncio.create_task(scheduler.submit(update(3)))
+        await asyncio.sleep(0.01)
+        waited = not blocked.done()
+        
+        release.set()
+        await (await blocked)
+        return waited, scheduler.stats()
+    
+    waited, stats = asyncio.run(scenario())
+    assert waited
+    assert stats['processed'] == 3 and stats['pending'] == 0
+
+class FakeUpdates:
+    """Подмена getUpdates: отдает заранее заданные пачки, затем пустые ответы"""
+    
+    def __init__(self, batches):
+        self.batches = list(batches)
+        self.calls = 0
+    
+    async def __call__(self, limit=None, offset=None, timeout=None, allowed_updates=None):
+        self.calls += 1
+        if self.batches:
+            return self.batches.pop(0)
+        await asyncio.sleep(0.01)
+        return []
+
+def make_dispatcher(handler, **kwargs):
+    dp = ScheduledDispatcher(Bot(token='123456:test-token'), **kwargs)
+    dp.register_message_handler(handler)
+    return dp
+
+async def stop_polling(dp, polling):
+    dp.stop_polling()
+    await asyncio.wait_for(polling, 1)
+    await (await dp.bot.get_session()).close()
+
+def test_polling_keeps_order_within_chat(fake_telegram):
+    handled = []
+    
+    async def handler(message: types.Message):
+        # Ранние обновления чата обрабатываются дольше поздних
+        await asyncio.sleep(0.03 / message.message_id)
+        handled.append((message.chat.id, message.message_id))
+    
+    async def scenario():
+        dp = make_dispatcher(handler)
+        dp.bot.get_updates = FakeUpdates([
+            [update(1), update(2), update(3, chat_id=-200)],
+            [update(4), update(5, chat_id=-200)],
+        ])
+        polling = asyncio.create_task(dp.start_polling(relax=0))
+        await asyncio.sleep(0.01)
+        assert await dp.scheduler.drain(timeout=1)
+        await stop_polling(dp, polling)
+    
+    asyncio.run(scenario())
+    assert [message_id for chat_id, message_id in handled if chat_id == -100] == [1, 2, 4]
+    assert [message_id for chat_id, message_id in handled if chat_id == -200] == [3, 5]
+
+def test_polling_pauses_while_scheduler_is_full(fake_telegram):
+    handled = []
+    
+    async def scenario():
+        release = asyncio.Event()
+        
+        async def handler(message: types.Message):
+            await release.wait()
+            handled.append(message.message_id)
+        
+        dp = make_dispatcher(handler, max_pending=2)
+        get_updates = dp.bot.get_updates = FakeUpdates([[update(1), update(2), update(3)], [update(4)]])
+        polling = asyncio.create_task(dp.start_polling(relax=0))
+        await asyncio.sleep(0.05)
+        # Третье обновление пачки ждет места в планировщике, следующая пачка не запрашивается
+        paused = get_updates.calls, dp.scheduler.stats()['pending']
+        
+        release.set()
+        await asyncio.sleep(0.05)
+        assert await dp.scheduler.drain(timeout=1)
+        await stop_polling(dp, polling)
+        return paused, get_updates.calls
+    
+    paused, calls = asyncio.run(scenario())
+    assert paused == (1, 2)
+    assert calls > 2
+    assert handled == [1, 2, 3, 4]
@@ -0,0 +1,123 @@
+import asyncio
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from aiogram import Bot, types
+from aiogram.dispatcher.webhook import BOT_DISPATCHER_KEY
+from conftest import make_update
+from scheduler import ScheduledDispatcher
+from webhook import (DRAINING_KEY, INFLIGHT_KEY, SECRET_TOKEN_HEADER, SECRET_TOKEN_KEY, ModeratorWebhookHandler,
+                     drain_updates)
+
+SECRET = 'test-secret'
+
+def make_app(dp, secret=SECRET):
+    # То же приложение, что собирает start_webhook, без запуска сервера на порту
+    app = web.Application()
+    app[SECRET_TOKEN_KEY] = secret
+    app[INFLIGHT_KEY] = set()
+    app[DRAINING_KEY] = asyncio.Event()
+    app[BOT_DISPATCHER_KEY] = dp
+    app.router.add_route('*', '/webhook', ModeratorWebhookHandler)
+    return app
+
+async def make_client(dp, secret=SECRET):
+    client = TestClient(TestServer(make_app(dp, secret)))
+    await client.start_server()
+    return client
+
+def make_dispatcher(handler):
+    bot = Bot(token='123456:test-token')
+    dp = ScheduledDispatcher(bot, concurrency=10, max_pending=100)
+    dp.register_message_handler(handler)
+    return dp
+
+def post_update(client, update, secret=SECRET):
+    headers = {SECRET_TOKEN_HEADER: secret} if secret is not None else {}
+    return client.post('/webhook', json=update, headers=headers)
+
+def test_rejects_missing_or_wrong_secret(fake_telegram):
+    handled = []
+    
+    async def handler(message: types.Message):
+        handled.append(message.message_id)
+    
+    async def scenario():
+        dp = make_dispatcher(handler)
+        client = await make_client(dp)
+        try:
+            missing = await post_update(client, make_update(1), secret=None)
+            wrong = await post_update(client, make_update(2), secret='wrong')
+            # Заголовок не из ASCII отклоняется как неверный, а не падает с ошибкой сервера
+            non_ascii = await post_update(client, make_update(3), secret='секрет')
+            return missing.status, wrong.status, non_ascii.status, dp.scheduler.stats()['processed']
+        finally:
+            await client.close()
+            await (await dp.bot.get_session()).close()
+    
+    assert asyncio.run(scenario()) == (401, 401, 401, 0)
+    assert handled == []
+
+def test_updates_are_routed_through_scheduler(fake_telegram):
+    async def handler(message: types.Message):
+        await message.answer(f"ответ {message.message_id}")
+    
+    async def scenario():
+        dp = make_dispatcher(handler)
+        submitted = []
+        submit = dp.scheduler.submit
+        
+        async def tracking_submit(update):
+            submitted.append(update.update_id)
+            return await submit(update)
+        
+        dp.scheduler.submit = tracking_submit
+        client = await make_client(dp)
+        try:
+            statuses = [(await post_update(client, make_update(update_id))).status for update_id in (1, 2)]
+            return statuses, submitted, dp.scheduler.stats()
+        finally:
+            await client.close()
+            await (await dp.bot.get_session()).close()
+    
+    statuses, submitted, stats = asyncio.run(scenario())
+    assert statuses == [200, 200]
+    assert submitted == [1, 2]
+    assert stats['processed'] == 2 and stats['pending'] == 0
+    assert fake_telegram.methods() == ['sendMessage', 'sendMessage']
+
+def test_shutdown_drains_inflight_updates(fake_telegram):
+    finished = []
+    
+    async def scenario():
+        started = asyncio.Event()
+        release = asyncio.Event()
+        
+        async def handler(message: types.Message):
+            started.set()
+            await release.wait()
+            finished.append(message.message_id)
+        
+        dp = make_dispatcher(handler)
+        app_client = await make_client(dp)
+        app = app_client.server.app
+        try:
+            inflight = asyncio.create_task(post_update(app_client, make_update(1)))
+            await started.wait()
+            assert len(app[INFLIGHT_KEY]) == 1
+            
+            drain = asyncio.create_task(drain_updates(app, timeout=5))
+            await asyncio.sleep(0.05)
+            # Пока идет остановка, новые обновления не принимаются, а начатое еще не завершено
+            rejected = await post_update(app_client, make_update(2))
+            assert not drain.done()
+            assert finished == []
+            
+            release.set()
+            await drain
+            assert finished == [1]
+            return rejected.status, (await inflight).status, dp.scheduler.stats()['pending']
+        finally:
+            await app_client.close()
+            await (await dp.bot.get_session()).close()
+    
+    assert asyncio.run(scenario()) == (503, 200, 0)
@@ -0,0 +1,92 @@
+import asyncio
+import datetime
+import logging
+from sqlalchemy import insert
+from database import Violation
+
+logger = logging.getLogger(__name__)
+
+class ViolationLog:
+    """Буфер записей о нарушениях: записи копятся в памяти и пишутся в базу пачками фоновой задачей"""
+    
+    def __init__(self, session_factory, batch_size=100, flush_interval=2.0, max_pending=100000):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.written = 0
+        self.dropped = 0
+        self._pending = []
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._stopping = False
+    
+    def __len__(self):
+        return len(self._pending)
+    
+    def add(self, chat_id, user_id, username, message_text, violation_type, action_taken):
+        """Ставит запись в очередь, не обращаясь к базе"""
+        self._pending.append({
+            'chat_id': str(chat_id),
+            'user_id': str(user_id),
+            'username': username,
+            'message_text': message_text,
+            'violation_type': violation_type,
+            'action_taken': action_taken,
+            # Время фиксируем сразу, а не в момент записи пачки
+            'timestamp': datetime.datetime.utcnow(),
+        })
+        
+        # Если база долго недоступна, не даем очереди съесть всю память
+        if len(self._pending) > self.max_pending:
+            overflow = len(self._pending) - self.max_pending
+            del self._pending[:overflow]
+            self.dropped += overflow
+            logger.error("Очередь нарушений переполнена, отброшено записей: %s", overflow)
+        
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+    
+    async def flush(self):
+        """Записывает все накопленные записи одной вставкой"""
+        async with self._flush_lock:
+            batch, self._pending = self._pending, []
+            if not batch:
+                return
+            
+            try:
+                async with self.session_factory() as session:
+                    await session.execute(insert(Violation), batch)
+                    await session.commit()
+            except Exception as e:
+                # Возвращаем пачку в начало очереди, повторим при следующей записи
+                logger.error("Ошибка при записи %s нарушений в базу: %s", len(batch), e)
+                self._pending[:0] = batch
+                return
+            
+            self.written += len(batch)
+    
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Останавливает фоновую задачу и дописывает все, что осталось в очереди"""
+        # Задачу не отменяем: отмена посреди записи потеряла бы взятую из очереди пачку
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        
+        await self.flush()
@@ -0,0 +1,112 @@
+import asyncio
+import hmac
+import logging
+from aiohttp import web
+from aiogram import Dispatcher, types
+from aiogram.dispatcher.webhook import RESPONSE_TIMEOUT, WebhookRequestHandler
+from aiogram.utils.executor import Executor
+
+logger = logging.getLogger(__name__)
+
+# Заголовок, в котором Telegram передает секретный токен, указанный при установке вебхука
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+# Типы обновлений, которые запрашиваем у Telegram: chat_member по умолчанию не присылается,
+# callback_query - нажатия кнопок навигации по спискам
+ALLOWED_UPDATES = (types.AllowedUpdates.MESSAGE + types.AllowedUpdates.CALLBACK_QUERY
+                   + types.AllowedUpdates.CHAT_MEMBER + types.AllowedUpdates.MY_CHAT_MEMBER)
+
+# Ключи состояния в приложении aiohttp
+SECRET_TOKEN_KEY = 'WEBHOOK_SECRET_TOKEN'
+INFLIGHT_KEY = 'WEBHOOK_INFLIGHT'
+DRAINING_KEY = 'WEBHOOK_DRAINING'
+
+def secret_matches(request, secret):
+    """Сравнивает секретный токен из заголовка запроса с ожидаемым за постоянное время"""
+    # compare_digest принимает строки только из ASCII: сравниваем байты, в которые aiohttp декодировал заголовок
+    header = request.headers.get(SECRET_TOKEN_HEADER, '')
+    return hmac.compare_digest(header.encode('utf-8', 'surrogateescape'), secret.encode('utf-8'))
+
+class ModeratorWebhookHandler(WebhookRequestHandler):
+    """Обработчик вебхука с проверкой секретного токена и учетом обновлений, которые еще обрабатываются"""
+    
+    async def post(self):
+        app = self.request.app
+        
+        secret_token = app.get(SECRET_TOKEN_KEY)
+        if secret_token and not secret_matches(self.request, secret_token):
+            logger.warning("Запрос к вебхуку с неверным секретным токеном от %s", self.request.remote)
+            raise web.HTTPUnauthorized()
+        
+        # Во время остановки новые обновления не принимаем: Telegram повторит их доставку позже
+        if app[DRAINING_KEY].is_set():
+            raise web.HTTPServiceUnavailable()
+        
+        task = asyncio.current_task()
+        app[INFLIGHT_KEY].add(task)
+        try:
+            return await super().post()
+        finally:
+            app[INFLIGHT_KEY].discard(task)
+    
+    async def process_update(self, update):
+        # Обновление обрабатывается в очереди своего чата, если диспетчер работает через планировщик
+        scheduler = getattr(self.get_dispatcher(), 'scheduler', None)
+        if scheduler is None:
+            return await super().process_update(update)
+        
+        future = await scheduler.submit(update)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), RESPONSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            # Telegram ждет ответа ограниченное время: отвечаем сразу, обработка продолжится в очереди
+            logger.warning("Обновление %s обрабатывается дольше %s секунд", update.update_id, RESPONSE_TIMEOUT)
+            return None
+
+async def drain_updates(app, timeout):
+    """Перестает принимать обновления и ждет завершения уже начатых"""
+    # Состояние запущенного приложения aiohttp не меняется, поэтому признак остановки - событие
+    app[DRAINING_KEY].set()
+    
+    inflight = set(app[INFLIGHT_KEY])
+    if not inflight:
+        return
+    
+    logger.info("Ожидание завершения обработки обновлений: %s", len(inflight))
+    _, pending = await asyncio.wait(inflight, timeout=timeout)
+    if pending:
+        logger.warning("Не дождались завершения обработки обновлений: %s", len(pending))
+
+def start_webhook(dp: Dispatcher, webhook_url, webhook_path, host, port, secret_token=None,
+                  max_connections=40, drain_timeout=30, allowed_updates=None, on_startup=None, on_shutdown=None):
+    """Запуск бота в режиме вебхука на локальном HTTP-сервере aiohttp"""
+    web_app = web.Application()
+    web_app[SECRET_TOKEN_KEY] = secret_token
+    web_app[INFLIGHT_KEY] = set()
+    web_app[DRAINING_KEY] = asyncio.Event()
+    
+    async def startup(dispatcher: Dispatcher):
+        if on_startup is not None:
+            await on_startup(dispatcher)
+        
+        # Накопившиеся обновления не сбрасываем: после перезапуска Telegram дошлет их на вебхук
+        await dispatcher.bot.set_webhook(
+            webhook_url,
+            secret_token=secret_token,
+            max_connections=max_connections,
+            allowed_updates=allowed_updates
+        )
+        logger.info("Вебхук установлен: %s", webhook_url)
+    
+    async def shutdown(dispatcher: Dispatcher):
+        # Сначала дожидаемся начатых обновлений, затем освобождаем ресурсы
+        await drain_updates(web_app, drain_timeout)
+        
+        if on_shutdown is not None:
+            await on_shutdown(dispatcher)
+    
+    runner = Executor(dp, skip_updates=False)
+    runner.on_startup(startup, polling=False)
+    runner.on_shutdown(shutdown, polling=False)
+    runner.set_webhook(webhook_path=webhook_path, request_handler=ModeratorWebhookHandler, web_app=web_app)
+    runner.run_app(host=host, port=port)